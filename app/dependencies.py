@@ -0,0 +1,42 @@
+"""Shared dependencies providing the configured stores and broker integrations to the API routes."""
+
+import os
+from functools import lru_cache
+
+from app.modules.broker_integrations.capital_integration import CapitalIntegration
+from app.modules.broker_integrations.ig_integration import IGIntegration
+from app.modules.config import read_config
+from app.modules.price_store import PriceStore
+from app.modules.pub_sub import Multiplexer
+
+CONFIG_PATH = os.environ.get('CONFIG_PATH', './configs/default.yaml')
+
+
+@lru_cache()
+def get_config():
+    """Load the server configuration once per process."""
+    return read_config(CONFIG_PATH)
+
+
+@lru_cache()
+def get_price_store() -> PriceStore:
+    """Return the PriceStore for the configured data folder."""
+    return PriceStore(get_config()['data_folder'])
+
+
+@lru_cache()
+def get_ig_integration() -> IGIntegration:
+    """Return an IG integration using the configured credentials, caching historical data in the PriceStore."""
+    return IGIntegration(**get_config()['credentials']['ig'], price_store=get_price_store())
+
+
+@lru_cache()
+def get_capital_integration() -> CapitalIntegration:
+    """Return a Capital.com integration using the configured credentials."""
+    return CapitalIntegration(**get_config()['credentials']['capital'])
+
+
+@lru_cache()
+def get_multiplexer() -> Multiplexer:
+    """Return the Multiplexer sharing this worker's subscription to the Publisher between its stream clients."""
+    return Multiplexer()
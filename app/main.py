@@ -4,7 +4,14 @@ import asyncio
 
 from fastapi import FastAPI, Depends
 
+from app.dependencies import get_capital_integration, get_config, get_ig_integration, get_multiplexer, \
+    get_price_store
 from app.middleware.auth import get_token_header
+from app.modules.broker_integrations import capital_integration, ig_integration
+from app.modules.broker_integrations.ig_stream import close_stream_managers
+from app.modules.broker_integrations.sessions import close_sessions, start_keep_warm
+from app.modules.broker_integrations.tokens import stop_token_managers
+from app.modules.market_data import create_hub
 from app.modules.pub_sub import Publisher
 from app.modules.utils import by_one_worker
 
@@ -38,9 +45,43 @@ app = FastAPI(
 @by_one_worker('/tmp/worker-share')  # only run this startup function for a single worker.
 def start():
     """Async tasks must be started here when using uvicorn"""
+    # The /stream routes of every worker subscribe to this Publisher over a Unix socket.
     pub = Publisher()
     asyncio.create_task(pub.listen())
 
+    # Stream the configured epics into the PriceStore, the Publisher and the bar aggregator.
+    store = get_price_store()
+    app.state.store_task = asyncio.create_task(store.start())
+    app.state.market_data = create_hub(get_config(), {'ig': get_ig_integration(), 'capital': get_capital_integration()},
+                                       pub, store)
+    app.state.market_data.start()
+
+
+@app.on_event('startup')
+def warm_broker_connections():
+    """Keep a pooled connection to each broker's dealing endpoint open in every worker."""
+    start_keep_warm(get_ig_integration().url)
+    start_keep_warm(get_capital_integration().server)
+
+
+@app.on_event('shutdown')
+async def close_broker_connections():
+    """
+    Stop the market data hub and flush the PriceStore, and close the broker sessions, token renewals and Publisher
+    subscription of this worker.
+    """
+    if getattr(app.state, 'market_data', None) is not None:
+        # The streams stop first, then the ticks queued for the store and bar sinks are handled.
+        await app.state.market_data.stop()
+    if getattr(app.state, 'store_task', None) is not None:
+        # Ticks and bars still buffered (up to the store's flush frequency) are written by a final flush.
+        get_price_store().stop()
+        await app.state.store_task
+    await close_stream_managers()
+    stop_token_managers(ig_integration.tokens, capital_integration.tokens)
+    await close_sessions()
+    await get_multiplexer().close()
+
 
 app.include_router(position.router, dependencies=[Depends(get_token_header)])
 app.include_router(history.router, dependencies=[Depends(get_token_header)])
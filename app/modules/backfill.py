@@ -0,0 +1,123 @@
+"""
+Module contains a job backfilling IG historical candles into the PriceStore, many windows at a time.
+
+Usage: python -m app.modules.backfill --start 2023-01-01 --end 2023-07-01 --resolution MINUTE [--epics ...]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from app.modules.broker_integrations.ig_integration import IGAPIException, IGIntegration, RESOLUTIONS, \
+    ig_time_to_ns, tokens
+from app.modules.broker_integrations.sessions import close_sessions
+from app.modules.broker_integrations.tokens import stop_token_managers
+from app.modules.config import read_config
+from app.modules.price_store import PriceStore
+
+log = logging.getLogger('Backfill')
+
+WINDOW_CANDLES = 1000  # Candles requested per window.
+
+
+def windows(resolution: str, start_ns: int, end_ns: int, candles: int = WINDOW_CANDLES) -> List[Tuple[int, int]]:
+    """
+    Split [start_ns, end_ns) into half-open windows of at most candles periods of a resolution.
+
+    Windows are aligned to multiples of their length since the epoch, so overlapping backfills share them.
+    """
+    length = RESOLUTIONS[resolution] * candles * 10 ** 9
+    first = start_ns - start_ns % length
+    bounds = ((max(window, start_ns), min(window + length, end_ns)) for window in range(first, end_ns, length))
+    return [(start, end) for start, end in bounds if start < end]
+
+
+class Backfill:
+    """
+    Fetches the historical candles of several epics over a date range with bounded concurrency.
+
+    Progress is checkpointed by the PriceStore coverage index as each window is stored, so running an interrupted
+    backfill again only requests the windows which were not completed.
+    """
+
+    def __init__(self, integration: IGIntegration, epics: Iterable[str], resolution: str, start_ns: int,
+                 end_ns: int, concurrency: int = 4, candles: int = WINDOW_CANDLES):
+        """Initialise the job, the integration must have a price store."""
+        if integration.price_store is None:
+            raise ValueError('Backfill requires an IGIntegration with a price store')
+        self.integration = integration
+        self.epics = list(epics)
+        self.resolution = resolution
+        self.start_ns = start_ns
+        self.end_ns = end_ns
+        self.concurrency = concurrency
+        self.candles = candles
+        self.done = 0
+        self.failed = 0
+        self.stored = 0
+
+    def pending(self) -> List[Tuple[str, int, int]]:
+        """List the (epic, start_ns, end_ns) windows which are not fully held yet."""
+        coverage = self.integration.price_store.coverage
+        return [(epic, start, end) for epic in self.epics
+                for start, end in windows(self.resolution, self.start_ns, self.end_ns, self.candles)
+                if coverage.missing(epic, self.resolution, start, end)]
+
+    async def _fetch(self, semaphore: asyncio.Semaphore, epic: str, start_ns: int, end_ns: int, total: int):
+        """Fetch and store one window, a failed window is logged and left for the next run."""
+        async with semaphore:
+            try:
+                stored = await self.integration.fill_historical_data(epic, self.resolution, start_ns, end_ns,
+                                                                     self.candles)
+            except (IGAPIException, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.failed += 1
+                log.error('Failed to backfill %s from %d to %d: %s', epic, start_ns, end_ns, e)
+                return
+            self.done += 1
+            self.stored += stored
+            log.info('Backfilled %d/%d windows (%d candles)', self.done, total, self.stored)
+
+    async def run(self) -> int:
+        """Fetch every pending window, returning the number of windows which failed."""
+        pending = self.pending()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._fetch(semaphore, epic, start, end, len(pending)) for epic, start, end in pending))
+        return self.failed
+
+
+async def main(args: Optional[List[str]] = None):
+    """Backfill the IG epics of the server configuration."""
+    parser = argparse.ArgumentParser(description='Backfill IG historical candles into the price store.')
+    parser.add_argument('--start', required=True, help='UTC start date (YYYY-MM-DD), inclusive')
+    parser.add_argument('--end', required=True, help='UTC end date (YYYY-MM-DD), exclusive')
+    parser.add_argument('--resolution', default='MINUTE', choices=list(RESOLUTIONS))
+    parser.add_argument('--epics', nargs='*', help='IG epics, defaults to the configured epics')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--config', default=os.environ.get('CONFIG_PATH', './configs/default.yaml'))
+    options = parser.parse_args(args)
+
+    config = read_config(options.config)
+    store = PriceStore(config['data_folder'])
+    integration = IGIntegration(**config['credentials']['ig'], price_store=store)
+    job = Backfill(integration, options.epics or config['epics']['ig'], options.resolution,
+                   ig_time_to_ns(options.start), ig_time_to_ns(options.end), options.concurrency)
+
+    started = time.monotonic()
+    try:
+        failed = await job.run()
+        await store.compact(grace=0)
+    finally:
+        stop_token_managers(tokens)
+        await close_sessions()
+    log.info('Backfill finished in %.0fs, %d windows failed', time.monotonic() - started, failed)
+    return failed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(1 if asyncio.run(main()) else 0)
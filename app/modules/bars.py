@@ -0,0 +1,161 @@
+"""
+Module contains an incremental aggregator turning live ticks into bid/ask OHLC bars at several resolutions.
+"""
+
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from app.modules.broker_integrations.base_integration import Tick
+from app.modules.price_store import PriceStore
+from app.modules.pub_sub import Publisher
+
+# Length of each bar resolution in nanoseconds.
+BAR_RESOLUTIONS = {
+    '1s': 10 ** 9,
+    '1m': 60 * 10 ** 9,
+    '5m': 300 * 10 ** 9,
+    '1h': 3600 * 10 ** 9,
+}
+
+
+def bar_topic(resolution: str, epic: str) -> str:
+    """Publisher topic carrying the bars of an epic at a resolution."""
+    return f'ochl:{resolution}:{epic}'
+
+
+class Bar:
+    """A bid/ask OHLC bar which is updated in place as ticks arrive."""
+    __slots__ = ('time_stamp', 'open_bid', 'high_bid', 'low_bid', 'close_bid', 'open_ask', 'high_ask', 'low_ask',
+                 'close_ask', 'volume')
+
+    def __init__(self, time_stamp: int, bid: float, ask: float):
+        """Open a bar at time_stamp (epoch-ns) with a first tick."""
+        self.time_stamp = time_stamp
+        self.open_bid = self.high_bid = self.low_bid = self.close_bid = bid
+        self.open_ask = self.high_ask = self.low_ask = self.close_ask = ask
+        self.volume = 1
+
+    def update(self, bid: float, ask: float):
+        """Add a tick to the bar."""
+        if bid > self.high_bid:
+            self.high_bid = bid
+        elif bid < self.low_bid:
+            self.low_bid = bid
+        if ask > self.high_ask:
+            self.high_ask = ask
+        elif ask < self.low_ask:
+            self.low_ask = ask
+        self.close_bid = bid
+        self.close_ask = ask
+        self.volume += 1
+
+    def to_json(self, epic: str, resolution: str, closed: bool) -> str:
+        """Serialise the bar as a Publisher message."""
+        return json.dumps({
+            'epic': epic,
+            'resolution': resolution,
+            'closed': closed,
+            **{name: getattr(self, name) for name in self.__slots__},
+        })
+
+
+class BarAggregator:
+    """
+    Aggregates ticks into bars at every resolution in BAR_RESOLUTIONS at once, with constant work per tick.
+
+    Every tick publishes the partial bar it updated, and closed bars are published a final time and persisted in
+    the PriceStore next to the raw ticks.
+    """
+    bars: Dict[Tuple[str, str], Bar]
+    closed: Dict[Tuple[str, str], int]  # Start of the last bar of each epic and resolution closed on expiry.
+    clock_offsets: Dict[str, int]  # Broker clock minus local clock at the latest tick of each epic, in ns.
+
+    def __init__(self, publisher: Optional[Publisher] = None, store: Optional[PriceStore] = None,
+                 resolutions: Optional[Dict[str, int]] = None):
+        """Initialise the aggregator, publisher and store are optional to allow using it standalone."""
+        self.publisher = publisher
+        self.store = store
+        self.resolutions = list((resolutions or BAR_RESOLUTIONS).items())
+        self.bars = {}
+        self.closed = {}
+        self.clock_offsets = {}
+
+    def update(self, epic: str, time_stamp: int, bid: float, ask: float) -> List[Tuple[str, Bar, bool]]:
+        """
+        Add a tick to the current bar of every resolution.
+
+        Returns the (resolution, bar, closed) events produced: a closed event for each bar the tick ended,
+        followed by a partial event for each bar the tick updated. Ticks older than the current bar, or than the
+        last bar closed on expiry, are ignored.
+        """
+        events = []
+        for resolution, length in self.resolutions:
+            start = time_stamp - time_stamp % length
+            key = (epic, resolution)
+            bar = self.bars.get(key)
+            if bar is None and start <= self.closed.get(key, -1):
+                continue
+            if bar is None or start > bar.time_stamp:
+                if bar is not None:
+                    events.append((resolution, bar, True))
+                bar = self.bars[key] = Bar(start, bid, ask)
+            elif start == bar.time_stamp:
+                bar.update(bid, ask)
+            else:
+                continue
+            events.append((resolution, bar, False))
+
+        return events
+
+    def close_expired(self, now: int, clock_offsets: Optional[Dict[str, int]] = None) -> List[Tuple[str, str, Bar]]:
+        """
+        Close and remove the bars whose period ended before now (epoch-ns), returning (epic, resolution, bar).
+
+        clock_offsets maps epics to the offset of their broker's clock from now, so their bars expire in broker time.
+        """
+        lengths = dict(self.resolutions)
+        offsets = clock_offsets or {}
+        expired = [key for key, bar in self.bars.items()
+                   if bar.time_stamp + lengths[key[1]] <= now + offsets.get(key[0], 0)]
+        for key in expired:
+            self.closed[key] = self.bars[key].time_stamp
+        return [(epic, resolution, self.bars.pop((epic, resolution))) for epic, resolution in expired]
+
+    async def emit(self, epic: str, resolution: str, bar: Bar, closed: bool):
+        """Publish a bar and persist it if it is closed."""
+        if closed and self.store is not None:
+            self.store.store_bar(epic, resolution, bar)
+        if self.publisher is not None:
+            await self.publisher.broadcast(bar_topic(resolution, epic), bar.to_json(epic, resolution, closed))
+
+    async def on_tick(self, epic: str, time_stamp: int, bid: float, ask: float):
+        """Add a tick and emit every bar event it produced."""
+        self.clock_offsets[epic] = time_stamp - time.time_ns()
+        for resolution, bar, closed in self.update(epic, time_stamp, bid, ask):
+            await self.emit(epic, resolution, bar, closed)
+
+    async def consume(self, ticks: AsyncIterator[Tick]):
+        """Aggregate every tick of a broker stream, e.g. IGIntegration.stream or CapitalIntegration.stream."""
+        async for tick in ticks:
+            await self.on_tick(tick.epic, tick.time_stamp, tick.bid, tick.ask)
+
+    async def close_periodically(self, frequency: float = 1, delay: float = 2):
+        """
+        Close bars which received no tick after their period ended in broker time, allowing delay seconds for late
+        ticks.
+
+        When this is cancelled (e.g. on shutdown) the bars whose period has ended are persisted without waiting for
+        late ticks. Bars whose period has not ended are not, as the next aggregator rebuilds and persists that period.
+        """
+        try:
+            while True:
+                await asyncio.sleep(frequency)
+                now = time.time_ns() - int(delay * 1e9)
+                for epic, resolution, bar in self.close_expired(now, self.clock_offsets):
+                    await self.emit(epic, resolution, bar, True)
+        finally:
+            if self.store is not None:
+                for epic, resolution, bar in self.close_expired(time.time_ns(), self.clock_offsets):
+                    self.store.store_bar(epic, resolution, bar)
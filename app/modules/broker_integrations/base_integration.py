@@ -1,7 +1,149 @@
 """Contains generic classes for broker API integration."""
 
+import json
+import logging
 from abc import abstractmethod
+from collections import deque
 from dataclasses import dataclass
+from struct import Struct
+from typing import Deque, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+RECONNECT_BACKOFF = 0.1  # Seconds, the first reconnection of a dropped stream is attempted within
+RECONNECT_CAP = 10.0  # Longest delay in seconds between reconnection attempts
+STREAM_GAPS_KEPT = 1000  # Most recent stream gaps kept in stream_gaps
+
+log = logging.getLogger('BrokerStreams')
+
+# Common schema of historical candles from every broker, missing prices are null.
+CANDLE_SCHEMA = pa.schema([
+    ('time_stamp', pa.timestamp('ns', tz='UTC')),
+    ('open_bid', pa.float64()),
+    ('high_bid', pa.float64()),
+    ('low_bid', pa.float64()),
+    ('close_bid', pa.float64()),
+    ('open_ask', pa.float64()),
+    ('high_ask', pa.float64()),
+    ('low_ask', pa.float64()),
+    ('close_ask', pa.float64()),
+    ('volume', pa.int64()),
+])
+
+# Price fields of a candle in the broker payloads, shared by IG and Capital.com.
+CANDLE_PRICES = {'open': 'openPrice', 'high': 'highPrice', 'low': 'lowPrice', 'close': 'closePrice'}
+CANDLE_POINT = pa.struct([
+    ('snapshotTimeUTC', pa.string()),
+    *((field, pa.struct([('bid', pa.float64()), ('ask', pa.float64())])) for field in CANDLE_PRICES.values()),
+    ('lastTradedVolume', pa.int64()),
+])
+
+
+def parse_candles(points: List[dict]) -> pa.Table:
+    """
+    Convert the 'prices' list of an IG or Capital.com historical prices response to a CANDLE_SCHEMA table.
+
+    The points are converted to Arrow in a single pass, ignoring unused keys, and the UTC time stamps are parsed as
+    a whole column. Missing bid or ask prices are kept as nulls.
+    """
+    struct = pa.array(points, type=CANDLE_POINT)
+    columns = {'time_stamp': pc.cast(struct.field('snapshotTimeUTC'), pa.timestamp('ns')).cast(
+        CANDLE_SCHEMA.field('time_stamp').type)}
+    for name, field in CANDLE_PRICES.items():
+        for side in ('bid', 'ask'):
+            columns[f'{name}_{side}'] = struct.field(field).field(side)
+    columns['volume'] = struct.field('lastTradedVolume')
+    return pa.table(columns, schema=CANDLE_SCHEMA)
+
+
+class EpicTable:
+    """Interns epic names as small integer ids, so ticks carry an id instead of their own copy of the name."""
+
+    def __init__(self):
+        """Create an empty table."""
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.json_names: List[str] = []  # Names encoded as JSON strings, for serialising ticks.
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, epic: str) -> int:
+        """Return the id of an epic, adding it to the table on first use."""
+        epic_id = self.ids.get(epic)
+        if epic_id is None:
+            epic_id = self.ids[epic] = len(self.names)
+            self.names.append(epic)
+            self.json_names.append(json.dumps(epic))
+        return epic_id
+
+
+# Epic ids are only meaningful within the process which interned them.
+epic_table = EpicTable()
+
+TICK_STRUCT = Struct('<Iqqdd')  # Binary tick: epic id, time stamp, received, bid, ask.
+TICK_DTYPE = np.dtype([('epic_id', '<u4'), ('time_stamp', '<i8'), ('received', '<i8'), ('bid', '<f8'),
+                       ('ask', '<f8')])
+TICK_BINARY = Struct('<qqdd')  # Published binary tick, named by its topic: time stamp, received, bid, ask.
+
+
+class Tick(NamedTuple):
+    """A live price from a broker stream, times in epoch-ns."""
+    epic_id: int  # Id of the epic in epic_table.
+    time_stamp: int  # Time of the price according to the broker.
+    received: int  # Time the price was received.
+    bid: float
+    ask: float
+
+    @property
+    def epic(self) -> str:
+        """Name of the epic."""
+        return epic_table.names[self.epic_id]
+
+    def to_json(self) -> str:
+        """Serialise as a JSON object with the name of the epic."""
+        return (f'{{"epic":{epic_table.json_names[self.epic_id]},"time_stamp":{self.time_stamp},'
+                f'"received":{self.received},"bid":{self.bid!r},"ask":{self.ask!r}}}')
+
+    def to_bytes(self) -> bytes:
+        """Serialise as a TICK_STRUCT."""
+        return TICK_STRUCT.pack(self.epic_id, self.time_stamp, self.received, self.bid, self.ask)
+
+    def to_binary(self) -> bytes:
+        """Serialise as a TICK_BINARY, without the epic id which is local to the process."""
+        return TICK_BINARY.pack(self.time_stamp, self.received, self.bid, self.ask)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Tick':
+        """Deserialise a TICK_STRUCT."""
+        return cls._make(TICK_STRUCT.unpack(data))
+
+
+def ticks_to_array(ticks: Sequence[Tick]) -> np.ndarray:
+    """Batch ticks into a TICK_DTYPE structured array."""
+    return np.array(ticks, dtype=TICK_DTYPE)
+
+
+class StreamGap(NamedTuple):
+    """A period in which a broker stream was disconnected and its epics received no prices, in epoch-ns."""
+    broker: str
+    epics: Tuple[str, ...]
+    start: int
+    end: int
+
+
+# Gaps of every broker stream in this process, oldest first, for consumers which need to know about missed prices.
+stream_gaps: Deque[StreamGap] = deque(maxlen=STREAM_GAPS_KEPT)
+
+
+def record_gap(broker: str, epics, start: int, end: int) -> StreamGap:
+    """Record a gap in a broker stream once it has reconnected."""
+    gap = StreamGap(broker, tuple(epics), start, end)
+    stream_gaps.append(gap)
+    log.warning('%s stream recovered after %.3fs gap for %d epics', broker, (end - start) / 10 ** 9, len(gap.epics))
+    return gap
 
 
 @dataclass
@@ -1,20 +1,32 @@
 """
 Contains the integration classes and functions for the Capital.com API
 """
-import datetime
+import asyncio
+import itertools
 import json
 import logging
+import time
 from base64 import b64encode, b64decode
+from typing import Dict, List, Tuple
 
 import aiohttp
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
-from cachetools import TTLCache
+import pyarrow as pa
 
-from app.modules.broker_integrations.base_integration import BaseIntegration, NewPositionDetails
+from app.modules.broker_integrations.base_integration import BaseIntegration, NewPositionDetails, parse_candles, \
+    RECONNECT_BACKOFF, RECONNECT_CAP, Tick, epic_table, record_gap
+from app.modules.broker_integrations.scheduler import ACCOUNT, MARKET_DATA, TRADING, RequestScheduler
+from app.modules.broker_integrations.sessions import get_session
+from app.modules.broker_integrations.tokens import TokenManager
+from app.modules.utils import backoff_delay
 
-cache = TTLCache(maxsize=10, ttl=600)  # Time limited cache for access token
 store = {}  # Share token store across all instances of CapitalClient
+tokens: Dict[str, TokenManager] = {}  # Session tokens of each user, shared across all instances
+SESSION_TTL = 600  # Seconds a Capital.com session is valid for
+STREAM_URL = 'wss://api-streaming-capital.backend-capital.com/connect'
+STREAM_HEARTBEAT = 5  # Seconds between websocket pings, a connection without a pong is closed after half of it.
+STREAM_PING_INTERVAL = 60  # Seconds between Capital.com ping messages, the stream is closed after 10 idle minutes.
 
 
 class CapitalAPIException(Exception):
@@ -27,7 +39,7 @@ class CapitalAPIException(Exception):
         except ValueError:
             self.message = f"Invalid JSON error message from Capital.com: {response.text}"
         else:
-            self.code = json_res["errorCode"]
+            self.code = json_res.get("errorCode", 0) if isinstance(json_res, dict) else 0
         self.status_code = status_code
         self.response = response
         self.request = getattr(response, "request", None)
@@ -36,6 +48,36 @@ class CapitalAPIException(Exception):
         return f"APIError(status code={self.status_code}) || Capital.com Error: {self.code}"
 
 
+# Capital.com allows 10 requests per second for a user, one position or order request per 0.1 seconds and one
+# session request per second.
+scheduler = RequestScheduler({'account': (10, 10), 'trading': (10, 1), 'session': (1, 1)},
+                             errors=(CapitalAPIException,))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def check_subscription(response, message: dict):
+    """Raise CapitalAPIException unless a marketData.subscribe reply subscribed every epic."""
+    # {'status': 'OK', 'destination': 'marketData.subscribe', 'payload': {'subscriptions': {'OIL_CRUDE': 'PROCESSED'}}}
+    payload = message.get('payload') or {}
+    failed = {epic: result for epic, result in payload.get('subscriptions', {}).items() if result != 'PROCESSED'}
+    if message.get('status') != 'OK' or failed:
+        error = {'errorCode': failed} if failed else payload
+        raise CapitalAPIException(response, message.get('status'), json.dumps(error))
+
+
+def classify_request(method: str, path: str) -> Tuple[int, List[str]]:
+    """Priority lane and rate limit buckets of a Capital.com REST request."""
+    if ('/positions' in path or '/workingorders' in path) and method.upper() != 'GET':
+        return TRADING, ['trading', 'account']
+    if '/confirms' in path:
+        return TRADING, ['account']
+    if '/session' in path:
+        return ACCOUNT, ['session', 'account']
+    if '/prices' in path or '/markets' in path:
+        return MARKET_DATA, ['account']
+    return ACCOUNT, ['account']
+
+
 def encrypt_password(password, key):
     """Encrypt API Key Password using RSA."""
     key = b64decode(key)
@@ -59,37 +101,55 @@ class CapitalIntegration(BaseIntegration):
             self.server = "https://api-capital.backend-capital.com"
         else:
             self.server = "https://demo-api-capital.backend-capital.com"
+        self.stream_url = STREAM_URL
 
     async def __auth_request(self, method, path, **kwargs):
-        """Wrapper method for making authenticated API requests."""
+        """Wrapper method for making authenticated API requests, metered by the account's request scheduler."""
+        lane, buckets = classify_request(method, path)
+        return await scheduler.submit(lambda: self.__send_auth_request(method, path, **kwargs), lane, buckets,
+                                      idempotent=method.upper() == 'GET')
+
+    async def __send_auth_request(self, method, path, **kwargs):
+        """Make a single authenticated API request."""
         headers = await self.__headers()
         if 'headers' in kwargs:
             headers.update(kwargs['headers'])
             del kwargs['headers']
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, self.server + path, headers=headers, **kwargs) as resp:
-                try:
-                    return await resp.json()
-                except:
-                    self.log.error(await resp.text())
-                    raise
+        async with get_session(self.server).request(method, self.server + path, headers=headers, **kwargs) as resp:
+            if resp.status in RETRY_STATUSES:
+                raise CapitalAPIException(resp, resp.status, await resp.text())
+            try:
+                return await resp.json()
+            except:
+                self.log.error(await resp.text())
+                raise
 
     async def __make_request(self, method, path, **kwargs):
         """Wrapper method for making API requests, returns both response and response headers."""
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, self.server + path, **kwargs) as resp:
-                try:
-                    return resp.headers, await resp.json()
-                except:
-                    self.log.error(await resp.text())
-                    raise
+        lane, buckets = classify_request(method, path)
+        return await scheduler.submit(lambda: self.__send_request(method, path, **kwargs), lane, buckets,
+                                      idempotent=method.upper() == 'GET')
+
+    async def __send_request(self, method, path, **kwargs):
+        """Make a single API request."""
+        async with get_session(self.server).request(method, self.server + path, **kwargs) as resp:
+            if resp.status in RETRY_STATUSES:
+                raise CapitalAPIException(resp, resp.status, await resp.text())
+            try:
+                return resp.headers, await resp.json()
+            except:
+                self.log.error(await resp.text())
+                raise
 
     async def __token(self):
-        """Create a session using the stored credentials."""
-        if 'access_token' in cache:
-            return cache['access_token']
+        """Getter for the (security token, CST) pair of the current session."""
+        if self.username not in tokens:
+            tokens[self.username] = TokenManager(self.__create_session, SESSION_TTL, margin=60)
+        return await tokens[self.username].get()
 
+    async def __create_session(self):
+        """Create a session using the stored credentials."""
         encryption_key, timestamp = await self.__get_encryption_key()
         string_encrypt = f"{self.password}|{timestamp}"
         encrypted_password = str(encrypt_password(string_encrypt, encryption_key), "utf-8")
@@ -102,9 +162,7 @@ class CapitalIntegration(BaseIntegration):
             "X-CAP-API-KEY": self.api_key,
             "content-type": "application/json",
         })
-        cache['access_token'] = (headers["X-SECURITY-TOKEN"], headers["CST"])
-
-        return cache['access_token']
+        return headers["X-SECURITY-TOKEN"], headers["CST"]
 
     async def __headers(self):
         """Returns headers with auth token."""
@@ -160,12 +218,21 @@ class CapitalIntegration(BaseIntegration):
         final_data = await self.__confirmation(data["dealReference"])
         return final_data
 
-    async def prices(self, epic, resolution="MINUTE", limit=10):
-        """Returns historical prices for a particular instrument"""
+    async def prices(self, epic, resolution="MINUTE", limit=10, start=None, end=None):
+        """Returns historical prices for a particular instrument, optionally between two UTC date times."""
         url = f"/api/v1/prices/{epic}?resolution={resolution}&max={limit}"
+        if start is not None:
+            url += f"&from={start}"
+        if end is not None:
+            url += f"&to={end}"
         data = await self.__auth_request("GET", url)
         return data
 
+    async def candles(self, epic, resolution="MINUTE", limit=10, start=None, end=None) -> pa.Table:
+        """Returns historical prices for a particular instrument as a CANDLE_SCHEMA table."""
+        data = await self.prices(epic, resolution, limit, start, end)
+        return parse_candles(data.get('prices', []))
+
     async def search_instruments(self, search_term):
         """Returns the details of the given markets."""
         data = await self.__auth_request("GET", f"/api/v1/markets?searchTerm={search_term}")
@@ -177,34 +244,76 @@ class CapitalIntegration(BaseIntegration):
     async def get_positions(self):
         raise NotImplementedError()
 
-    async def stream(self, epics):
-        url = f'wss://api-streaming-capital.backend-capital.com/connect'
+    async def __send_stream_message(self, ws, destination, correlation_id, payload=None):
+        """Send a message authenticated with the current session tokens on the streaming websocket."""
         token, cst = await self.__token()
+        message = {"destination": destination, "correlationId": correlation_id, "cst": cst, "securityToken": token}
+        if payload is not None:
+            message["payload"] = payload
+        await ws.send_json(message)
+
+    async def __ping(self, ws, correlation_ids):
+        """Keep the streaming session alive while the websocket is open."""
+        while True:
+            await asyncio.sleep(STREAM_PING_INTERVAL)
+            try:
+                await self.__send_stream_message(ws, "ping", next(correlation_ids))
+            except (aiohttp.ClientError, ConnectionError, CapitalAPIException) as e:
+                self.log.warning('Failed to ping price stream: %s', e)
+                return
+
+    async def stream(self, epics):
+        """
+        Stream the prices of epics as Ticks.
+
+        Once subscribed, the websocket is reconnected with jittered backoff whenever it closes or stops answering
+        pings, and epics are subscribed again. The gap is recorded in stream_gaps. Until then, a rejected subscription
+        raises CapitalAPIException and the websocket closing raises ConnectionError.
+        """
+        correlation_ids = itertools.count(1)
+        subscribed = False
+        gap_start = None
+        attempt = 0
+        while True:
+            try:
+                async with get_session(self.stream_url).ws_connect(self.stream_url, heartbeat=STREAM_HEARTBEAT) as ws:
+                    await self.__send_stream_message(ws, "marketData.subscribe", next(correlation_ids),
+                                                     {"epics": epics})
+                    pinger = asyncio.create_task(self.__ping(ws, correlation_ids))
+                    try:
+                        async for msg in ws:
+                            if msg.type != aiohttp.WSMsgType.TEXT:
+                                break
+
+                            # {'epic': 'OIL_CRUDE', 'bid': 85.09, 'ofr': 85.12, 'timestamp': 1649250000000, ...}
+                            message = msg.json()
+                            destination = message.get('destination')
+                            if destination == 'marketData.subscribe':
+                                check_subscription(msg, message)
+                                subscribed = True
+                                if gap_start is not None:
+                                    record_gap('Capital.com', epics, gap_start, time.time_ns())
+                                    gap_start = None
+                                attempt = 0
+                                continue
+                            if destination != 'quote':
+                                continue
+
+                            payload = message['payload']
+                            yield Tick(epic_table.intern(payload['epic']), payload['timestamp'] * 1_000_000,
+                                       time.time_ns(), payload['bid'], payload['ofr'])
+                    finally:
+                        pinger.cancel()
+                    if not subscribed:
+                        reason = ws.exception() or ws.close_code
+                        raise ConnectionError(f'Price stream closed before subscribing: {reason}')
+            except (aiohttp.ClientError, asyncio.TimeoutError, CapitalAPIException) as e:
+                if not subscribed:
+                    raise
+                self.log.warning('Price stream failed: %s', e)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.ws_connect(url) as ws:
-                await ws.send_json({
-                    "destination": "marketData.subscribe",
-                    "correlationId": 1,
-                    "cst": cst,
-                    "securityToken": token,
-                    "payload": {
-                        "epics": epics
-                    }
-                })
-
-                async for msg in ws:
-                    if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                        break
-
-                    # {'epic': 'CS.D.CRYPTOB10.CFD.IP', 'ask': 8589.22, 'bid': 8509.22, 't': '13:56:58'}
-                    payload = msg.json()['payload']
-                    if 'subscriptions' in payload:
-                        continue
-
-                    yield {
-                        'epic': payload['epic'],
-                        'ask': payload['ofr'],
-                        'bid': payload['bid'],
-                        't': datetime.datetime.fromtimestamp(payload['timestamp'] / 1000),
-                    }
+            if gap_start is None:
+                gap_start = time.time_ns()
+            self.log.warning('Price stream closed, reconnecting')
+            await asyncio.sleep(backoff_delay(attempt, RECONNECT_BACKOFF, RECONNECT_CAP))
+            attempt += 1
@@ -2,17 +2,39 @@
 
 import json
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
 
-import aiohttp
-from cachetools import TTLCache
-import pandas as pd
+from app.modules.broker_integrations.base_integration import BaseIntegration, NewPositionDetails, parse_candles
+from app.modules.broker_integrations.ig_stream import get_stream_manager
+from app.modules.broker_integrations.scheduler import ACCOUNT, MARKET_DATA, TRADING, RequestScheduler
+from app.modules.broker_integrations.sessions import get_session
+from app.modules.broker_integrations.tokens import TokenManager
+from app.modules.price_store import PriceStore
 
-from app.modules.broker_integrations.base_integration import BaseIntegration, NewPositionDetails
-from app.modules.broker_integrations.lightstreamer import async_adapter, LSClient, Subscription
-
-cache = TTLCache(maxsize=10, ttl=60)  # Time limited cache for access token
 store = {}  # Share token store across all instances of IgAPI
+tokens: Dict[str, TokenManager] = {}  # Access token of each IG API key, shared across all instances
+ACCESS_TOKEN_TTL = 60  # Seconds an IG OAuth access token is valid for
+
+# Length of each IG price resolution in seconds.
+RESOLUTIONS = {
+    'SECOND': 1,
+    'MINUTE': 60,
+    'MINUTE_2': 120,
+    'MINUTE_3': 180,
+    'MINUTE_5': 300,
+    'MINUTE_10': 600,
+    'MINUTE_15': 900,
+    'MINUTE_30': 1800,
+    'HOUR': 3600,
+    'HOUR_2': 7200,
+    'HOUR_3': 10800,
+    'HOUR_4': 14400,
+    'DAY': 86400,
+    'WEEK': 604800,
+    'MONTH': 2678400,
+}
 
 
 async def refresh_token(r_token, api_key):
@@ -28,28 +50,18 @@ async def refresh_token(r_token, api_key):
         'Content-Type': 'application/json'
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.request("POST", url, headers=headers, data=payload) as resp:
-            return await resp.json()
+    async with get_session(url).request("POST", url, headers=headers, data=payload) as resp:
+        return await resp.json()
 
 
-def parse_ig_point(point):
-    """Flatten historical data response."""
-    if 'ask' not in point['openPrice'] or 'bid' not in point['openPrice']:
-        return None
-
-    return {
-        'time_stamp': datetime.fromisoformat(point['snapshotTimeUTC']),
-        'open_ask': point['openPrice']['ask'],
-        'open_bid': point['openPrice']['bid'],
-        'close_ask': point['closePrice']['ask'],
-        'close_bid': point['closePrice']['bid'],
-        'high_ask': point['highPrice']['ask'],
-        'high_bid': point['highPrice']['bid'],
-        'low_ask': point['lowPrice']['ask'],
-        'low_bid': point['lowPrice']['bid'],
-        'volume': point['lastTradedVolume']
-    }
+def ig_time_to_ns(value: str) -> int:
+    """Convert an IG UTC date (YYYY-MM-DD) or date time (YYYY-MM-DDTHH:MM:SS) to epoch-ns."""
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()) * 10 ** 9
+
+
+def ns_to_ig_time(value: int) -> str:
+    """Convert epoch-ns to an IG UTC date time (YYYY-MM-DDTHH:MM:SS)."""
+    return datetime.fromtimestamp(value // 10 ** 9, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
 
 
 class IGAPIException(Exception):
@@ -63,10 +75,32 @@ class IGAPIException(Exception):
         return f"APIError(status code={self.status_code}) || Error: {self.text}"
 
 
+# IG meters the trading and non-trading requests of an account separately, per minute.
+scheduler = RequestScheduler({'trading': (100 / 60, 10), 'non_trading': (60 / 60, 10)}, errors=(IGAPIException,))
+
+
+def classify_request(method: str, path: str) -> Tuple[int, List[str]]:
+    """Priority lane and rate limit buckets of an IG REST request."""
+    if path.startswith(('/positions/otc', '/workingorders')) and method != 'GET':
+        return TRADING, ['trading']
+    if path.startswith('/confirms'):
+        return TRADING, ['non_trading']
+    if path.startswith(('/prices', '/markets')):
+        return MARKET_DATA, ['non_trading']
+    return ACCOUNT, ['non_trading']
+
+
 class IGIntegration(BaseIntegration):
     """Class containing methods for interacting with the IG REST API."""
 
-    def __init__(self, api_key, account_id, username, password, demo=True):
+    def __init__(self, api_key, account_id, username, password, demo=True,
+                 price_store: Optional[PriceStore] = None):
+        """
+        Initialise client object with credentials and live/dev endpoint.
+
+        When a PriceStore is given, historical data is cached in it and only missing ranges are requested from IG.
+        """
+        self.price_store = price_store
         self.api_key = api_key
         self.username = username
         self.password = password
@@ -91,9 +125,8 @@ class IGIntegration(BaseIntegration):
             'Content-Type': 'application/json'
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request("POST", url, headers=headers, data=payload) as resp:
-                return await resp.json()
+        async with get_session(url).request("POST", url, headers=headers, data=payload) as resp:
+            return await resp.json()
 
     async def get_session_tokens(self):
         _, headers = await self.__make_request(1, 'GET', '/session?fetchSessionTokens=true', return_headers=True)
@@ -101,20 +134,21 @@ class IGIntegration(BaseIntegration):
 
     async def __token(self):
         """Getter for access token."""
-        if 'access_token' in cache:
-            return cache['access_token']
+        if self.api_key not in tokens:
+            tokens[self.api_key] = TokenManager(self.__acquire_token, ACCESS_TOKEN_TTL)
+        return await tokens[self.api_key].get()
+
+    async def __acquire_token(self):
+        """Get a new access token using the refresh token, or a new session if there is none or it was rejected."""
         if 'refresh_token' in store:
             token_response = await refresh_token(store['refresh_token'], self.api_key)
-            store['refresh_token'] = token_response['refresh_token']
-            cache['access_token'] = token_response['access_token']
-            return token_response['access_token']
+            if 'access_token' in token_response:
+                store['refresh_token'] = token_response['refresh_token']
+                return token_response['access_token']
 
         resp = await self.create_session()
-
         store['refresh_token'] = resp['oauthToken']['refresh_token']
-        cache['access_token'] = resp['oauthToken']['access_token']
-
-        return cache['access_token']
+        return resp['oauthToken']['access_token']
 
     async def __headers(self, version=2):
         """Getter for shared headers."""
@@ -126,24 +160,30 @@ class IGIntegration(BaseIntegration):
         }
 
     async def __make_request(self, version, method, path, return_headers=False, **kwargs):
-        """Wrapper method for making authenticated API requests."""
+        """Wrapper method for making authenticated API requests, metered by the account's request scheduler."""
+        lane, buckets = classify_request(method, path)
+        return await scheduler.submit(
+            lambda: self.__send_request(version, method, path, return_headers, **kwargs), lane, buckets,
+            idempotent=method == 'GET')
+
+    async def __send_request(self, version, method, path, return_headers=False, **kwargs):
+        """Make a single authenticated API request."""
         headers = await self.__headers(version)
         if 'headers' in kwargs:
             headers.update(kwargs['headers'])
             del kwargs['headers']
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, self.url + path, headers=headers, **kwargs) as resp:
-                if not 200 <= resp.status < 300:
-                    raise IGAPIException(resp.status, await resp.text())
-                try:
-                    if return_headers:
-                        return (await resp.json()), resp.headers
-                    else:
-                        return await resp.json()
-                except:
-                    self.log.error(await resp.text())
-                    raise
+        async with get_session(self.url).request(method, self.url + path, headers=headers, **kwargs) as resp:
+            if not 200 <= resp.status < 300:
+                raise IGAPIException(resp.status, await resp.text())
+            try:
+                if return_headers:
+                    return (await resp.json()), resp.headers
+                else:
+                    return await resp.json()
+            except:
+                self.log.error(await resp.text())
+                raise
 
     async def get_positions(self):
         """Get list of open positions."""
@@ -192,20 +232,58 @@ class IGIntegration(BaseIntegration):
 
         return details
 
-    async def get_historical_data(self, epic, resolution='DAY', max_values=100, start='2022-02-01', end='2022-02-02'):
-        """Get historical data for an instrument."""
+    async def __fetch_historical_data(self, epic, resolution, max_values, start, end):
+        """Request historical data for an instrument between two IG UTC date times."""
         resp = await self.__make_request(3, "GET", f'/prices/{epic}',
                                          params={'resolution': resolution,
-                                                 'from': start + "T00:00:00",
-                                                 'to': end + "T00:00:00",
+                                                 'from': start,
+                                                 'to': end,
                                                  'max': max_values,
                                                  'pageSize': 0})
 
         if 'prices' not in resp or len(resp['prices']) == 0:
             return
 
-        points = [parse_ig_point(point) for point in resp['prices']]
-        return pd.DataFrame(list(filter(None, points)))
+        return parse_candles(resp['prices'])
+
+    async def fill_historical_data(self, epic, resolution, start_ns: int, end_ns: int, max_values=100) -> int:
+        """
+        Request the sub-intervals of [start_ns, end_ns) missing from the price store and store them.
+
+        Returns the number of candles stored. Each sub-interval is recorded as held once it is stored, so an
+        interrupted fill resumes where it stopped.
+        """
+        # The latest candle may still be forming, so it is never recorded as held.
+        settled_ns = time.time_ns() - RESOLUTIONS[resolution] * 10 ** 9
+        stored = 0
+        for gap_start, gap_end in self.price_store.coverage.missing(epic, resolution, start_ns, end_ns):
+            # Both ends of the IG range are inclusive, whereas gaps exclude their end.
+            candles = await self.__fetch_historical_data(epic, resolution, max_values, ns_to_ig_time(gap_start),
+                                                         ns_to_ig_time(max(gap_start, gap_end - 10 ** 9)))
+            if candles is not None:
+                await self.price_store.store_candles(epic, resolution, candles)
+                stored += candles.num_rows
+            self.price_store.coverage.add(epic, resolution, gap_start, min(gap_end, settled_ns))
+        return stored
+
+    async def get_historical_data(self, epic, resolution='DAY', max_values=100, start='2022-02-01', end='2022-02-02'):
+        """
+        Get historical data for an instrument between two UTC dates (or IG date times).
+
+        With a price store, only the sub-intervals of the range which are not already held locally are requested from IG
+        and the response is read from the store, so repeating a request makes no network calls.
+        """
+        start_ns, end_ns = ig_time_to_ns(start), ig_time_to_ns(end)
+        if self.price_store is None:
+            candles = await self.__fetch_historical_data(epic, resolution, max_values, ns_to_ig_time(start_ns),
+                                                         ns_to_ig_time(end_ns))
+            return None if candles is None else candles.to_pandas()
+
+        await self.fill_historical_data(epic, resolution, start_ns, end_ns, max_values)
+        candles = await self.price_store.read_candles(epic, resolution, start_ns, end_ns)
+        if len(candles) == 0:
+            return
+        return candles
 
     async def get_position(self, deal_id: str):
         raise NotImplementedError()
@@ -215,35 +293,6 @@ class IGIntegration(BaseIntegration):
         return await self.__make_request(1, "GET", '/markets', params={'searchTerm': search_term})
 
     async def stream(self, epics):
-        stream_get, stream_put = async_adapter()
-
-        ig_session = await self.create_session()
-        token, cst = await self.get_session_tokens()
-        ls_password = "CST-%s|XST-%s" % (cst, token)
-        endpoint = ig_session['lightstreamerEndpoint']
-        ls_client = LSClient(endpoint, adapter_set="", password=ls_password)
-        ls_client.connect()
-
-        # Making a new Subscription in MERGE mode
-        subscription_prices = Subscription(
-            mode="MERGE",
-            items=[f"MARKET:{epic}" for epic in epics],  # sample CFD epics
-            fields=["BID", "OFFER", "UPDATE_TIME"],
-        )
-
-        # Adding the "on_price_update" function to Subscription
-        subscription_prices.addlistener(stream_put)
-        sub_key_prices = ls_client.subscribe(subscription_prices)
-
-        async for item in stream_get:
-            try:
-                hour, minutes, seconds = tuple(map(int, item['values']['UPDATE_TIME'].split(':')))
-                now = datetime.now().replace(hour=hour, minute=minutes, second=seconds, microsecond=0)
-                yield {
-                    'epic': item['name'].split(':')[1],
-                    'ask': float(item['values']['OFFER']),
-                    'bid': float(item['values']['BID']),
-                    't': now
-                }
-            except ValueError as e:
-                print('Error reading stream', e)
+        """Stream the prices of epics as Ticks, on the Lightstreamer session shared by every stream of the account."""
+        async for tick in get_stream_manager(self).stream(epics):
+            yield tick
@@ -0,0 +1,244 @@
+"""
+Module contains the IG price stream, one Lightstreamer session per account shared by every stream consumer.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from functools import partial
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from dateutil import tz
+
+from app.modules.broker_integrations.base_integration import RECONNECT_BACKOFF, RECONNECT_CAP, Tick, epic_table, \
+    record_gap
+from app.modules.broker_integrations.lightstreamer import ItemUpdate, LSClient, Subscription
+from app.modules.queues import BatchQueue
+from app.modules.utils import backoff_delay
+
+STREAM_QUEUE_SIZE = 100_000  # Stream updates held for a slow consumer
+PRICE_FIELDS = ["BID", "OFFER", "UPDATE_TIME"]
+IG_TIMEZONE = tz.gettz('Europe/London')  # Time zone of IG's UPDATE_TIME.
+HALF_DAY_NS = 12 * 3600 * 10 ** 9
+
+log = logging.getLogger('IGStream')
+
+
+def parse_update_time(value: str) -> int:
+    """Convert an IG stream UPDATE_TIME (HH:MM:SS, UK time) to seconds since midnight."""
+    if len(value) != 8 or value[2] != ':' or value[5] != ':':
+        raise ValueError(f'Invalid update time: {value}')
+    return int(value[:2]) * 3600 + int(value[3:5]) * 60 + int(value[6:])
+
+
+def uk_midnight_ns(value: int) -> int:
+    """Epoch-ns of the UK midnight starting the day of an epoch-ns time."""
+    day = datetime.fromtimestamp(value // 10 ** 9, IG_TIMEZONE).date()
+    return int(datetime(day.year, day.month, day.day, tzinfo=IG_TIMEZONE).timestamp()) * 10 ** 9
+
+
+def update_time_ns(midnight_ns: int, update_time: int, now_ns: int) -> int:
+    """
+    Epoch-ns of an UPDATE_TIME in seconds since the UK midnight midnight_ns of now_ns, moved a day back or forward
+    when it is over 12 hours from now_ns: a snapshot carries the time of the last update, which may be in the
+    previous session, and an update sent just before midnight may arrive after it.
+    """
+    value = midnight_ns + update_time * 10 ** 9
+    if value - now_ns > HALF_DAY_NS:
+        value -= 2 * HALF_DAY_NS
+    elif now_ns - value > HALF_DAY_NS:
+        value += 2 * HALF_DAY_NS
+    return value
+
+
+PRICE_CONVERTERS = {"BID": float, "OFFER": float, "UPDATE_TIME": parse_update_time}
+
+
+class IGStreamManager:
+    """
+    Shares one Lightstreamer session of an IG account between every consumer streaming its prices.
+
+    Each epic is subscribed as its own table, added on the live session when its first consumer arrives and deleted
+    when its last consumer leaves, so subscribing does not open a new session. Updates are decoded once and put in
+    the queue of every consumer of the epic as an immutable Tick. A consumer joining an epic which already has a
+    table starts with its latest Tick, as the table's snapshot was only sent to the earlier consumers.
+
+    When the session ends while epics are streamed, a new one is opened with jittered backoff and every epic is
+    subscribed again, its snapshot refilling the latest prices. The gap is recorded in stream_gaps.
+    """
+    client: Optional[LSClient]
+    _supervisor: Optional[asyncio.Task]
+
+    def __init__(self, integration):
+        """Initialise without a session, integration is the IGIntegration of the account."""
+        self.integration = integration
+        self.client = None
+        self.tables: Dict[str, int] = {}  # Subscription key of each subscribed epic.
+        self.consumers: Dict[str, List[BatchQueue]] = {}  # Queues of the consumers of each epic.
+        self.last_ticks: Dict[str, Tick] = {}  # Latest Tick of each subscribed epic.
+        self.sessions = 0
+        self.midnight_ns = 0
+        self.next_midnight_ns = 0
+        self._lock = asyncio.Lock()  # Serialises session and table changes.
+        self._supervisor = None
+
+    async def _connect(self) -> LSClient:
+        """Open a Lightstreamer session with the tokens of a new IG session."""
+        ig_session = await self.integration.create_session()
+        token, cst = await self.integration.get_session_tokens()
+        client = LSClient(ig_session['lightstreamerEndpoint'], adapter_set="", password=f"CST-{cst}|XST-{token}")
+        await client.connect()
+        self.sessions += 1
+        return client
+
+    async def _open(self):
+        """Open the session and subscribe every epic with consumers, the lock must be held."""
+        self.client = await self._connect()
+        self.tables.clear()
+        try:
+            for epic in self.consumers:
+                await self._add_table(epic)
+        except BaseException:
+            await self.client.destroy()
+            raise
+        if self._supervisor is None or self._supervisor.done():
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        """Reopen the session whenever it ends while epics are streamed."""
+        while self.client is not None:
+            await self.client.wait_closed()
+            if not self.consumers:
+                return
+
+            start = time.time_ns()
+            log.warning('Lightstreamer session of %s ended, reconnecting', self.integration.account_id)
+            attempt = 0
+            while True:
+                await asyncio.sleep(backoff_delay(attempt, RECONNECT_BACKOFF, RECONNECT_CAP))
+                try:
+                    async with self._lock:
+                        if not self.client.connected:  # A new consumer may have reconnected already.
+                            await self._open()
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Failed to reopen Lightstreamer session')
+                    attempt += 1
+            record_gap('IG', self.consumers, start, time.time_ns())
+
+    async def _add_table(self, epic: str):
+        """Subscribe an epic on the live session."""
+        subscription = Subscription(mode="MERGE", items=[f"MARKET:{epic}"], fields=PRICE_FIELDS,
+                                    converters=PRICE_CONVERTERS)
+        subscription.addlistener(partial(self._on_update, epic, epic_table.intern(epic)))
+        self.tables[epic] = await self.client.subscribe(subscription)
+
+    def _on_update(self, epic: str, epic_id: int, item: ItemUpdate):
+        """Convert a price update to a Tick and put it in the queue of every consumer of the epic."""
+        bid, offer, update_time = item.values
+        if bid is None or offer is None or update_time is None:
+            return
+        now_ns = time.time_ns()
+        if now_ns >= self.next_midnight_ns:
+            self.midnight_ns = uk_midnight_ns(now_ns)
+            self.next_midnight_ns = uk_midnight_ns(self.midnight_ns + 36 * 3600 * 10 ** 9)
+        time_stamp = update_time_ns(self.midnight_ns, update_time, now_ns)
+        tick = self.last_ticks[epic] = Tick(epic_id, time_stamp, now_ns, bid, offer)
+        for queue in self.consumers.get(epic, ()):
+            queue.put_nowait(tick)
+
+    async def subscribe(self, epics: List[str], queue: BatchQueue):
+        """
+        Start putting the ticks of epics in queue, opening the session or subscribing epics as needed. Nothing is
+        left subscribed for queue if this fails.
+        """
+        async with self._lock:
+            if self.client is None or not self.client.connected:
+                await self._open()
+
+            added = []
+            try:
+                for epic in epics:
+                    # Registered first, so the snapshot of a new table cannot arrive before its consumer.
+                    self.consumers.setdefault(epic, []).append(queue)
+                    added.append(epic)
+                    if epic not in self.tables:
+                        await self._add_table(epic)
+                    elif epic in self.last_ticks:
+                        queue.put_nowait(self.last_ticks[epic])
+            except BaseException:
+                await self._remove(added, queue)
+                raise
+
+    async def _remove(self, epics: List[str], queue: BatchQueue):
+        """Unsubscribe queue from epics (see unsubscribe), the lock must be held."""
+        for epic in epics:
+            queues = self.consumers.get(epic, [])
+            if queue in queues:
+                queues.remove(queue)
+            if queues:
+                continue
+            self.consumers.pop(epic, None)
+            self.last_ticks.pop(epic, None)
+            table = self.tables.pop(epic, None)
+            if table is not None and self.client is not None and self.client.connected:
+                await self.client.unsubscribe(table)
+
+    async def unsubscribe(self, epics: List[str], queue: BatchQueue):
+        """Stop putting the ticks of epics in queue, deleting the tables of epics without consumers."""
+        async with self._lock:
+            await self._remove(epics, queue)
+
+    async def stream(self, epics: List[str]) -> AsyncIterator[Tick]:
+        """Iterate over the ticks of epics until the iterator is closed."""
+        epics = list(dict.fromkeys(epics))
+        # Updates wait here while the consumer is busy, beyond STREAM_QUEUE_SIZE the oldest are dropped.
+        queue = BatchQueue(STREAM_QUEUE_SIZE, policy='drop_oldest')
+        await self.subscribe(epics, queue)
+        try:
+            dropped = 0
+            async for tick in queue.items():
+                if queue.dropped > dropped:
+                    log.warning('Stream consumer fell behind, %d updates dropped', queue.dropped - dropped)
+                    dropped = queue.dropped
+                yield tick
+        finally:
+            await self.unsubscribe(epics, queue)
+
+    async def close(self):
+        """Destroy the session, the consumers stop receiving ticks."""
+        async with self._lock:
+            if self._supervisor is not None:
+                self._supervisor.cancel()
+                self._supervisor = None
+            if self.client is not None and self.client.connected:
+                await self.client.destroy()
+            self.client = None
+            self.tables.clear()
+
+    def stats(self) -> dict:
+        """Number of sessions opened, and the consumers of each epic."""
+        return {'connected': self.client is not None and self.client.connected, 'sessions': self.sessions,
+                'epics': {epic: len(queues) for epic, queues in self.consumers.items()}}
+
+
+managers: Dict[Tuple[str, asyncio.AbstractEventLoop], IGStreamManager] = {}
+
+
+def get_stream_manager(integration) -> IGStreamManager:
+    """Return the stream manager of the account of an IGIntegration on the running event loop."""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in managers if key[1].is_closed()]:
+        del managers[key]
+    key = (integration.account_id, loop)
+    if key not in managers:
+        managers[key] = IGStreamManager(integration)
+    return managers[key]
+
+
+async def close_stream_managers():
+    """Destroy the sessions of the stream managers on the running event loop."""
+    loop = asyncio.get_running_loop()
+    for key in [key for key in managers if key[1] is loop]:
+        await managers.pop(key).close()
@@ -13,17 +13,16 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import asyncio
 import logging
-import threading
-import traceback
 import sys
-from datetime import datetime
-import asyncio
+from typing import Any, Callable, Dict, NamedTuple, Optional
+from urllib.parse import urlencode, urljoin
 
-from six.moves.urllib.request import urlopen as _urlopen
-from six.moves.urllib.parse import urlparse as parse_url, urljoin, urlencode
+import aiohttp
 
-logger = logging.getLogger(__name__)
+from app.modules.broker_integrations.sessions import get_session
+from app.modules.queues import BatchQueue
 
 try:
     from systemd.daemon import notify
@@ -55,36 +54,51 @@ LOOP_CMD = "LOOP"
 ERROR_CMD = "ERROR"
 SYNC_ERROR_CMD = "SYNC ERROR"
 OK_CMD = "OK"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+# The stream connection stays open indefinitely, the server sends a PROBE at least every few seconds.
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
 
 log = logging.getLogger(__name__)
 
 
-class Subscription(object):
-    """Represents a Subscription to be submitted to a Lightstreamer Server."""
+class ItemUpdate(NamedTuple):
+    """An update of a subscribed item with the latest value of every field, in subscription order."""
+    pos: int
+    name: str
+    values: tuple
+
+
+class ItemState:
+    """Latest decoded field values of a subscribed item, updated in place."""
+    __slots__ = ('pos', 'name', 'values')
+
+    def __init__(self, pos: int, name: str, fields: int):
+        self.pos = pos
+        self.name = name
+        self.values = [None] * fields
+
+
+class Subscription:
+    """
+    Represents a Subscription to be submitted to a Lightstreamer Server.
 
-    def __init__(self, mode, items, fields, adapter=""):
+    converters optionally maps field names to functions parsing their values (e.g. float), which only run when a
+    field changes. Listeners are called with an ItemUpdate for every update.
+    """
+
+    def __init__(self, mode, items, fields, adapter="", converters: Optional[Dict[str, Callable[[str], Any]]] = None):
         self.item_names = items
-        self._items_map = {}
+        self._items_map: Dict[int, ItemState] = {}
         self.field_names = fields
         self.adapter = adapter
         self.mode = mode
         self.snapshot = "true"
         self._listeners = []
+        self._converters = [(converters or {}).get(field) for field in fields]
 
-    def _decode(self, value, last):
-        """Decode the field value according to
-        Lightstremar Text Protocol specifications.
-        """
-        if value == "$":
-            return u""
-        elif value == "#":
-            return None
-        elif not value:
-            return last
-        elif value[0] in "#$":
-            value = value[1:]
-
-        return value
+    def field_index(self, field: str) -> int:
+        """Position of a field in the values of an ItemUpdate."""
+        return self.field_names.index(field)
 
     def addlistener(self, listener):
         self._listeners.append(listener)
@@ -93,64 +107,77 @@ class Subscription(object):
         """Invoked by LSClient each time Lightstreamer Server pushes
         a new item event.
         """
-        # Tokenize the item line as sent by Lightstreamer
-        toks = item_line.rstrip("\r\n").split("|")
-        undecoded_item = dict(list(zip(self.field_names, toks[1:])))
-
-        # Retrieve the previous item stored into the map, if present.
-        # Otherwise create a new empty dict.
-        item_pos = int(toks[0])
-        curr_item = self._items_map.get(item_pos, {})
-        # Update the map with new values, merging with the
-        # previous ones if any.
-        self._items_map[item_pos] = dict(
-            [
-                (k, self._decode(v, curr_item.get(k)))
-                for k, v in list(undecoded_item.items())
-            ]
-        )
-        # Make an item info as a new event to be passed to listeners
-        item_info = {
-            "pos": item_pos,
-            "name": self.item_names[item_pos - 1],
-            "values": self._items_map[item_pos],
-        }
-
-        # Update each registered listener with new event
+        item_pos, _, line = item_line.partition("|")
+        item_pos = int(item_pos)
+        state = self._items_map.get(item_pos)
+        if state is None:
+            state = self._items_map[item_pos] = ItemState(item_pos, self.item_names[item_pos - 1],
+                                                          len(self.field_names))
+
+        # Decode the fields according to the Lightstreamer Text Protocol, an empty value is unchanged.
+        values = state.values
+        for i, value in enumerate(line.rstrip("\r\n").split("|")):
+            if not value:
+                continue
+            if value == "$":
+                values[i] = ""
+            elif value == "#":
+                values[i] = None
+            else:
+                if value[0] in "#$":
+                    value = value[1:]
+                converter = self._converters[i]
+                if converter is None:
+                    values[i] = value
+                else:
+                    try:
+                        values[i] = converter(value)
+                    except ValueError:
+                        log.warning("Invalid %s value for %s: %s", self.field_names[i], state.name, value)
+                        values[i] = None
+
+        update = ItemUpdate(item_pos, state.name, tuple(values))
         for on_item_update in self._listeners:
-            on_item_update(item_info)
+            on_item_update(update)
 
 
-# NGL this class is horrendous but I CBA to fix it.
-class LSClient(object):
-    """Manages the communication with Lightstreamer Server"""
+class LSClient:
+    """
+    Manages the communication with Lightstreamer Server on the event loop.
+
+    The stream connection is read by an asyncio task which dispatches updates straight to the Subscription
+    listeners, and control requests are made on the pooled aiohttp session without blocking the loop.
+    """
 
     def __init__(self, base_url, adapter_set="", user="", password=""):
-        self._base_url = parse_url(base_url)
+        self._base_url = base_url
+        self._control_url = base_url
         self._adapter_set = adapter_set
         self._user = user
         self._password = password
         self._session = {}
         self._subscriptions = {}
         self._current_subscription_key = 0
-        self._stream_connection = None
-        self._stream_connection_thread = None
+        self._stream_connection: Optional[aiohttp.ClientResponse] = None
+        self._receiver: Optional[asyncio.Task] = None
         self._bind_counter = 0
         self.content_length = 1000000000
 
+    @property
+    def connected(self) -> bool:
+        """Whether the session is open and its Stream Connection is being read."""
+        return self._receiver is not None and not self._receiver.done()
+
     def _encode_params(self, params):
         """Encode the parameter for HTTP POST submissions, but
         only for non empty values..."""
         return _url_encode(dict([(k, v) for (k, v) in _iteritems(params) if v]))
 
-    def _call(self, base_url, url, body):
-        """Open a network connection and performs HTTP Post
-        with provided body.
-        """
-        # Combines the "base_url" with the
-        # required "url" to be used for the specific request.
-        url = urljoin(base_url.geturl(), url)
-        return _urlopen(url, data=self._encode_params(body))
+    async def _call(self, base_url, url, body, timeout=None) -> aiohttp.ClientResponse:
+        """Perform an HTTP Post with provided body to url relative to base_url."""
+        url = urljoin(base_url, url)
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        return await get_session(url).post(url, data=self._encode_params(body), headers=FORM_HEADERS, **kwargs)
 
     def _set_control_link_url(self, custom_address=None):
         """Set the address to use for the Control Connection
@@ -159,34 +186,50 @@ class LSClient(object):
         if custom_address is None:
             self._control_url = self._base_url
         else:
-            parsed_custom_address = parse_url("//" + custom_address)
-            self._control_url = parsed_custom_address._replace(scheme=self._base_url[0])
+            self._control_url = f"{self._base_url.split('://', 1)[0]}://{custom_address}"
 
-    def _control(self, params):
-        """Create a Control Connection to send control commands
-        that manage the content of Stream Connection.
+    async def _control(self, params):
+        """
+        Send a control command that manages the content of the Stream Connection, returning the lines of the
+        response joined by spaces, e.g. OK or ERROR 17 Data item not found.
         """
         params["LS_session"] = self._session["SessionId"]
-        response = self._call(self._control_url, CONTROL_URL_PATH, params)
-        return response.readline().decode("utf-8").rstrip()
+        async with await self._call(self._control_url, CONTROL_URL_PATH, params) as response:
+            return " ".join(line.strip() for line in (await response.text()).splitlines() if line.strip())
 
-    def _read_from_stream(self):
-        """Read a single line of content of the Stream Connection."""
-        line = self._stream_connection.readline().decode("utf-8").rstrip()
-        return line
+    async def _read_from_stream(self) -> Optional[str]:
+        """Read a single line of content of the Stream Connection, None once it is closed."""
+        line = await self._stream_connection.content.readline()
+        if not line:
+            return None
+        return line.decode("utf-8").rstrip()
+
+    async def _open_stream(self, base_url, url, params):
+        """Open a Stream Connection and read the session information which starts it."""
+        self._stream_connection = await self._call(base_url, url, params, timeout=STREAM_TIMEOUT)
+        stream_line = await self._read_from_stream()
+        if stream_line != OK_CMD:
+            lines = await self._stream_connection.text()
+            self._stream_connection.close()
+            self._stream_connection = None
+            log.error("Server response error: \n%s\n%s", stream_line, lines)
+            raise IOError()
+
+        while next_stream_line := await self._read_from_stream():
+            session_key, session_value = next_stream_line.split(":", 1)
+            self._session[session_key] = session_value
 
-    def connect(self):
+    async def connect(self):
         """Establish a connection to Lightstreamer Server to create
         a new session.
         """
-
         if not notify and sys.platform.startswith('linux'):
             log.warning(
                 "systemd.daemon not available, "
                 "no watchdog notifications will be sent."
             )
 
-        self._stream_connection = self._call(
+        await self._open_stream(
             self._base_url,
             CONNECTION_URL_PATH,
             {
@@ -198,14 +241,15 @@ class LSClient(object):
                 "LS_content_length": self.content_length,
             },
         )
-        stream_line = self._read_from_stream()
-        self._handle_stream(stream_line)
+        self._set_control_link_url(self._session.get("ControlAddress"))
+        self._receiver = asyncio.create_task(self._receive())
 
-    def bind(self):
+    async def bind(self):
         """Replace a completely consumed connection in listening for an active
         Session.
         """
-        self._stream_connection = self._call(
+        self._stream_connection.close()
+        await self._open_stream(
             self._control_url,
             BIND_URL_PATH,
             {
@@ -213,104 +257,69 @@ class LSClient(object):
                 "LS_content_length": self.content_length,
             },
         )
-
         self._bind_counter += 1
-        stream_line = self._read_from_stream()
-        self._handle_stream(stream_line)
-
-    def _handle_stream(self, stream_line):
-        if stream_line == OK_CMD:
-            # Parsing session inkion
-            while 1:
-                next_stream_line = self._read_from_stream()
-                if next_stream_line:
-                    session_key, session_value = next_stream_line.split(":", 1)
-                    self._session[session_key] = session_value
-                else:
-                    break
-
-            # Setup of the control link url
-            self._set_control_link_url(self._session.get("ControlAddress"))
-
-            # Start a new thread to handle real time updates sent
-            # by Lightstreamer Server on the stream connection.
-            self._stream_connection_thread = threading.Thread(
-                name="STREAM-CONN-THREAD-{0}".format(self._bind_counter),
-                target=self._receive,
-            )
-            self._stream_connection_thread.setDaemon(True)
-            # Add "active connection" attribute to running thread
-            setattr(self._stream_connection_thread, "active_connection", True)
-            self._stream_connection_thread.start()
-        else:
-            lines = self._stream_connection.readlines()
-            lines.insert(0, stream_line)
-            log.error("Server response error: \n{0}".format("".join(lines)))
-            raise IOError()
 
-    def _join(self):
-        """Await the natural STREAM-CONN-THREAD termination."""
-        if self._stream_connection_thread:
-            log.debug("Waiting for thread to terminate")
-            self._stream_connection_thread.active_connection = False
-            self._stream_connection_thread.join()
-            self._stream_connection_thread = None
-            log.debug("Thread terminated")
-
-    def disconnect(self):
-        """Request to close the session previously opened with
-        the connect() invocation.
-        """
-        if self._stream_connection is not None:
-            # Exits stream thread loop, joins and exits stream thread, closes connection
-            self._join()
+    async def disconnect(self):
+        """Stop receiving updates and close the Stream Connection."""
+        if self._receiver is not None:
+            self._receiver.cancel()
+            try:
+                await self._receiver
+            except asyncio.CancelledError:
+                pass
+            self._receiver = None
             log.debug("Connection closed")
-            print("DISCONNECTED FROM LIGHTSTREAMER")
         else:
             log.warning("No connection to Lightstreamer")
 
-    def destroy(self):
+    async def wait_closed(self):
+        """Wait until the session ends, whether it was closed by the server, an error or disconnect()."""
+        if self._receiver is not None:
+            await asyncio.wait([self._receiver])
+
+    async def destroy(self):
         """Destroy the session previously opened with
         the connect() invocation.
         """
         if self._stream_connection is not None:
-            server_response = self._control({"LS_op": OP_DESTROY})
-            if server_response == OK_CMD:
-                # There is no need to explicitly close the connection,
-                # since it is handled by thread completion.
-                self._join()
-            else:
-                log.warning("No connection to Lightstreamer")
+            server_response = await self._control({"LS_op": OP_DESTROY})
+            if server_response != OK_CMD:
+                log.warning("Server error destroying session: %s", server_response)
+        await self.disconnect()
 
-    def subscribe(self, subscription):
-        """Perform a subscription request to Lightstreamer Server."""
+    async def subscribe(self, subscription):
+        """Perform a subscription request to Lightstreamer Server, raising IOError if it is rejected."""
         # Register the Subscription with a new subscription key
         self._current_subscription_key += 1
         self._subscriptions[self._current_subscription_key] = subscription
 
         # Send the control request to perform the subscription
-        server_response = self._control(
+        server_response = await self._control(
             {
                 "LS_Table": self._current_subscription_key,
                 "LS_op": OP_ADD,
                 "LS_data_adapter": subscription.adapter,
                 "LS_mode": subscription.mode,
+                "LS_snapshot": subscription.snapshot,
                 "LS_schema": " ".join(subscription.field_names),
                 "LS_id": " ".join(subscription.item_names),
             }
         )
-        log.debug("Server response ---> <{0}>".format(server_response))
+        log.debug("Server response ---> <%s>", server_response)
+        if server_response != OK_CMD:
+            del self._subscriptions[self._current_subscription_key]
+            raise IOError(f"Subscription of {' '.join(subscription.item_names)} rejected: {server_response}")
         return self._current_subscription_key
 
-    def unsubscribe(self, subcription_key):
+    async def unsubscribe(self, subcription_key):
         """Unregister the Subscription associated to the
         specified subscription_key.
         """
         if subcription_key in self._subscriptions:
-            server_response = self._control(
+            server_response = await self._control(
                 {"LS_Table": subcription_key, "LS_op": OP_DELETE}
             )
-            log.debug("Server response ---> <{0}>".format(server_response))
+            log.debug("Server response ---> <%s>", server_response)
 
             if server_response == OK_CMD:
                 del self._subscriptions[subcription_key]
@@ -318,13 +327,12 @@ class LSClient(object):
             else:
                 log.warning("Server error")
         else:
-            log.warning("No subscription key {0} found!".format(subcription_key))
+            log.warning("No subscription key %s found!", subcription_key)
 
     def _forward_update_message(self, update_message):
         """Forwards the real time update to the relative
         Subscription instance for further dispatching to its listeners.
         """
-        log.debug("Received update message ---> <{0}>".format(update_message))
         tok = update_message.split(",", 1)
         table, item = int(tok[0]), tok[1]
         if table in self._subscriptions:
@@ -332,86 +340,64 @@ class LSClient(object):
         else:
             log.warning("No subscription found!")
 
-    def _receive(self):
-        rebind = False
-        receive = True
-        while receive and self._stream_connection_thread.active_connection:
-            log.debug("Waiting for a new message")
-            try:
-                message = self._read_from_stream()
-                log.debug("Received message ---> <{0}>".format(message))
-            except Exception:
-                log.error("Communication error")
-                print(traceback.format_exc())
-                message = None
-
-            if notify:
-                notify("WATCHDOG=1")
-
-            if message is None:
-                receive = False
-                log.warning("No new message received")
-            elif message == PROBE_CMD:
-                # Skipping the PROBE message, keep on receiving messages.
-                log.debug("PROBE message")
-            elif message.startswith(ERROR_CMD):
-                # Terminate the receiving loop on ERROR message
-                receive = False
-                log.error("ERROR")
-            elif message.startswith(LOOP_CMD):
-                # Terminate the the receiving loop on LOOP message.
-                # A complete implementation should proceed with
-                # a rebind of the session.
-                log.debug("LOOP")
-                rebind = True
-                receive = False
-            elif message.startswith(SYNC_ERROR_CMD):
-                # Terminate the receiving loop on SYNC ERROR message.
-                # A complete implementation should create a new session
-                # and re-subscribe to all the old items and relative fields.
-                log.error("SYNC ERROR")
-                receive = False
-            elif message.startswith(END_CMD):
-                # Terminate the receiving loop on END message.
-                # The session has been forcibly closed on the server side.
-                # A complete implementation should handle the
-                # "cause_code" if present.
-                log.info("Connection closed by the server")
-                receive = False
-            elif message.startswith("Preamble"):
-                # Skipping Preamble message, keep on receiving messages.
-                log.debug("Preamble")
-            else:
-                self._forward_update_message(message)
-
-        if not rebind:
+    async def _receive(self):
+        """Read the Stream Connection until the session ends, rebinding it whenever the server asks to."""
+        try:
+            while True:
+                try:
+                    message = await self._read_from_stream()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    log.exception("Communication error")
+                    message = None
+
+                if notify:
+                    notify("WATCHDOG=1")
+
+                if message is None:
+                    log.warning("No new message received")
+                    break
+                if message == PROBE_CMD:
+                    # Skipping the PROBE message, keep on receiving messages.
+                    continue
+                if message.startswith(ERROR_CMD):
+                    log.error("ERROR")
+                    break
+                if message.startswith(LOOP_CMD):
+                    # The connection reached its content length, continue the session on a new one.
+                    log.debug("Binding to this active session")
+                    try:
+                        await self.bind()
+                    except (aiohttp.ClientError, asyncio.TimeoutError, IOError):
+                        log.exception("Failed to rebind session")
+                        break
+                elif message.startswith(SYNC_ERROR_CMD):
+                    log.error("SYNC ERROR")
+                    break
+                elif message.startswith(END_CMD):
+                    # The session has been forcibly closed on the server side.
+                    log.info("Connection closed by the server")
+                    break
+                elif message.startswith("Preamble"):
+                    # Skipping Preamble message, keep on receiving messages.
+                    continue
+                else:
+                    self._forward_update_message(message)
+        finally:
             log.debug("Closing connection")
             # Clear internal data structures for session
             # and subscriptions management.
-            self._stream_connection.close()
+            if self._stream_connection is not None:
+                self._stream_connection.close()
             self._stream_connection = None
             self._session.clear()
             self._subscriptions.clear()
             self._current_subscription_key = 0
-        else:
-            log.debug("Binding to this active session")
-            self._stream_connection = None
-            self.bind()
 
 
-def async_adapter():
+def async_adapter(queue: Optional[BatchQueue] = None):
     """
-    Wraps the non-async lightstreamer class with async queues.
+    Adapts Subscription listener callbacks to an async iterator through a bounded BatchQueue.
     :return: Async Iterator, Callable
     """
-    loop = asyncio.get_event_loop()
-    queue = asyncio.Queue()
-
-    def put(*args):
-        loop.call_soon_threadsafe(queue.put_nowait, *args)
-
-    async def get():
-        while True:
-            yield await queue.get()
-
-    return get(), put
+    queue = queue or BatchQueue(policy='drop_oldest')
+    return queue.items(), queue.put_nowait
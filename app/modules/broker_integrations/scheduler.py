@@ -0,0 +1,137 @@
+"""
+Module contains a rate limiting request scheduler shared by the requests of a broker account.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+from app.modules.utils import backoff_delay
+
+# Priority lanes, requests in a lower lane are always sent first.
+TRADING = 0
+ACCOUNT = 1
+MARKET_DATA = 2
+LANES = {TRADING: 'trading', ACCOUNT: 'account', MARKET_DATA: 'market_data'}
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, in bursts of up to capacity requests."""
+    waiting: List[Tuple[int, int, asyncio.Future]]
+
+    def __init__(self, rate: float, capacity: int):
+        """Create a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.waiting = []  # Heap of (lane, sequence, future) of the requests waiting for a token.
+        self.pump: Optional[asyncio.Task] = None
+
+    def delay(self) -> float:
+        """Seconds until a token is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        """Use a token."""
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """
+    Meters the requests of a broker account through token buckets, one per endpoint class.
+
+    A request takes a token from every bucket it is classified in, and while it waits for one, requests from lower
+    priority lanes are queued behind it. Requests failing with a 429 status, or a 5xx status when they are
+    idempotent, are retried with jittered exponential backoff.
+    """
+    buckets: Dict[str, TokenBucket]
+
+    def __init__(self, buckets: Dict[str, Tuple[float, int]], errors: Tuple[Type[Exception], ...] = (),
+                 retries: int = 3, backoff: float = 0.5):
+        """
+        Create a bucket for each (rate per second, burst capacity) in buckets.
+
+        errors are the exception types which carry the HTTP status_code of a failed request.
+        """
+        self.buckets = {name: TokenBucket(rate, capacity) for name, (rate, capacity) in buckets.items()}
+        self.errors = errors
+        self.retries = retries
+        self.backoff = backoff
+        self.sequence = itertools.count()
+        self.queued = {lane: 0 for lane in LANES}
+        self.waits = {lane: [0, 0.0, 0.0] for lane in LANES}  # Requests, total and longest wait in seconds.
+
+    async def _acquire(self, lane: int, name: str):
+        """Wait for a token from a bucket, behind the waiting requests of the same or a higher priority lane."""
+        bucket = self.buckets[name]
+        if not bucket.waiting and bucket.delay() == 0:
+            bucket.take()
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(bucket.waiting, (lane, next(self.sequence), future))
+        if bucket.pump is None or bucket.pump.done():
+            bucket.pump = asyncio.create_task(self._pump(bucket))
+        await future
+
+    @staticmethod
+    async def _pump(bucket: TokenBucket):
+        """Hand out tokens to the waiting requests in priority order as the bucket refills."""
+        while bucket.waiting:
+            delay = bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, future = heapq.heappop(bucket.waiting)
+            if not future.done():  # Cancelled requests do not use a token.
+                bucket.take()
+                future.set_result(None)
+
+    async def submit(self, request: Callable[[], Awaitable], lane: int, buckets: Sequence[str],
+                     idempotent: bool = True):
+        """Send request once it has a token from each of buckets, retrying it if it was rate limited or failed."""
+        for attempt in range(self.retries + 1):
+            queued = time.monotonic()
+            self.queued[lane] += 1
+            try:
+                for name in buckets:
+                    await self._acquire(lane, name)
+            finally:
+                self.queued[lane] -= 1
+
+            wait = time.monotonic() - queued
+            waits = self.waits[lane]
+            waits[0] += 1
+            waits[1] += wait
+            waits[2] = max(waits[2], wait)
+
+            try:
+                return await request()
+            except self.errors as e:
+                status = getattr(e, 'status_code', 0)
+                retry = status == 429 or (status >= 500 and idempotent)
+                if not retry or attempt == self.retries:
+                    raise
+            await asyncio.sleep(backoff_delay(attempt, self.backoff))
+
+    def stats(self) -> dict:
+        """Queue depths and wait times of each lane, and the state of each bucket."""
+        return {
+            'lanes': {name: {
+                'queued': self.queued[lane],
+                'requests': self.waits[lane][0],
+                'mean_wait': self.waits[lane][1] / self.waits[lane][0] if self.waits[lane][0] else 0.0,
+                'max_wait': self.waits[lane][2],
+            } for lane, name in LANES.items()},
+            'buckets': {name: {
+                'tokens': bucket.tokens,
+                'waiting': len(bucket.waiting),
+            } for name, bucket in self.buckets.items()},
+        }
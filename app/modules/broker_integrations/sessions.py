@@ -0,0 +1,68 @@
+"""
+Module contains the long-lived, pooled aiohttp sessions shared by every broker integration.
+"""
+
+import asyncio
+import logging
+from typing import Dict, Set, Tuple
+
+import aiohttp
+from yarl import URL
+
+log = logging.getLogger('BrokerSessions')
+
+LIMIT_PER_HOST = 16  # Concurrent connections to a single broker host.
+DNS_CACHE_TTL = 300  # Seconds a resolved broker address is reused.
+KEEPALIVE_TIMEOUT = 120  # Seconds an idle connection is kept in the pool.
+KEEP_WARM_INTERVAL = 30  # Seconds between requests keeping an idle connection open.
+
+_sessions: Dict[Tuple[str, asyncio.AbstractEventLoop], aiohttp.ClientSession] = {}
+_warmers: Set[asyncio.Task] = set()
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    """
+    Return the pooled session of the running event loop for the host of url, creating it on first use.
+
+    Connections are kept alive and reused between requests, so only the first request to a host pays for the
+    TCP and TLS handshakes.
+    """
+    loop = asyncio.get_running_loop()
+    key = (str(URL(url).origin()), loop)
+    session = _sessions.get(key)
+    if session is None or session.closed:
+        # Sessions of event loops which have been closed (e.g. by tests) can no longer be used or closed.
+        for stale in [stale for stale in _sessions if stale[1].is_closed()]:
+            del _sessions[stale]
+        connector = aiohttp.TCPConnector(limit_per_host=LIMIT_PER_HOST, ttl_dns_cache=DNS_CACHE_TTL,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        session = _sessions[key] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+async def keep_warm(url: str, interval: float = KEEP_WARM_INTERVAL):
+    """Make a HEAD request to url every interval seconds, so a connection to its host is always open."""
+    while True:
+        try:
+            async with get_session(url).head(url) as resp:
+                await resp.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning('Failed to keep connection to %s warm: %s', url, e)
+        await asyncio.sleep(interval)
+
+
+def start_keep_warm(url: str, interval: float = KEEP_WARM_INTERVAL):
+    """Run keep_warm for url in the background until close_sessions is called."""
+    task = asyncio.create_task(keep_warm(url, interval))
+    _warmers.add(task)
+    task.add_done_callback(_warmers.discard)
+
+
+async def close_sessions():
+    """Stop keeping connections warm and close every session of the running event loop."""
+    for task in list(_warmers):
+        task.cancel()
+
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _sessions if key[1] is loop]:
+        await _sessions.pop(key).close()
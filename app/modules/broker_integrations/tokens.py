@@ -0,0 +1,88 @@
+"""
+Module contains a holder for broker access tokens which coalesces logins and renews tokens in the background.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from app.modules.utils import backoff_delay
+
+log = logging.getLogger('TokenManager')
+
+
+class TokenManager:
+    """
+    Holds the access token of a broker account.
+
+    Concurrent callers needing a new token all await a single acquisition, and once a token is held it is renewed
+    in the background margin seconds before its ttl ends, so requests do not wait for authentication.
+    """
+
+    def __init__(self, acquire: Callable[[], Awaitable[Any]], ttl: float, margin: float = 10):
+        """Initialise without a token, acquire is called to log in or refresh and returns the new token."""
+        self.acquire = acquire
+        self.ttl = ttl
+        self.margin = margin
+        self.token = None
+        self.expires = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self._renewal: Optional[asyncio.Task] = None
+
+    @property
+    def valid(self) -> bool:
+        """Whether a token is held and has not expired."""
+        return self.token is not None and time.monotonic() < self.expires
+
+    async def get(self):
+        """Return the current token, acquiring a new one if it expired."""
+        if self.valid:
+            return self.token
+        return await self.refresh()
+
+    async def refresh(self):
+        """Acquire a new token, joining the acquisition already in flight if there is one."""
+        loop = asyncio.get_running_loop()
+        if self._inflight is None or self._inflight.get_loop() is not loop:
+            self._inflight = loop.create_task(self._acquire())
+        # A cancelled caller must not cancel the acquisition the other callers are waiting for.
+        return await asyncio.shield(self._inflight)
+
+    async def _acquire(self):
+        """Acquire a token and schedule its renewal."""
+        try:
+            token = await self.acquire()
+        finally:
+            self._inflight = None
+        self.token = token
+        self.expires = time.monotonic() + self.ttl
+        if self._renewal is None or self._renewal.done() or self._renewal.get_loop() is not asyncio.get_running_loop():
+            self._renewal = asyncio.create_task(self._renew())
+        return token
+
+    async def _renew(self):
+        """Renew the token shortly before it expires, retrying with backoff while it is still valid."""
+        attempt = 0
+        while True:
+            await asyncio.sleep(max(0.0, self.expires - self.margin - time.monotonic()))
+            try:
+                await self.refresh()
+                attempt = 0
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Failed to renew access token')
+                await asyncio.sleep(backoff_delay(attempt, cap=self.margin / 2))
+                attempt += 1
+
+    def stop(self):
+        """Stop renewing the token in the background."""
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+
+
+def stop_token_managers(*registries: Dict[Hashable, TokenManager]):
+    """Stop renewing the tokens of every TokenManager in registries, e.g. the tokens of each integration on shutdown."""
+    for registry in registries:
+        for manager in registry.values():
+            manager.stop()
@@ -0,0 +1,94 @@
+"""
+Module contains a persistent index of the time intervals of historical data already held locally.
+"""
+
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from app.modules.parquet_dataset import partition_lock
+
+
+class CoverageIndex:
+    """
+    Persistent record of the half-open [start, end) epoch-ns intervals stored per (epic, resolution).
+
+    Intervals are kept sorted and merged, and the index is saved to a JSON file on every change. The file is
+    reloaded whenever another process has changed it, and changes are made under an exclusive partition_lock of its
+    folder so processes adding intervals at the same time (e.g. a backfill and the server) do not lose any.
+    """
+    intervals: Dict[str, List[List[int]]]
+
+    def __init__(self, path):
+        """Load the index stored at path, if it exists."""
+        self.path = Path(path)
+        self.intervals = {}
+        self._mtime = None
+        self._reload()
+
+    @staticmethod
+    def _key(epic: str, resolution: str) -> str:
+        return f'{epic}|{resolution}'
+
+    def _reload(self, force: bool = False):
+        """Read the index from disk if it changed since it was last read or written, or always when forced."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if force or mtime != self._mtime:
+            with open(self.path, 'r', encoding='UTF-8') as file:
+                self.intervals = json.load(file)
+            self._mtime = mtime
+
+    def _save(self):
+        """Write the index to disk atomically."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'.{self.path.name}.{uuid.uuid4().hex[:8]}.tmp')
+        with open(tmp_path, 'w', encoding='UTF-8') as file:
+            json.dump(self.intervals, file)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def covered(self, epic: str, resolution: str) -> List[Tuple[int, int]]:
+        """Return the sorted, non-overlapping intervals held for an epic and resolution."""
+        self._reload()
+        return list(map(tuple, self.intervals.get(self._key(epic, resolution), [])))
+
+    def missing(self, epic: str, resolution: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """Return the sub-intervals of [start, end) which are not held for an epic and resolution."""
+        gaps = []
+        cursor = start
+        for covered_start, covered_end in self.covered(epic, resolution):
+            if covered_end <= cursor:
+                continue
+            if covered_start >= end:
+                break
+            if covered_start > cursor:
+                gaps.append((cursor, covered_start))
+            cursor = covered_end
+
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def add(self, epic: str, resolution: str, start: int, end: int):
+        """Record that [start, end) is held for an epic and resolution, merging it with adjacent intervals."""
+        if end <= start:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with partition_lock(self.path.parent, exclusive=True):
+            self._reload(force=True)  # The modification time may not show a change made within its resolution.
+            merged = []
+            intervals = self.intervals.get(self._key(epic, resolution), [])
+            for interval_start, interval_end in sorted([*map(tuple, intervals), (start, end)]):
+                if merged and interval_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], interval_end)
+                else:
+                    merged.append([interval_start, interval_end])
+
+            self.intervals[self._key(epic, resolution)] = merged
+            self._save()
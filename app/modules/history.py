@@ -0,0 +1,233 @@
+"""
+Module contains functions for querying historical prices from the PriceStore parquet dataset.
+"""
+
+import io
+import os
+from datetime import datetime, timezone
+from itertools import groupby
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+
+from app.modules.parquet_dataset import partition_lock, select_files
+from app.modules.price_store import TICK_SCHEMA, PriceStore
+
+# Pandas resample rules for each bar resolution.
+RESOLUTIONS = {
+    'SECOND': '1s',
+    'MINUTE': '1min',
+    'MINUTE_5': '5min',
+    'MINUTE_15': '15min',
+    'HOUR': '1h',
+    'DAY': '1D',
+}
+TICK_COLUMNS = ['bid', 'ask', 'volume']
+BAR_COLUMNS = ['open_bid', 'high_bid', 'low_bid', 'close_bid', 'open_ask', 'high_ask', 'low_ask', 'close_ask',
+               'volume']
+IPC_END_OF_STREAM = b'\xff\xff\xff\xff\x00\x00\x00\x00'
+
+
+def datetime_to_ns(value: datetime) -> int:
+    """Convert a datetime to epoch-ns, naive values are treated as UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return round(value.timestamp() * 1e6) * 1000
+
+
+def resolve_columns(resolution: str, columns: Optional[List[str]]) -> List[str]:
+    """Validate the requested columns for a resolution, defaulting to every column."""
+    available = TICK_COLUMNS if resolution == 'TICK' else BAR_COLUMNS
+    if not columns:
+        return list(available)
+
+    unknown = [column for column in columns if column not in available]
+    if unknown:
+        raise ValueError(f'Unknown columns for {resolution} resolution: {", ".join(unknown)}')
+    return [column for column in available if column in columns]
+
+
+def history_schema(resolution: str, columns: List[str]) -> pa.Schema:
+    """Arrow schema of the history returned for a resolution and list of columns."""
+    fields = [TICK_SCHEMA.field('time_stamp')]
+    for column in columns:
+        if resolution == 'TICK':
+            fields.append(TICK_SCHEMA.field(column))
+        else:
+            fields.append(pa.field(column, pa.int64() if column == 'volume' else pa.float64()))
+    return pa.schema(fields)
+
+
+def tick_columns(resolution: str, columns: List[str]) -> List[str]:
+    """Tick columns which have to be read from disk to produce the requested columns."""
+    if resolution == 'TICK':
+        return columns
+
+    sides = [side for side in ('bid', 'ask') if any(column.endswith(f'_{side}') for column in columns)]
+    return sides or ['bid']  # Volume is the tick count, which needs at least one column.
+
+
+def scan_ticks(files: List[str], start_ns: int, end_ns: int, columns: List[str]) -> ds.Scanner:
+    """
+    Build a scanner over the ticks in files between start_ns and end_ns (inclusive).
+
+    The time filter is pushed down to skip row groups using their statistics and only time_stamp and columns
+    are decoded.
+    """
+    time_type = TICK_SCHEMA.field('time_stamp').type
+    time_stamp = ds.field('time_stamp')
+    return ds.dataset(files, schema=TICK_SCHEMA, format='parquet').scanner(
+        columns=['time_stamp', *columns],
+        filter=(time_stamp >= pa.scalar(start_ns, type=time_type)) & (time_stamp <= pa.scalar(end_ns, type=time_type)),
+    )
+
+
+def iter_ticks(store: PriceStore, epic: str, start_ns: int, end_ns: int,
+               columns: List[str]) -> Iterator[pa.RecordBatch]:
+    """
+    Yield time-ordered batches of the ticks of an epic between start_ns and end_ns, one partition at a time.
+
+    Only the partitions overlapping the range are opened. Single-file (compacted) partitions are already time-ordered,
+    partitions still made of several flushes are sorted. Each partition is listed again and read into memory under
+    its partition_lock, so it cannot be compacted in the meantime, and the lock is released before its batches are
+    yielded so a slow consumer does not hold back compaction.
+    """
+    for directory, _ in groupby(store.get_price_files(epic, start_ns, end_ns), key=os.path.dirname):
+        with partition_lock(Path(directory)):
+            files = [str(path) for path in select_files(Path(directory).glob('*.parquet'), start_ns, end_ns)]
+            if not files:
+                continue
+            table = scan_ticks(files, start_ns, end_ns, columns).to_table()
+            if len(files) > 1:
+                table = table.sort_by('time_stamp')
+        yield from (batch for batch in table.to_batches() if batch.num_rows > 0)
+
+
+def resample_ticks(ticks: pd.DataFrame, resolution: str) -> pd.DataFrame:
+    """Aggregate time-sorted ticks into bid/ask OHLC bars, volume is the number of ticks in each bar."""
+    grouped = ticks.set_index('time_stamp').resample(RESOLUTIONS[resolution])
+    bars = pd.DataFrame({'volume': grouped.size()})
+    for side in ('bid', 'ask'):
+        if side in ticks:
+            ohlc = grouped[side].ohlc()
+            for field in ohlc.columns:
+                bars[f'{field}_{side}'] = ohlc[field]
+
+    return bars[bars['volume'] > 0]
+
+
+def merge_bars(first: pd.DataFrame, second: pd.DataFrame) -> pd.DataFrame:
+    """Merge two single-row frames of partial bars for the same period into one bar."""
+    merged = first.copy()
+    for column in merged.columns:
+        if column.startswith('high_'):
+            merged[column] = max(first[column].iloc[0], second[column].iloc[0])
+        elif column.startswith('low_'):
+            merged[column] = min(first[column].iloc[0], second[column].iloc[0])
+        elif column.startswith('close_'):
+            merged[column] = second[column].iloc[0]
+        elif column == 'volume':
+            merged[column] = first[column].iloc[0] + second[column].iloc[0]
+    return merged
+
+
+def iter_bars(batches: Iterable[pa.RecordBatch], resolution: str, columns: List[str]) -> Iterator[pa.RecordBatch]:
+    """
+    Aggregate time-ordered tick batches into batches of bars.
+
+    The last bar of each batch may continue into the next one, so it is carried over and merged rather than
+    emitted, which keeps memory bounded by the batch size rather than the bar length.
+    """
+    schema = history_schema(resolution, columns)
+    carry = None
+    for batch in batches:
+        bars = resample_ticks(batch.to_pandas(), resolution)
+        if carry is not None:
+            if bars.index[0] == carry.index[0]:
+                bars = pd.concat([merge_bars(carry, bars.iloc[:1]), bars.iloc[1:]])
+            else:
+                bars = pd.concat([carry, bars])
+
+        carry = bars.iloc[-1:]
+        if len(bars) > 1:
+            yield pa.RecordBatch.from_pandas(bars.iloc[:-1][columns].reset_index(), schema=schema,
+                                             preserve_index=False)
+
+    if carry is not None:
+        yield pa.RecordBatch.from_pandas(carry[columns].reset_index(), schema=schema, preserve_index=False)
+
+
+def iter_history(store: PriceStore, epic: str, start: datetime, end: datetime, resolution: str = 'TICK',
+                 columns: Optional[List[str]] = None) -> Iterator[pa.RecordBatch]:
+    """Yield batches of ticks or bars for an epic between start and end from the local store."""
+    columns = resolve_columns(resolution, columns)
+    ticks = iter_ticks(store, epic, datetime_to_ns(start), datetime_to_ns(end), tick_columns(resolution, columns))
+    if resolution == 'TICK':
+        return ticks
+
+    return iter_bars(ticks, resolution, columns)
+
+
+def read_history(store: PriceStore, epic: str, start: datetime, end: datetime, resolution: str = 'TICK',
+                 columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read ticks or bars for an epic between start and end from the local store into memory."""
+    columns = resolve_columns(resolution, columns)
+    batches = list(iter_history(store, epic, start, end, resolution, columns))
+    return pa.Table.from_batches(batches, schema=history_schema(resolution, columns)).to_pandas()
+
+
+def encode_arrow(batches: Iterable[pa.RecordBatch], schema: pa.Schema) -> Iterator[bytes]:
+    """Encode batches as an Arrow IPC stream, one message per batch."""
+    yield schema.serialize().to_pybytes()
+    for batch in batches:
+        yield batch.serialize().to_pybytes()
+    yield IPC_END_OF_STREAM
+
+
+def nan_to_null(column: pa.Array) -> pa.Array:
+    """Replace the NaN values of a floating point column by nulls, other columns are returned as they are."""
+    if pa.types.is_floating(column.type):
+        return pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+    return column
+
+
+def json_values(column: pa.Array) -> pa.Array:
+    """Format a numeric or timestamp column as JSON values, NaN and missing values become null."""
+    if pa.types.is_timestamp(column.type):
+        return pc.binary_join_element_wise('"', pc.strftime(column, format='%Y-%m-%dT%H:%M:%S'), 'Z"', '')
+    return pc.cast(nan_to_null(column), pa.string()).fill_null('null')
+
+
+def encode_ndjson(batches: Iterable[pa.RecordBatch], schema: pa.Schema) -> Iterator[bytes]:
+    """Encode batches as newline delimited JSON, one object per row, formatting whole columns at a time."""
+    keys = [('{' if i == 0 else ',') + f'"{name}":' for i, name in enumerate(schema.names)]
+    for batch in batches:
+        parts = [part for key, column in zip(keys, batch.columns) for part in (key, json_values(column))]
+        lines = pc.binary_join_element_wise(*parts, '}\n', '')
+        _, offsets, data = lines.buffers()
+        start, end = np.frombuffer(offsets, dtype=np.int32)[[lines.offset, lines.offset + len(lines)]]
+        yield data[start:end].to_pybytes()
+
+
+def encode_csv(batches: Iterable[pa.RecordBatch], schema: pa.Schema) -> Iterator[bytes]:
+    """Encode batches as CSV with a single header row, NaN and missing values are empty fields."""
+    yield ','.join(schema.names).encode() + b'\n'
+    for batch in batches:
+        buffer = io.BytesIO()
+        batch = pa.RecordBatch.from_arrays([nan_to_null(column) for column in batch.columns], schema=batch.schema)
+        pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+        yield buffer.getvalue()
+
+
+# Streaming encoders by media type.
+STREAM_FORMATS = {
+    'application/vnd.apache.arrow.stream': encode_arrow,
+    'application/x-ndjson': encode_ndjson,
+    'text/csv': encode_csv,
+}
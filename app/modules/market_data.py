@@ -0,0 +1,218 @@
+"""
+Module contains the market data hub, running the broker streams and feeding their ticks to every sink.
+"""
+
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from app.modules.bars import BarAggregator
+from app.modules.broker_integrations.base_integration import RECONNECT_BACKOFF, RECONNECT_CAP, Tick
+from app.modules.price_store import PriceStore
+from app.modules.pub_sub import Publisher
+from app.modules.queues import BatchQueue
+from app.modules.shards import ShardedStream, broker_stream
+from app.modules.utils import backoff_delay
+
+log = logging.getLogger('MarketDataHub')
+
+SINK_QUEUE_SIZE = 100_000  # Ticks held for a slow sink before the overflow policy applies.
+
+Handler = Callable[[List[Tick]], Awaitable[None]]
+
+
+def tick_topic(epic: str) -> str:
+    """Publisher topic carrying the ticks of an epic."""
+    return f'tick:{epic}'
+
+
+class Sink:
+    """
+    A consumer of ticks, fed batches of ticks from its own bounded queue.
+
+    The ticks queued for a durable sink (e.g. persisting them) are handled before the hub stops, and ticks dropped
+    by its overflow policy are logged.
+    """
+
+    def __init__(self, name: str, handler: Handler, queue: BatchQueue, durable: bool = False):
+        self.name = name
+        self.handler = handler
+        self.queue = queue
+        self.durable = durable
+        self.ticks = 0
+        self.errors = 0
+        self.logged_drops = 0
+
+    async def drain(self):
+        """
+        Pass every batch of queued ticks to the handler, logging its errors so the sink keeps running, until a None
+        ends the queue.
+        """
+        async for batch in self.queue.batches():
+            end = batch[-1] is None
+            if end:
+                batch.pop()
+            if batch:
+                try:
+                    await self.handler(batch)
+                except Exception:  # pylint: disable=broad-except
+                    self.errors += 1
+                    log.exception('Sink %s failed to handle %d ticks', self.name, len(batch))
+                self.ticks += len(batch)
+            if self.durable and self.queue.dropped > self.logged_drops:
+                log.warning('Sink %s dropped %d ticks it could not keep up with', self.name,
+                            self.queue.dropped - self.logged_drops)
+                self.logged_drops = self.queue.dropped
+            if end:
+                return
+
+
+class MarketDataHub:
+    """
+    Runs the price streams of the brokers and puts every tick in the queue of every sink.
+
+    Each sink drains its own queue, so a slow sink only fills its queue (whose overflow policy then applies)
+    without delaying the streams or the other sinks. Ticks are shared by the sinks, which must not modify them.
+    """
+    streams: Dict[str, Callable[[], AsyncIterator[Tick]]]
+
+    def __init__(self):
+        """Create a hub without streams or sinks."""
+        self.streams = {}
+        self.sinks: List[Sink] = []
+        self.received: Dict[str, int] = {}
+        self.background: List[Callable[[], Awaitable]] = []
+        self.tasks: List[asyncio.Task] = []  # Drainers of the sinks, background tasks, then streams.
+
+    def add_stream(self, name: str, stream: Callable[[List[str]], AsyncIterator[Tick]], epics: List[str]):
+        """Add a broker stream, e.g. IGIntegration.stream, of epics."""
+        self.streams[name] = lambda: stream(epics)
+        self.received[name] = 0
+
+    def add_sink(self, name: str, handler: Handler, maxsize: int = SINK_QUEUE_SIZE, policy: str = 'drop_oldest',
+                 key=None, durable: bool = False) -> Sink:
+        """
+        Add a sink whose handler is awaited with batches of ticks, queued with a BatchQueue overflow policy. The ticks
+        queued for a durable sink are handled before the hub stops.
+        """
+        sink = Sink(name, handler, BatchQueue(maxsize, policy, key), durable)
+        self.sinks.append(sink)
+        return sink
+
+    def add_task(self, task: Callable[[], Awaitable]):
+        """Add a coroutine function to run in the background while the hub runs, e.g. closing expired bars."""
+        self.background.append(task)
+
+    def dispatch(self, tick: Tick):
+        """Put a tick in the queue of every sink."""
+        for sink in self.sinks:
+            sink.queue.put_nowait(tick)
+
+    async def run_stream(self, name: str):
+        """Dispatch the ticks of a stream, restarting it with backoff whenever it fails or ends."""
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async for tick in self.streams[name]():
+                    self.received[name] += 1
+                    self.dispatch(tick)
+                log.warning('%s stream ended', name)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('%s stream failed', name)
+            if time.monotonic() - started > RECONNECT_CAP:
+                attempt = 0
+            await asyncio.sleep(backoff_delay(attempt, RECONNECT_BACKOFF, RECONNECT_CAP))
+            attempt += 1
+
+    def start(self):
+        """Start draining the sinks, the background tasks and the streams."""
+        self.tasks += [asyncio.create_task(sink.drain()) for sink in self.sinks]
+        self.tasks += [asyncio.create_task(task()) for task in self.background]
+        self.tasks += [asyncio.create_task(self.run_stream(name)) for name in self.streams]
+
+    async def stop(self):
+        """
+        Stop the streams, then let the durable sinks handle the ticks still queued for them before stopping the other
+        sinks and the background tasks, whose queued ticks are discarded.
+        """
+        streams = self.tasks[-len(self.streams):] if self.streams else []
+        for task in streams:
+            task.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
+
+        drainers = [task for sink, task in zip(self.sinks, self.tasks) if sink.durable]
+        for sink in self.sinks:
+            if sink.durable:
+                await sink.queue.put(None)
+        await asyncio.gather(*drainers, return_exceptions=True)
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        """Ticks received from each stream, and the ticks handled, errors and queue of each sink."""
+        return {
+            'streams': dict(self.received),
+            'sinks': {sink.name: {'ticks': sink.ticks, 'errors': sink.errors, **sink.queue.stats()}
+                      for sink in self.sinks},
+        }
+
+
+def store_sink(store: PriceStore) -> Handler:
+    """Sink handler accumulating ticks in a PriceStore."""
+    async def handle(ticks: List[Tick]):
+        store.store_ticks(ticks)
+    return handle
+
+
+def publisher_sink(publisher: Publisher) -> Handler:
+    """Sink handler broadcasting each tick on the tick_topic of its epic, serialised once per subscriber encoding."""
+    async def handle(ticks: List[Tick]):
+        for tick in ticks:
+            await publisher.broadcast(tick_topic(tick.epic), tick)
+    return handle
+
+
+def aggregator_sink(aggregator: BarAggregator) -> Handler:
+    """Sink handler aggregating ticks into bars."""
+    async def handle(ticks: List[Tick]):
+        for tick in ticks:
+            await aggregator.on_tick(tick.epic, tick.time_stamp, tick.bid, tick.ask)
+    return handle
+
+
+def create_hub(config: dict, integrations: dict, publisher: Optional[Publisher] = None,
+               store: Optional[PriceStore] = None) -> MarketDataHub:
+    """
+    Create a hub streaming the epics of each broker in the 'epics' section of config with integrations.
+
+    Brokers with more than one shard in the 'shards' section stream their epics in that many worker processes, each
+    with its own broker connection made with the 'credentials' section.
+
+    Ticks are stored in store and published by publisher when they are given, and aggregated into bars which are
+    published and stored as well. More sinks (e.g. marking positions) can be added before the hub is started.
+    """
+    hub = MarketDataHub()
+    shards = config.get('shards') or {}
+    for broker, epics in (config.get('epics') or {}).items():
+        if not epics or broker not in integrations:
+            continue
+        if shards.get(broker, 1) > 1:
+            hub.add_stream(broker, ShardedStream(partial(broker_stream, broker, config), shards[broker]).stream, epics)
+        else:
+            hub.add_stream(broker, integrations[broker].stream, epics)
+    if store is not None:
+        hub.add_sink('store', store_sink(store), durable=True)
+    if publisher is not None:
+        # Subscribers only need the latest price of each epic when they fall behind.
+        hub.add_sink('publisher', publisher_sink(publisher), policy='conflate', key=lambda tick: tick.epic_id)
+    if store is not None or publisher is not None:
+        aggregator = BarAggregator(publisher, store)
+        hub.add_sink('bars', aggregator_sink(aggregator), durable=True)
+        hub.add_task(aggregator.close_periodically)
+    return hub
@@ -0,0 +1,177 @@
+"""
+Module contains functions for writing, listing and compacting time-partitioned parquet datasets.
+
+Datasets are laid out Hive-style, e.g. ``ticks/epic=TSLA/date=2023-10-17/hour=09/part-<min>-<max>-<id>.parquet``.
+The minimum and maximum time stamp of every file are kept in its name, so range reads can skip files without
+opening them, and rows are sorted by time so the parquet row group statistics are tight.
+
+Readers hold a shared partition_lock on each partition while listing and reading its files, and compaction holds
+it exclusively, so a reader never sees a compacted file next to its inputs nor loses files it listed.
+"""
+
+import fcntl
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+TIME_COLUMN = 'time_stamp'
+LOCK_FILE = '.lock'  # Hidden, so ignored by dataset discovery.
+
+
+class TimePartitioning:
+    """Maps epoch-ns time stamps to Hive-style partition directories of a calendar period."""
+    formats = {
+        'h': lambda period: f'date={np.datetime_as_string(period, unit="D")}/hour={str(period)[-2:]}',
+        'D': lambda period: f'date={period}',
+        'M': lambda period: f'month={period}',
+        'Y': lambda period: f'year={period}',
+    }
+
+    def __init__(self, unit: str):
+        """Create a partitioning by hour (h), day (D), month (M) or year (Y)."""
+        if unit not in self.formats:
+            raise ValueError(f'Unsupported partition unit: {unit}')
+        self.unit = unit
+        self.depth = 2 if unit == 'h' else 1
+
+    def periods(self, time_stamps: np.ndarray) -> np.ndarray:
+        """Floor epoch-ns time stamps to the start of their partition period."""
+        return time_stamps.astype('datetime64[ns]').astype(f'datetime64[{self.unit}]')
+
+    def path(self, period: np.datetime64) -> str:
+        """Relative directory of the partition for a period."""
+        return self.formats[self.unit](period)
+
+    def paths(self, start_ns: int, end_ns: int) -> List[str]:
+        """Relative directories of every partition overlapping [start_ns, end_ns]."""
+        first, last = self.periods(np.array([start_ns, end_ns], dtype=np.int64))
+        return [self.path(period) for period in np.arange(first, last + 1)]
+
+    def end_ns(self, directory: Path) -> int:
+        """Epoch-ns time stamp at which the partition in directory closes."""
+        values = [part.split('=', 1)[1] for part in directory.parts[-self.depth:]]
+        start = np.datetime64('T'.join(values), self.unit)
+        return int((start + 1).astype('datetime64[ns]').astype(np.int64))
+
+
+def file_time_range(path: Path) -> Tuple[int, int]:
+    """Return the (min, max) time stamp of a dataset file from its name."""
+    _, min_ns, max_ns, _ = path.stem.split('-', 3)
+    return int(min_ns), int(max_ns)
+
+
+def _write_file(directory: Path, table: pa.Table, prefix: str, row_group_size: Optional[int] = None) -> Path:
+    """Write a time-sorted table to a new file in directory via a hidden temporary file and an atomic rename."""
+    time_stamps = table.column(TIME_COLUMN)
+    min_ns, max_ns = time_stamps[0].value, time_stamps[-1].value
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{prefix}-{min_ns}-{max_ns}-{uuid.uuid4().hex[:8]}.parquet'
+    tmp_path = directory / f'.{path.name}.tmp'  # Hidden files are ignored by dataset discovery.
+    try:
+        pq.write_table(table, tmp_path, row_group_size=row_group_size or max(len(table), 1))
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    return path
+
+
+def write_partitioned(root: Path, table: pa.Table, partitioning: TimePartitioning) -> List[Path]:
+    """
+    Sort a table by time and write it as one single-row-group file per partition it spans.
+
+    The cost is proportional to the size of table, existing files are never read or rewritten.
+    """
+    if len(table) == 0:
+        return []
+
+    table = table.sort_by(TIME_COLUMN)
+    time_stamps = table.column(TIME_COLUMN).cast(pa.int64()).to_numpy()
+    periods = partitioning.periods(time_stamps)
+    bounds = [0, *(np.flatnonzero(periods[1:] != periods[:-1]) + 1), len(table)]
+
+    return [_write_file(root / partitioning.path(periods[start]), table.slice(start, end - start), 'part')
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+@contextmanager
+def partition_lock(directory: Path, exclusive: bool = False, blocking: bool = True) -> Iterator[bool]:
+    """
+    Hold a shared (reading) or exclusive (compacting) lock on a partition directory, across processes.
+
+    Yields whether the lock was acquired, which is always the case when blocking.
+    """
+    with open(Path(directory) / LOCK_FILE, 'a', encoding='utf-8') as lock:
+        try:
+            fcntl.flock(lock, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def select_files(files: Iterator[Path], start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> List[Path]:
+    """Sorted files which may hold rows between start_ns and end_ns (inclusive), by the time range in their names."""
+    lower = -np.inf if start_ns is None else start_ns
+    upper = np.inf if end_ns is None else end_ns
+    selected = []
+    for path in files:
+        min_ns, max_ns = file_time_range(path)
+        if min_ns <= upper and max_ns >= lower:
+            selected.append(path)
+
+    return sorted(selected)
+
+
+def list_files(root: Path, partitioning: TimePartitioning, start_ns: Optional[int] = None,
+               end_ns: Optional[int] = None) -> List[Path]:
+    """
+    List the dataset files under root which may hold rows between start_ns and end_ns (inclusive).
+
+    Only the partition directories overlapping the range are listed, and files are pruned using the time range
+    in their names.
+    """
+    if start_ns is None or end_ns is None:
+        files = root.glob('/'.join(['*'] * partitioning.depth + ['*.parquet']))
+    else:
+        files = (path for directory in partitioning.paths(start_ns, end_ns)
+                 for path in (root / directory).glob('*.parquet'))
+
+    return select_files(files, start_ns, end_ns)
+
+
+def partitions(root: Path, partitioning: TimePartitioning) -> List[Path]:
+    """List every partition directory under root."""
+    return sorted(root.glob('/'.join(['*'] * partitioning.depth)))
+
+
+def compact_partition(directory: Path, row_group_size: int = 1_000_000) -> Optional[Path]:
+    """
+    Merge every file in a partition directory into one time-sorted file with row groups of row_group_size rows.
+
+    The merged file is renamed into place before the inputs are removed, so no rows are ever missing from the
+    partition, under an exclusive partition_lock so readers never see both. Returns the new file, or None if the
+    partition was already compact or is being read (it is compacted on a later run).
+    """
+    with partition_lock(directory, exclusive=True, blocking=False) as locked:
+        inputs = sorted(directory.glob('*.parquet'))
+        if not locked or len(inputs) < 2:
+            return None
+
+        table = pa.concat_tables([pq.read_table(path) for path in inputs])
+        table = table.sort_by(TIME_COLUMN)
+        output = _write_file(directory, table, 'compacted', row_group_size)
+        for path in inputs:
+            path.unlink()
+
+    return output
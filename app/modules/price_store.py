@@ -3,44 +3,277 @@ Module contains functionality for storing and retrieving price data.
 """
 
 import asyncio
-from typing import Dict, List
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Dict, Iterable, List, Optional, Tuple
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from app.modules.broker_integrations.base_integration import CANDLE_SCHEMA, Tick
+from app.modules.coverage import CoverageIndex
+from app.modules.parquet_dataset import TimePartitioning, compact_partition, list_files, partition_lock, partitions, \
+    select_files, write_partitioned
+from app.modules.tick_buffer import NaN, BarBuffer, TickBuffer, to_epoch_ns
+
+log = logging.getLogger('PriceStore')
+
+
+TICK_SCHEMA = pa.schema([
+    ('time_stamp', pa.timestamp('ns', tz='UTC')),
+    ('bid', pa.float64()),
+    ('ask', pa.float64()),
+    ('volume', pa.float64()),
+])
+
+BAR_SCHEMA = CANDLE_SCHEMA  # Live bars are stored in the same schema as broker candles.
+
+
+def candle_partitioning(resolution: str) -> TimePartitioning:
+    """Partitioning of the candle dataset for a broker resolution, sized to a few thousand candles per file."""
+    if resolution == 'SECOND':
+        return TimePartitioning('D')
+    if resolution in ('MINUTE', 'MINUTE_2', 'MINUTE_3'):
+        return TimePartitioning('M')
+    return TimePartitioning('Y')
+
+
+def read_table(root: Path, partitioning: TimePartitioning, schema: pa.Schema, start_ns: int,
+               end_ns: int) -> pa.Table:
+    """
+    Read the rows of the dataset at root in [start_ns, end_ns) sorted by time, pushing the time filter down to the
+    scan. The files of each partition are listed again and read under its partition_lock.
+    """
+    directories = sorted({path.parent for path in list_files(root, partitioning, start_ns, end_ns)})
+    time_type = schema.field('time_stamp').type
+    time_stamp = ds.field('time_stamp')
+    in_range = (time_stamp >= pa.scalar(start_ns, type=time_type)) & (time_stamp < pa.scalar(end_ns, type=time_type))
+    with ExitStack() as locks:
+        for directory in directories:
+            locks.enter_context(partition_lock(directory))
+        files = [str(path) for directory in directories
+                 for path in select_files(directory.glob('*.parquet'), start_ns, end_ns)]
+        return ds.dataset(files, schema=schema, format='parquet').to_table(filter=in_range).sort_by('time_stamp')
+
+
+def prices_to_table(prices: Dict[str, np.ndarray], schema: pa.Schema = TICK_SCHEMA) -> pa.Table:
+    """Wrap the column views of a TickBuffer (or BarBuffer with BAR_SCHEMA) in an Arrow table without copying."""
+    return pa.table({
+        name: pa.array(prices[name], type=schema.field(name).type) for name in schema.names
+    }, schema=schema)
+
 
 class PriceStore:
     """The PriceStore class contains a buffer to accumulate prices and a cron to write them to disk."""
-    accumulators: Dict[str, List]
+    accumulators: Dict[str, TickBuffer]
+    bar_accumulators: Dict[Tuple[str, str], BarBuffer]
     cache_folder: str
     frequency: float
+    max_buffer_ticks: int
+    compaction_frequency: float
+    partitioning = TimePartitioning('h')
+    bar_partitioning = TimePartitioning('D')
     running = True
 
-    def __init__(self, cache_folder: str, frequency: int = 60):
-        """Initialise PriceStore instance with empty accumulator dictionary."""
+    def __init__(self, cache_folder: str, frequency: int = 60, max_buffer_ticks: int = 100_000,
+                 executor: Optional[Executor] = None, compaction_frequency: int = 600,
+                 row_group_size: int = 1_000_000):
+        """
+        Initialise PriceStore instance with empty accumulator dictionary.
+
+        Buffers are flushed every frequency seconds, or sooner once any epic holds max_buffer_ticks ticks.
+        Parquet encoding runs in executor (a single background thread by default) to keep the event loop free.
+        Every compaction_frequency seconds, closed hourly partitions are merged into row groups of row_group_size.
+        """
         self.frequency = frequency
+        self.max_buffer_ticks = max_buffer_ticks
+        self.compaction_frequency = compaction_frequency
+        self.row_group_size = row_group_size
         self.cache_folder = cache_folder
         self.accumulators = {}
+        self.bar_accumulators = {}
+        self.coverage = CoverageIndex(self.candle_folder / '_coverage.json')
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='price-store')
+        self._flush_requested: Optional[asyncio.Event] = None
+
+    @property
+    def tick_folder(self) -> Path:
+        """Root folder of the partitioned tick dataset."""
+        return Path(self.cache_folder) / 'ticks'
+
+    @property
+    def bar_folder(self) -> Path:
+        """Root folder of the partitioned bar dataset."""
+        return Path(self.cache_folder) / 'bars'
+
+    @property
+    def candle_folder(self) -> Path:
+        """Root folder of the partitioned dataset of historical candles fetched from brokers."""
+        return Path(self.cache_folder) / 'candles'
 
     async def start(self):
-        """Start the disk storage cron job."""
-        while self.running:
-            await asyncio.sleep(self.frequency)
-            for epic, prices in self.accumulators.items():
-                # TODO: write accumulators to disk as parquet.
-                # TODO: add lock to prevent sending while writing.
-                self.accumulators[epic] = []
+        """Start the disk storage cron job, flushing on a timer or when a buffer fills up."""
+        self._flush_requested = asyncio.Event()
+        compactor = asyncio.create_task(self._compact_periodically())
+        try:
+            while self.running:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self.frequency)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_requested.clear()
+                await self.flush()
+        finally:
+            compactor.cancel()
 
     def stop(self):
-        """Stop the cron job gracefully (useful in testing)."""
+        """Stop the cron job gracefully after a final flush (useful in testing)."""
         self.running = False
+        if self._flush_requested is not None:
+            self._flush_requested.set()
+
+    async def flush(self):
+        """
+        Swap every non-empty buffer for an empty one and write the full buffers to disk in the executor.
+
+        The swap happens without yielding to the event loop, so it is atomic with respect to store_price and
+        ticks arriving while the files are being written go straight into the fresh buffers. Each flush adds
+        one single-row-group file to each partition it covers.
+        """
+        full_ticks = {epic: buffer for epic, buffer in self.accumulators.items() if len(buffer) > 0}
+        for epic, buffer in full_ticks.items():
+            self.accumulators[epic] = TickBuffer(buffer.capacity)
+        full_bars = {key: buffer for key, buffer in self.bar_accumulators.items() if len(buffer) > 0}
+        for key, buffer in full_bars.items():
+            self.bar_accumulators[key] = BarBuffer(buffer.capacity)
+
+        writes = [(self.get_price_dir(epic), prices_to_table(buffer.view()), self.partitioning)
+                  for epic, buffer in full_ticks.items()]
+        writes += [(self.get_bar_dir(*key), prices_to_table(buffer.view(), BAR_SCHEMA), self.bar_partitioning)
+                   for key, buffer in full_bars.items()]
+
+        loop = asyncio.get_running_loop()
+        for root, table, partitioning in writes:
+            try:
+                await loop.run_in_executor(self.executor, write_partitioned, root, table, partitioning)
+            except (OSError, pa.ArrowException):
+                log.exception('Failed to write %d rows to %s', len(table), root)
+
+    async def compact(self, grace: float = 60):
+        """Merge the per-flush files of every partition closed for more than grace seconds in the executor."""
+        now_ns = time.time_ns()
+        loop = asyncio.get_running_loop()
+        for directory in self._closed_partitions(now_ns - int(grace * 1e9)):
+            try:
+                await loop.run_in_executor(self.executor, compact_partition, directory, self.row_group_size)
+            except (OSError, pa.ArrowException):
+                log.exception('Failed to compact %s', directory)
+
+    def _closed_partitions(self, before_ns: int) -> List[Path]:
+        """List the tick and bar partition directories of every epic which closed before before_ns."""
+        datasets = [(root, self.partitioning) for root in self.tick_folder.glob('epic=*')]
+        datasets += [(root, self.bar_partitioning) for root in self.bar_folder.glob('epic=*/resolution=*')]
+        datasets += [(root, candle_partitioning(root.name.split('=', 1)[1]))
+                     for root in self.candle_folder.glob('epic=*/resolution=*')]
+        return [directory for root, partitioning in datasets for directory in partitions(root, partitioning)
+                if partitioning.end_ns(directory) <= before_ns]
+
+    async def _compact_periodically(self):
+        """Run compaction every compaction_frequency seconds."""
+        while self.running:
+            await asyncio.sleep(self.compaction_frequency)
+            await self.compact()
 
     def store_price(self, epic, price):
-        """Add a price to the accumulator."""
+        """Add a price (a dict with t, bid, ask and optionally volume) to the accumulator."""
+        if epic not in self.accumulators:
+            self.accumulators[epic] = TickBuffer()
+
+        buffer = self.accumulators[epic]
+        buffer.append(to_epoch_ns(price['t']), price['bid'], price['ask'], price.get('volume', NaN))
+        if len(buffer) >= self.max_buffer_ticks and self._flush_requested is not None:
+            self._flush_requested.set()
+
+    def store_ticks(self, ticks: Iterable[Tick]):
+        """Add live ticks from a broker stream to the accumulators of their epics, timed by the broker."""
+        accumulators = self.accumulators
+        for tick in ticks:
+            buffer = accumulators.get(tick.epic)
+            if buffer is None:
+                buffer = accumulators[tick.epic] = TickBuffer()
+            buffer.append(tick.time_stamp, tick.bid, tick.ask)
+            if len(buffer) >= self.max_buffer_ticks and self._flush_requested is not None:
+                self._flush_requested.set()
+
+    def store_bar(self, epic, resolution, bar):
+        """Add a closed bar (see app.modules.bars.Bar) to the bar accumulator of an epic and resolution."""
+        key = (epic, resolution)
+        if key not in self.bar_accumulators:
+            self.bar_accumulators[key] = BarBuffer()
+
+        self.bar_accumulators[key].append(bar)
+
+    async def store_candles(self, epic, resolution, candles: pa.Table):
+        """Write historical candles (with BAR_SCHEMA columns) for an epic and broker resolution in the executor."""
+        await asyncio.get_running_loop().run_in_executor(
+            self.executor, write_partitioned, self.get_candle_dir(epic, resolution), candles,
+            candle_partitioning(resolution))
+
+    async def read_candles(self, epic, resolution, start_ns: int, end_ns: int) -> pd.DataFrame:
+        """Read the historical candles for an epic and broker resolution in [start_ns, end_ns) in the executor."""
+        table = await asyncio.get_running_loop().run_in_executor(
+            self.executor, read_table, self.get_candle_dir(epic, resolution), candle_partitioning(resolution),
+            BAR_SCHEMA, start_ns, end_ns)
+        return table.to_pandas().drop_duplicates('time_stamp', keep='last').reset_index(drop=True)
+
+    def get_prices(self, epic) -> Dict[str, np.ndarray]:
+        """Return zero-copy column views of the prices accumulated in memory for an epic."""
         if epic not in self.accumulators:
-            self.accumulators[epic] = []
+            return TickBuffer(0).view()
+
+        return self.accumulators[epic].view()
+
+    @property
+    def bytes_per_tick(self) -> float:
+        """Average bytes of buffer memory held per accumulated tick, including unused capacity."""
+        ticks = sum(len(buffer) for buffer in self.accumulators.values())
+        if ticks == 0:
+            return float(TickBuffer.bytes_per_row)
+
+        return sum(buffer.nbytes for buffer in self.accumulators.values()) / ticks
+
+    def get_price_dir(self, epic) -> Path:
+        """Get the root of the partitioned price dataset for a given epic."""
+        return self.tick_folder / f'epic={epic}'
+
+    def get_bar_dir(self, epic, resolution) -> Path:
+        """Get the root of the partitioned bar dataset for a given epic and resolution."""
+        return self.bar_folder / f'epic={epic}' / f'resolution={resolution}'
+
+    def get_bar_files(self, epic, resolution, start_ns: Optional[int] = None,
+                      end_ns: Optional[int] = None) -> List[str]:
+        """Get the paths of the bar files for a given epic and resolution which may hold bars in a time range."""
+        root = self.get_bar_dir(epic, resolution)
+        return [str(path) for path in list_files(root, self.bar_partitioning, start_ns, end_ns)]
+
+    def get_candle_dir(self, epic, resolution) -> Path:
+        """Get the root of the partitioned candle dataset for a given epic and broker resolution."""
+        return self.candle_folder / f'epic={epic}' / f'resolution={resolution}'
+
+    def has_prices(self, epic) -> bool:
+        """Check whether any prices for a given epic have been written to disk."""
+        return any(True for _ in self.get_price_dir(epic).glob('*/*/*.parquet'))
 
-        self.accumulators[epic].append(price)
+    def get_price_files(self, epic, start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> List[str]:
+        """
+        Get the paths of the price files for a given epic which may hold prices between start_ns and end_ns.
 
-    def get_price_file(self, epic):
-        """Get the path for the price file for a given epic."""
-        # TODO: add lock to prevent sending the file while it is being written to.
-        return str(Path(self.cache_folder) / f'{epic}.parquet')
+        Files are only ever renamed into place whole, so every listed file is complete. The files of a partition
+        can be replaced by compaction unless they are listed and read under its partition_lock.
+        """
+        return [str(path) for path in list_files(self.get_price_dir(epic), self.partitioning, start_ns, end_ns)]
@@ -1,68 +1,511 @@
 """
 Module containing the functions and classes used to pass live prices from broker streams to subscribers.
+
+Subscribers receive text frames of JSON messages by default. Subscribers with the 'binary' encoding receive binary
+frames of records, each a RECORD_HEADER followed by the UTF-8 topic and the payload: the JSON message, or the struct
+of a message which can be serialised as one (e.g. a TICK_BINARY on tick: topics). The 'binary_json' encoding always
+uses the JSON message, for workers relaying messages to their own clients. Batching subscribers receive the messages
+queued for them in one frame, a JSON array of the messages in text.
+
+Subscribers change their topics without reconnecting by sending control messages (see Publisher.control), which are
+replied to in text frames. Topics may be glob patterns such as 'tick:CS.D.*', resolved through a TopicIndex.
 """
 
 import asyncio
-import aiohttp.web
-from typing import Dict, Set
+import json
+import logging
+import os
+import time
+from fnmatch import fnmatchcase
+from operator import attrgetter
+from struct import Struct
+from typing import Any, AsyncIterator, Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
+from urllib.parse import urlencode
 
+import aiohttp.web
+from aiohttp import WSCloseCode
 from aiohttp.web_ws import WebSocketResponse
 
+from app.modules.queues import BatchQueue
+from app.modules.utils import backoff_delay
+
+log = logging.getLogger('Publisher')
+
+# Queue overflow policy of each subscriber policy, a lossless subscriber is disconnected when its queue is full.
+POLICIES = {'lossless': 'block', 'drop_oldest': 'drop_oldest', 'conflate': 'conflate'}
+SEND_QUEUE_SIZE = 10_000  # Messages queued for a subscriber, or topics with the 'conflate' policy.
+MAX_LAG = 10.0  # Seconds a subscriber's queue may stay full before it is disconnected.
+ENCODINGS = ('text', 'binary', 'binary_json')
+UNIX_PATH = os.environ.get('PUBLISHER_PATH', '/tmp/worker-publisher.sock')  # Where the workers of a host subscribe.
+UPSTREAM_BACKOFF = 0.1  # Seconds before a Multiplexer first reconnects to the Publisher, doubling up to UPSTREAM_CAP.
+UPSTREAM_CAP = 5.0
+
+RECORD_HEADER = Struct('<BHI')  # Payload kind, bytes of the UTF-8 topic and of the payload which follow.
+JSON_PAYLOAD = 0
+STRUCT_PAYLOAD = 1
+
+
+def is_pattern(topic: str) -> bool:
+    """Whether a subscription is a glob pattern matching several topics, e.g. 'tick:CS.D.*'."""
+    return any(char in topic for char in '*?[')
 
-async def subscribe(topics):
-    url = f'ws://localhost:9000/subscribe?topics={",".join(topics)}'
-    async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(url) as ws:
+
+def subscription_url(topics, path: Optional[str] = None, **options) -> str:
+    """URL subscribing to topics with the options which are not None, on localhost:9000 or the Unix socket at path."""
+    query = {'topics': ",".join(topics), **{key: value for key, value in options.items() if value is not None}}
+    return f'ws://localhost{"" if path else ":9000"}/subscribe?{urlencode(query)}'
+
+
+async def subscribe(topics, policy: Optional[str] = None, max_hz: Optional[float] = None, encoding: str = 'text',
+                    batch: Optional[float] = None, compress: bool = False, path: Optional[str] = None):
+    """
+    Iterate over the frames of topics, optionally with a subscriber policy, rate cap, encoding and batching window
+    in milliseconds. Binary frames can be decoded with decode_records, compress negotiates permessage-deflate.
+    The Publisher is reached on localhost:9000, or on the Unix socket at path from the same host.
+    """
+    url = subscription_url(topics, path, policy=policy, max_hz=max_hz,
+                           encoding=None if encoding == 'text' else encoding, batch=batch)
+    async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path) if path else None) as session:
+        async with session.ws_connect(url, compress=15 if compress else 0) as ws:
             async for msg in ws:
                 if msg.type in (aiohttp.WSMsgType.CLOSED,
                                 aiohttp.WSMsgType.ERROR):
                     break
 
-                print('Message received from server:', msg.data)
                 yield msg.data
 
 
+def decode_records(data: bytes) -> List[Tuple[str, Union[str, bytes]]]:
+    """Decode the (topic, payload) records of a binary frame, JSON payloads are decoded as text."""
+    records = []
+    offset = 0
+    while offset < len(data):
+        kind, topic_size, payload_size = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        topic = data[offset:offset + topic_size].decode()
+        offset += topic_size
+        payload = data[offset:offset + payload_size]
+        offset += payload_size
+        records.append((topic, payload.decode() if kind == JSON_PAYLOAD else payload))
+    return records
+
+
+class Message:
+    """
+    A message published on a topic, serialised at most once per encoding however many subscribers it is sent to.
+
+    The payload is the JSON message, or an object serialised by to_json() and, in binary, by to_binary() if it has it.
+    """
+
+    __slots__ = ('topic', 'payload', '_text', '_record', '_json_record')
+
+    def __init__(self, topic: str, payload: Any):
+        self.topic = topic
+        self.payload = payload
+        self._text: Optional[str] = payload if isinstance(payload, str) else None
+        self._record: Optional[bytes] = None
+        self._json_record: Optional[bytes] = None
+
+    def _pack(self, kind: int, payload: bytes) -> bytes:
+        """A binary record of the message."""
+        topic = self.topic.encode()
+        return b''.join([RECORD_HEADER.pack(kind, len(topic), len(payload)), topic, payload])
+
+    @property
+    def text(self) -> str:
+        """The JSON message."""
+        if self._text is None:
+            self._text = self.payload.to_json()
+        return self._text
+
+    @property
+    def record(self) -> bytes:
+        """The binary record of the message."""
+        if self._record is None:
+            if hasattr(self.payload, 'to_binary'):
+                self._record = self._pack(STRUCT_PAYLOAD, self.payload.to_binary())
+            else:
+                self._record = self.json_record
+        return self._record
+
+    @property
+    def json_record(self) -> bytes:
+        """The binary record of the JSON message."""
+        if self._json_record is None:
+            self._json_record = self._pack(JSON_PAYLOAD, self.text.encode())
+        return self._json_record
+
+
+class Subscriber:
+    """
+    A websocket subscribed to topics, with its own bounded queue of messages drained by its own writer task.
+
+    The policy decides what happens when the queue is full: 'lossless' disconnects the subscriber, 'drop_oldest'
+    drops its oldest messages and 'conflate' only keeps the latest message of each topic. A subscriber whose queue
+    stays full for max_lag seconds is disconnected, and max_hz caps the rate at which batches are sent.
+
+    Messages are sent one per frame unless batch is given, then the messages queued within batch seconds of the
+    first are sent in one frame.
+    """
+
+    def __init__(self, ws: WebSocketResponse, policy: str = 'lossless', max_hz: Optional[float] = None,
+                 maxsize: int = SEND_QUEUE_SIZE, max_lag: float = MAX_LAG, encoding: str = 'text',
+                 batch: Optional[float] = None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown subscriber policy: {policy}')
+        if encoding not in ENCODINGS:
+            raise ValueError(f'Unknown subscriber encoding: {encoding}')
+        if batch is not None and batch < 0:
+            raise ValueError(f'Negative batch window: {batch}')
+        self.ws = ws
+        self.policy = policy
+        self.encoding = encoding
+        self.batch = batch
+        self.interval = 1 / max_hz if max_hz else 0.0
+        self.max_lag = max_lag
+        self.queue = BatchQueue(maxsize, POLICIES[policy], attrgetter('topic') if policy == 'conflate' else None)
+        self.full_since: Optional[float] = None
+        self.sent = 0
+        self.frames = 0
+        self.closing = False
+        self.closer: Optional[asyncio.Task] = None
+
+    def put(self, message: Message):
+        """Queue a message, disconnecting the subscriber if it cannot keep up."""
+        if self.closing:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.disconnect('Subscriber queue full')
+            return
+        if len(self.queue) < self.queue.maxsize:
+            return
+
+        now = time.monotonic()
+        if self.full_since is None:
+            self.full_since = now
+        elif now - self.full_since > self.max_lag:
+            self.disconnect(f'Subscriber behind for over {self.max_lag:g}s')
+
+    def disconnect(self, reason: str):
+        """Close the websocket in the background, in the closer task awaited by the websocket handler."""
+        if self.closing:
+            return
+        self.closing = True
+        log.warning('Disconnecting subscriber: %s', reason)
+        self.closer = asyncio.create_task(self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=reason.encode()))
+
+    async def send(self, messages: List[Message]):
+        """Send messages in the encoding of the subscriber, in one frame when batching."""
+        if self.encoding == 'text':
+            if self.batch is None:
+                for message in messages:
+                    await self.ws.send_str(message.text)
+            else:
+                await self.ws.send_str(f'[{",".join([message.text for message in messages])}]')
+        else:
+            binary = self.encoding == 'binary'
+            records = [message.record if binary else message.json_record for message in messages]
+            if self.batch is None:
+                for record in records:
+                    await self.ws.send_bytes(record)
+            else:
+                await self.ws.send_bytes(b''.join(records))
+        self.frames += len(messages) if self.batch is None else 1
+
+    async def write(self):
+        """Send the queued messages, a batch at a time."""
+        while True:
+            messages = await self.queue.get_batch()
+            if self.batch:
+                await asyncio.sleep(self.batch)
+                if len(self.queue):
+                    messages += await self.queue.get_batch()
+            self.full_since = None
+            await self.send(messages)
+            self.sent += len(messages)
+            if self.interval:
+                await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        """Policy, encoding, messages and frames sent and queue state."""
+        return {'policy': self.policy, 'encoding': self.encoding, 'sent': self.sent, 'frames': self.frames,
+                **self.queue.stats()}
+
+
+class TopicIndex:
+    """
+    The subscribers of each topic, where subscribers subscribe to topics or to glob patterns such as 'tick:CS.D.*'.
+
+    Patterns are matched against a topic when its subscribers are first looked up, and the index is updated
+    incrementally as subscriptions change, so looking up the subscribers of a topic is a dict lookup.
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[Hashable, Set[str]] = {}  # Topics and patterns of each subscriber.
+        self.patterns: Dict[str, Set[Hashable]] = {}
+        self.index: Dict[str, Set[Hashable]] = {}  # Subscribers of each topic, by name or by pattern.
+
+    def subscribers(self, topic: str) -> Set[Hashable]:
+        """The subscribers of topic."""
+        subscribers = self.index.get(topic)
+        if subscribers is None:
+            subscribers = self.index[topic] = {subscriber for pattern, subscribers in self.patterns.items()
+                                               if fnmatchcase(topic, pattern) for subscriber in subscribers}
+        return subscribers
+
+    def _wants(self, subscriber: Hashable, topic: str) -> bool:
+        """Whether subscriber is subscribed to topic, by name or by pattern."""
+        return any(subscription == topic or (is_pattern(subscription) and fnmatchcase(topic, subscription))
+                   for subscription in self.subscriptions.get(subscriber, ()))
+
+    def add(self, subscriber: Hashable, topics: Iterable[str]):
+        """Subscribe subscriber to topics and patterns."""
+        subscriptions = self.subscriptions.setdefault(subscriber, set())
+        for topic in topics:
+            if topic in subscriptions:
+                continue
+            subscriptions.add(topic)
+            if is_pattern(topic):
+                self.patterns.setdefault(topic, set()).add(subscriber)
+                for name, subscribers in self.index.items():
+                    if fnmatchcase(name, topic):
+                        subscribers.add(subscriber)
+            else:
+                self.subscribers(topic).add(subscriber)
+
+    def remove(self, subscriber: Hashable, topics: Iterable[str]):
+        """Unsubscribe subscriber from topics and patterns, ignoring those it is not subscribed to."""
+        subscriptions = self.subscriptions.get(subscriber, set())
+        for topic in topics:
+            if topic not in subscriptions:
+                continue
+            subscriptions.remove(topic)
+            if is_pattern(topic):
+                self.patterns[topic].discard(subscriber)
+                if not self.patterns[topic]:
+                    del self.patterns[topic]
+                names = [name for name in self.index if fnmatchcase(name, topic)]
+            else:
+                names = [topic]
+            for name in names:
+                if not self._wants(subscriber, name):
+                    self.index[name].discard(subscriber)
+                    if not self.index[name]:
+                        del self.index[name]  # Matched again if it is looked up.
+        if not subscriptions:
+            self.subscriptions.pop(subscriber, None)
+
+    def discard(self, subscriber: Hashable):
+        """Unsubscribe subscriber from everything."""
+        self.remove(subscriber, list(self.subscriptions.get(subscriber, ())))
+
+    def topics(self, subscriber: Hashable) -> List[str]:
+        """The topics and patterns subscriber is subscribed to."""
+        return sorted(self.subscriptions.get(subscriber, ()))
+
+    def counts(self) -> Dict[str, int]:
+        """Subscribers of each topic and pattern subscribed to."""
+        counts: Dict[str, int] = {}
+        for subscriptions in self.subscriptions.values():
+            for topic in subscriptions:
+                counts[topic] = counts.get(topic, 0) + 1
+        return counts
+
+
+class Multiplexer:
+    """
+    Shares one upstream subscription to the Publisher between the local subscribers of a worker.
+
+    Topics and patterns are reference counted across local subscribers, and the upstream subscription follows those
+    with at least one local subscriber through control messages. Each upstream message is decoded once and queued for
+    every local subscriber of its topic, dropping the oldest messages of a local subscriber which falls behind.
+    """
+
+    def __init__(self, path: str = UNIX_PATH, maxsize: int = SEND_QUEUE_SIZE):
+        self.path = path
+        self.maxsize = maxsize
+        self.index = TopicIndex()
+        self.upstream: Optional[asyncio.Task] = None
+        self.changed: Optional[asyncio.Event] = None
+        self.received = 0
+        self.reconnects = 0
+
+    def _changed(self):
+        """Update the upstream subscription to the current topics, starting it if needed."""
+        if self.upstream is None:
+            if self.index.subscriptions:
+                self.changed = asyncio.Event()
+                self.upstream = asyncio.create_task(self._run())
+        else:
+            self.changed.set()
+
+    async def _read(self, ws: aiohttp.ClientWebSocketResponse):
+        """Dispatch upstream messages to the local subscribers of their topic, until the Publisher closes."""
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                continue  # Replies to control messages.
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                break
+            for topic, message in decode_records(msg.data):
+                self.received += 1
+                for queue in self.index.subscribers(topic):
+                    queue.put_nowait(message)
+
+    async def _follow(self, ws: aiohttp.ClientWebSocketResponse, reader: asyncio.Task):
+        """Subscribe and unsubscribe upstream as the local topics change, while there are any."""
+        subscribed: Set[str] = set()
+        while self.index.subscriptions and not reader.done():
+            self.changed.clear()
+            topics = set(self.index.counts())
+            if topics - subscribed:
+                await ws.send_json({'action': 'subscribe', 'topics': sorted(topics - subscribed)})
+            if subscribed - topics:
+                await ws.send_json({'action': 'unsubscribe', 'topics': sorted(subscribed - topics)})
+            subscribed = topics
+            changed = asyncio.create_task(self.changed.wait())
+            try:
+                await asyncio.wait([reader, changed], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                changed.cancel()
+
+    async def _run(self):
+        """Keep the upstream subscription to the current topics, while there are any."""
+        attempt = 0
+        url = subscription_url([], self.path, encoding='binary_json', batch=0)
+        while self.index.subscriptions:
+            try:
+                async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(self.path)) as session:
+                    async with session.ws_connect(url) as ws:
+                        attempt = 0
+                        reader = asyncio.create_task(self._read(ws))
+                        try:
+                            await self._follow(ws, reader)
+                        finally:
+                            reader.cancel()
+            except (aiohttp.ClientError, OSError) as e:
+                log.warning('Upstream subscription failed: %s', e)
+            if self.index.subscriptions:
+                self.reconnects += 1
+                await asyncio.sleep(backoff_delay(attempt, UPSTREAM_BACKOFF, UPSTREAM_CAP))
+                attempt += 1
+        self.upstream = None
+
+    async def subscribe(self, topics: List[str]) -> AsyncIterator[str]:
+        """Iterate over the JSON messages of topics and patterns, sharing the upstream subscription of the worker."""
+        queue = BatchQueue(self.maxsize, 'drop_oldest')
+        self.index.add(queue, topics)
+        self._changed()
+        try:
+            async for message in queue.items():
+                yield message
+        finally:
+            self.index.discard(queue)
+            self._changed()
+
+    async def close(self):
+        """Close the upstream subscription."""
+        self.index = TopicIndex()
+        if self.upstream is not None:
+            self.upstream.cancel()
+            await asyncio.gather(self.upstream, return_exceptions=True)
+            self.upstream = None
+
+    def stats(self) -> dict:
+        """Local subscribers of each topic and pattern, upstream messages received and reconnections."""
+        return {'topics': self.index.counts(), 'received': self.received, 'reconnects': self.reconnects}
+
+
 class Publisher:
-    topics: Dict[str, Set[WebSocketResponse]] = {}
     runner: aiohttp.web.AppRunner
     isListening = True
 
+    def __init__(self):
+        self.index = TopicIndex()
+
     async def broadcast(self, topic, message):
-        if topic not in self.topics:
+        """
+        Queue a message for every subscriber of topic, without waiting for it to be sent. The message is a JSON
+        message, or an object serialised by Message when it is first sent in each encoding.
+        """
+        subscribers = self.index.subscribers(topic)
+        if not subscribers:
             return
+        message = Message(topic, message)
+        for subscriber in subscribers:
+            subscriber.put(message)
 
-        return asyncio.gather(*[ws.send_str(message) for ws in self.topics[topic]])
+    def add_subscriber(self, topics, subscriber: Subscriber):
+        """Subscribe to topics and patterns."""
+        self.index.add(subscriber, topics)
 
-    def add_subscriber(self, topics, ws: WebSocketResponse):
-        for topic in topics:
-            if topic not in self.topics:
-                # Topics are created by subscribers (bit of an anti-pattern tbh)
-                self.topics[topic] = set()
+    def remove_subscriber(self, topics, subscriber: Subscriber):
+        """Unsubscribe from topics and patterns."""
+        self.index.remove(subscriber, topics)
 
-            self.topics[topic].add(ws)
-
-    def remove_subscriber(self, topics, ws: WebSocketResponse):
-        for topic in topics:
-            self.topics[topic].remove(ws)
-            if len(self.topics[topic]) == 0:  # Remove topics with no subscribers.
-                del self.topics[topic]
+    def control(self, subscriber: Subscriber, data: str) -> str:
+        """
+        Apply a control message of a subscriber, e.g. {"action": "subscribe", "topics": ["tick:CS.D.*"]}, returning
+        the JSON reply. The actions are subscribe, unsubscribe and list, each replying with the subscriber's topics.
+        """
+        try:
+            request = json.loads(data)
+            action = request['action']
+            topics = request.get('topics', [])
+            if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+                raise ValueError('topics must be a list of topics')
+            if action == 'subscribe':
+                self.add_subscriber(topics, subscriber)
+            elif action == 'unsubscribe':
+                self.remove_subscriber(topics, subscriber)
+            elif action != 'list':
+                raise ValueError(f'Unknown action: {action}')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return json.dumps({'error': f'Invalid control message: {e}'})
+        return json.dumps({'action': action, 'topics': self.index.topics(subscriber)})
 
     async def websocket_handler(self, request):
-        ws = aiohttp.web.WebSocketResponse()
+        """
+        Subscribe a websocket to ?topics=, with an optional &policy=, &max_hz= rate cap, &encoding= and &batch= window
+        in milliseconds. permessage-deflate is used when the client offers it. Topics may be glob patterns, and are
+        changed by sending control messages over the websocket.
+        """
+        query = request.query
+        try:
+            max_hz = float(query['max_hz']) if 'max_hz' in query else None
+            batch = float(query['batch']) / 1000 if 'batch' in query else None
+            ws = aiohttp.web.WebSocketResponse(compress=True)
+            subscriber = Subscriber(ws, query.get('policy', 'lossless'), max_hz, encoding=query.get('encoding', 'text'),
+                                    batch=batch)
+        except ValueError as e:
+            raise aiohttp.web.HTTPBadRequest(text=str(e))
         await ws.prepare(request)
-        print('Websocket connection ready')
+        log.debug('Websocket connection ready')
 
-        epics = request.query['topics'].split(',')
-        self.add_subscriber(epics, ws)
+        self.add_subscriber([topic for topic in query.get('topics', '').split(',') if topic], subscriber)
+        writer = asyncio.create_task(subscriber.write())
 
-        async for msg in ws:
-            pass
-
-        print('Websocket connection closed')
-        self.remove_subscriber(epics, ws)
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    await ws.send_str(self.control(subscriber, msg.data))
+        finally:
+            log.debug('Websocket connection closed')
+            writer.cancel()
+            self.index.discard(subscriber)
+            tasks = [writer] if subscriber.closer is None else [writer, subscriber.closer]
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    log.info('Subscriber failed: %r', result)
         return ws
 
-    async def listen(self):
+    def stats(self) -> dict:
+        """Subscribers of each topic and pattern."""
+        return self.index.counts()
+
+    async def listen(self, path: str = UNIX_PATH):
+        """Serve subscribers on localhost:9000, and on the Unix socket at path for the other workers of the host."""
         app = aiohttp.web.Application()
         app.router.add_route('GET', '/subscribe', self.websocket_handler)
 
@@ -71,6 +514,9 @@ class Publisher:
 
         site = aiohttp.web.TCPSite(self.runner, 'localhost', 9000)
         await site.start()
+        if os.path.exists(path):
+            os.unlink(path)  # Left by a previous Publisher which did not exit cleanly.
+        await aiohttp.web.UnixSite(self.runner, path).start()
 
         while self.isListening:
             await asyncio.sleep(.2)
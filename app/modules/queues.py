@@ -0,0 +1,134 @@
+"""
+Module contains a bounded queue handing items from a producer to an asyncio consumer in batches.
+"""
+
+import asyncio
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Hashable, List, Optional
+
+POLICIES = ('block', 'drop_oldest', 'conflate')
+
+
+class BatchQueue:
+    """
+    Bounded queue whose consumer takes every queued item at once.
+
+    The consumer is only woken by the first item put after it emptied the queue, so a burst of items costs a
+    single wakeup, including when items are put from another thread. When the queue is full, the overflow policy
+    applies: 'block' makes the producer wait, 'drop_oldest' discards the oldest item and 'conflate' keeps only the
+    latest item for each key (e.g. the latest price of each epic).
+    """
+
+    def __init__(self, maxsize: int = 10_000, policy: str = 'block',
+                 key: Optional[Callable[[Any], Hashable]] = None):
+        """Create an empty queue, key is required by and only used with the 'conflate' policy."""
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown overflow policy: {policy}')
+        if (policy == 'conflate') != (key is not None):
+            raise ValueError("A key must be given with, and only with, the 'conflate' policy")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        self.dropped = 0
+        self.drains = 0
+        self._items = {} if key is not None else deque()
+        self._lock = threading.Condition()
+        self._waiter: Optional[asyncio.Future] = None  # Consumer waiting for items.
+        self._space: Optional[asyncio.Future] = None  # Producer waiting for space with the 'block' policy.
+        self._wake_pending = False
+
+    def __len__(self):
+        return len(self._items)
+
+    def _add(self, item) -> bool:
+        """Add an item applying the overflow policy, returns False if the queue is full and blocking."""
+        items = self._items
+        if self.key is not None:
+            key = self.key(item)
+            if key in items:
+                del items[key]  # The item moves to the end, so the least recently updated key is dropped first.
+                self.dropped += 1
+            elif len(items) >= self.maxsize:
+                del items[next(iter(items))]
+                self.dropped += 1
+            items[key] = item
+        elif len(items) < self.maxsize:
+            items.append(item)
+        elif self.policy == 'block':
+            return False
+        else:
+            items.popleft()
+            items.append(item)
+            self.dropped += 1
+        return True
+
+    def _wake(self):
+        """Wake the consumer if it is waiting, must be called on the event loop."""
+        self._wake_pending = False
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def put_nowait(self, item):
+        """Put an item from the event loop, raising asyncio.QueueFull if the queue is full and blocking."""
+        with self._lock:
+            if not self._add(item):
+                raise asyncio.QueueFull()
+        self._wake()
+
+    async def put(self, item):
+        """Put an item from the event loop, waiting for space if the queue is full and blocking."""
+        while True:
+            with self._lock:
+                if self._add(item):
+                    break
+                if self._space is None or self._space.done():
+                    self._space = asyncio.get_running_loop().create_future()
+                space = self._space
+            await space
+        self._wake()
+
+    def put_threadsafe(self, item):
+        """Put an item from another thread, blocking the thread while the queue is full and blocking."""
+        with self._lock:
+            while not self._add(item):
+                self._lock.wait()
+            waiter = self._waiter
+            if waiter is None or waiter.done() or self._wake_pending:
+                return
+            self._wake_pending = True
+        waiter.get_loop().call_soon_threadsafe(self._wake)
+
+    async def get_batch(self) -> List[Any]:
+        """Wait for items and take every queued item, oldest first."""
+        while True:
+            with self._lock:
+                if self._items:
+                    batch = list(self._items.values()) if self.key is not None else list(self._items)
+                    self._items.clear()
+                    self.drains += 1
+                    self._lock.notify_all()
+                    break
+                waiter = self._waiter = asyncio.get_running_loop().create_future()
+            await waiter
+
+        if self._space is not None and not self._space.done():
+            self._space.set_result(None)
+        return batch
+
+    async def batches(self) -> AsyncIterator[List[Any]]:
+        """Iterate over batches of items forever."""
+        while True:
+            yield await self.get_batch()
+
+    async def items(self) -> AsyncIterator[Any]:
+        """Iterate over items forever, taking them from the queue a batch at a time."""
+        while True:
+            for item in await self.get_batch():
+                yield item
+
+    def stats(self) -> dict:
+        """Current depth and capacity, the number of items dropped by the overflow policy and of batches taken."""
+        return {'depth': len(self._items), 'maxsize': self.maxsize, 'policy': self.policy, 'dropped': self.dropped,
+                'drains': self.drains}
@@ -0,0 +1,222 @@
+"""
+Module contains sharded broker streams, running the stream of each subset of epics in its own worker process.
+
+Shards send their ticks to the parent process over a Unix socket as frames: a FRAME_HEADER, the names of the epics
+appearing for the first time, then one TICK_STRUCT per tick. An empty frame ends the stream of a shard.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from struct import Struct
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+from app.modules.broker_integrations.base_integration import RECONNECT_BACKOFF, RECONNECT_CAP, TICK_STRUCT, Tick, \
+    epic_table
+from app.modules.broker_integrations.capital_integration import CapitalIntegration
+from app.modules.broker_integrations.ig_integration import IGIntegration
+from app.modules.queues import BatchQueue
+from app.modules.utils import backoff_delay
+
+log = logging.getLogger('Shards')
+
+FRAME_HEADER = Struct('<II')  # Bytes of new epic names, number of ticks.
+EPIC_HEADER = Struct('<IH')  # Epic id in the shard and length of the UTF-8 name which follows.
+END_FRAME = FRAME_HEADER.pack(0, 0)
+SHARD_QUEUE_SIZE = 100_000  # Ticks held in a shard while the parent process is busy.
+MERGED_QUEUE_SIZE = 100_000  # Ticks of every shard held for a slow consumer.
+
+BROKERS = {'ig': IGIntegration, 'capital': CapitalIntegration}
+
+
+def shard_epics(epics: Sequence[str], shards: int) -> List[List[str]]:
+    """Split epics into at most shards lists of similar length."""
+    return [list(epics[i::shards]) for i in range(min(shards, len(epics)))]
+
+
+class TickEncoder:
+    """Encodes batches of ticks as frames, sending the name of each epic in the first frame using it."""
+
+    def __init__(self):
+        self.sent = set()
+
+    def encode(self, ticks: Sequence[Tick]) -> bytes:
+        """Encode a non-empty batch of ticks as a frame."""
+        epics = bytearray()
+        for tick in ticks:
+            if tick.epic_id not in self.sent:
+                self.sent.add(tick.epic_id)
+                name = tick.epic.encode()
+                epics += EPIC_HEADER.pack(tick.epic_id, len(name)) + name
+        return b''.join([FRAME_HEADER.pack(len(epics), len(ticks)), epics, *[tick.to_bytes() for tick in ticks]])
+
+
+class TickDecoder:
+    """Decodes the frames of a shard, mapping the epic ids of the shard to ids in the local epic_table."""
+
+    def __init__(self):
+        self.ids: Dict[int, int] = {}
+
+    def decode_epics(self, data: bytes):
+        """Intern the epic names of a frame."""
+        offset = 0
+        while offset < len(data):
+            remote_id, length = EPIC_HEADER.unpack_from(data, offset)
+            offset += EPIC_HEADER.size
+            self.ids[remote_id] = epic_table.intern(data[offset:offset + length].decode())
+            offset += length
+
+    def decode_ticks(self, data: bytes) -> List[Tick]:
+        """Decode the ticks of a frame."""
+        ids = self.ids
+        return [Tick(ids[epic_id], time_stamp, received, bid, ask)
+                for epic_id, time_stamp, received, bid, ask in TICK_STRUCT.iter_unpack(data)]
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[List[Tick]]:
+        """Read the ticks of the next frame, None at the end of the stream."""
+        epic_bytes, count = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        if count == 0:
+            return None
+        if epic_bytes:
+            self.decode_epics(await reader.readexactly(epic_bytes))
+        return self.decode_ticks(await reader.readexactly(count * TICK_STRUCT.size))
+
+
+async def broker_stream(broker: str, config: dict, epics: List[str]) -> AsyncIterator[Tick]:
+    """Stream epics with an integration of broker using the credentials in config, e.g. in a shard process."""
+    integration = BROKERS[broker](**config['credentials'][broker])
+    async for tick in integration.stream(epics):
+        yield tick
+
+
+async def send_ticks(stream: Callable[[List[str]], AsyncIterator[Tick]], epics: List[str], path: str):
+    """Send the ticks of a stream to the Unix socket at path, in a frame for each batch of ticks waiting."""
+    queue = BatchQueue(SHARD_QUEUE_SIZE)
+
+    async def produce():
+        try:
+            async for tick in stream(epics):
+                await queue.put(tick)
+        finally:
+            await queue.put(None)
+
+    _, writer = await asyncio.open_unix_connection(path)
+    producer = asyncio.create_task(produce())
+    encoder = TickEncoder()
+    try:
+        while True:
+            batch = await queue.get_batch()
+            end = batch[-1] is None
+            if end:
+                batch.pop()
+            if batch:
+                writer.write(encoder.encode(batch))
+                await writer.drain()
+            if end:
+                await producer  # A failed stream raises here, so its shard is restarted rather than ended.
+                writer.write(END_FRAME)
+                await writer.drain()
+                break
+    finally:
+        producer.cancel()
+        writer.close()
+        await writer.wait_closed()  # Flushes the frames still buffered before the process exits.
+
+
+def run_shard(stream: Callable[[List[str]], AsyncIterator[Tick]], epics: List[str], path: str):
+    """Entry point of a shard process."""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(send_ticks(stream, epics, path))
+
+
+async def wait_process(process: multiprocessing.process.BaseProcess):
+    """
+    Wait for process to exit without holding a thread, watching its sentinel on the event loop rather than joining it
+    in the default executor, which is shared with e.g. DNS resolution.
+    """
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    loop.add_reader(process.sentinel, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(process.sentinel)
+    process.join()  # Returns immediately, reaping the exited process.
+
+
+class ShardedStream:
+    """
+    Splits the epics of a broker stream into shards, each streamed by its own worker process.
+
+    Every shard has its own broker connection and decodes its updates on its own CPU, the parent process only
+    merges the binary frames of the shards into one stream of Ticks. A shard whose process fails is restarted with
+    backoff. stream is called with the epics of a shard in its process, so it must be picklable (e.g. a
+    functools.partial of broker_stream).
+    """
+
+    def __init__(self, stream: Callable[[List[str]], AsyncIterator[Tick]], shards: int):
+        self.stream_factory = stream
+        self.shards = shards
+        self.context = multiprocessing.get_context('spawn')  # Forking a process running an event loop is unsafe.
+        self.restarts = 0
+
+    async def _run_shard(self, epics: List[str], path: str):
+        """Run a shard process until its stream ends, restarting it whenever it fails."""
+        attempt = 0
+        while True:
+            process = self.context.Process(target=run_shard, args=(self.stream_factory, epics, path), daemon=True)
+            process.start()
+            try:
+                await wait_process(process)
+            finally:
+                if process.is_alive():
+                    process.terminate()
+                    await wait_process(process)
+            if process.exitcode == 0:
+                return
+            log.warning('Shard of %d epics exited with code %s, restarting', len(epics), process.exitcode)
+            self.restarts += 1
+            await asyncio.sleep(backoff_delay(attempt, RECONNECT_BACKOFF, RECONNECT_CAP))
+            attempt += 1
+
+    async def stream(self, epics: List[str]) -> AsyncIterator[Tick]:
+        """Iterate over the ticks of every shard of epics, until the stream of every shard ended."""
+        shards = shard_epics(epics, self.shards)
+        if not shards:
+            return
+        queue = BatchQueue(MERGED_QUEUE_SIZE, policy='drop_oldest')
+        ended = 0
+
+        async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            nonlocal ended
+            decoder = TickDecoder()
+            try:
+                while (ticks := await decoder.read(reader)) is not None:
+                    for tick in ticks:
+                        queue.put_nowait(tick)
+            except asyncio.IncompleteReadError:
+                return  # The shard failed and is restarted.
+            finally:
+                writer.close()
+            ended += 1
+            if ended == len(shards):
+                queue.put_nowait(None)
+
+        folder = tempfile.mkdtemp(prefix='shards-')
+        path = os.path.join(folder, 'ticks.sock')
+        server = await asyncio.start_unix_server(receive, path)
+        runners = [asyncio.create_task(self._run_shard(shard, path)) for shard in shards]
+        try:
+            async for tick in queue.items():
+                if tick is None:
+                    return
+                yield tick
+        finally:
+            for runner in runners:
+                runner.cancel()
+            await asyncio.gather(*runners, return_exceptions=True)
+            server.close()
+            shutil.rmtree(folder, ignore_errors=True)
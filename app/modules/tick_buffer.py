@@ -0,0 +1,101 @@
+"""
+Module contains a columnar, array-backed buffer for accumulating ticks in memory.
+"""
+
+from datetime import datetime
+from typing import Dict
+
+import numpy as np
+
+NaN = float('nan')
+
+
+def to_epoch_ns(value) -> int:
+    """Convert a datetime (naive values are treated as local time) or integer epoch-ns to integer epoch-ns."""
+    if isinstance(value, datetime):
+        return round(value.timestamp() * 1e6) * 1000
+    return int(value)
+
+
+class TickBuffer:
+    """Growable columnar buffer of ticks for a single epic, backed by preallocated NumPy arrays."""
+    columns = {
+        'time_stamp': np.int64,  # Epoch nanoseconds (UTC).
+        'bid': np.float64,
+        'ask': np.float64,
+        'volume': np.float64,  # NaN when the broker does not provide a volume.
+    }
+    bytes_per_row = sum(np.dtype(dtype).itemsize for dtype in columns.values())
+
+    def __init__(self, capacity: int = 1024):
+        """Preallocate arrays for capacity ticks."""
+        self.size = 0
+        self.arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self) -> int:
+        """Number of ticks that fit in the buffer before it has to grow."""
+        return len(self.arrays['time_stamp'])
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes allocated by the buffer, including unused capacity."""
+        return self.capacity * self.bytes_per_row
+
+    def append(self, time_stamp: int, bid: float, ask: float, volume: float = NaN):
+        """Write a single tick into the next free row, doubling the capacity if the buffer is full."""
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+
+        i = self.size
+        arrays = self.arrays
+        arrays['time_stamp'][i] = time_stamp
+        arrays['bid'][i] = bid
+        arrays['ask'][i] = ask
+        arrays['volume'][i] = volume
+        self.size = i + 1
+
+    def _grow(self, capacity: int):
+        """Reallocate the arrays with a larger capacity, copying the existing rows."""
+        for name, array in self.arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+
+    def view(self) -> Dict[str, np.ndarray]:
+        """
+        Return zero-copy views of the filled rows of each column.
+
+        Rows are only ever appended, so a view remains a consistent snapshot even as the buffer keeps filling.
+        """
+        return {name: array[:self.size] for name, array in self.arrays.items()}
+
+
+class BarBuffer(TickBuffer):
+    """Growable columnar buffer of bid/ask OHLC bars for a single epic and resolution."""
+    columns = {
+        'time_stamp': np.int64,  # Epoch nanoseconds (UTC) at which the bar opens.
+        'open_bid': np.float64,
+        'high_bid': np.float64,
+        'low_bid': np.float64,
+        'close_bid': np.float64,
+        'open_ask': np.float64,
+        'high_ask': np.float64,
+        'low_ask': np.float64,
+        'close_ask': np.float64,
+        'volume': np.int64,  # Number of ticks in the bar.
+    }
+    bytes_per_row = sum(np.dtype(dtype).itemsize for dtype in columns.values())
+
+    def append(self, bar):  # pylint: disable=arguments-differ
+        """Write a closed bar into the next free row, doubling the capacity if the buffer is full."""
+        if self.size == self.capacity:
+            self._grow(self.capacity * 2)
+
+        i = self.size
+        for name, array in self.arrays.items():
+            array[i] = getattr(bar, name)
+        self.size = i + 1
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import random
 from functools import cached_property
 
 
@@ -45,3 +46,8 @@ def by_one_worker(worker_pid_path):
         return wrapped
 
     return deco
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter, the delay in seconds before retry number attempt (from 0)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
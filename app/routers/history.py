@@ -1,16 +1,115 @@
 """Router for /history API routes"""
 
-from fastapi import APIRouter
-from app.schemas.poisitions import PositionType
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow as pa
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app.dependencies import get_capital_integration, get_config, get_ig_integration, get_price_store
+from app.modules.broker_integrations.ig_integration import ns_to_ig_time
+from app.modules.history import STREAM_FORMATS, datetime_to_ns, history_schema, iter_history, read_history, \
+    resolve_columns
+from app.modules.price_store import PriceStore
 from app.schemas.errors import EntityNotFound
+from app.schemas.history import HistoryType, ResolutionEnum, SourceEnum
 
 router = APIRouter(prefix="/history", tags=["History"])
 
-not_found_response = {"model": EntityNotFound, "description": "Position Not Found"}
+not_found_response = {"model": EntityNotFound, "description": "History Not Found"}
+
+StartType = Query(None, description='Start of the time range (UTC), defaults to one hour before end.')
+EndType = Query(None, description='End of the time range (UTC), defaults to now.')
+ResolutionType = Query(ResolutionEnum.TICK, description='Resolution of the returned prices.')
+ColumnsType = Query(None, description='Columns to return in addition to time_stamp, defaults to all.')
+
+
+def filter_range(prices: pd.DataFrame, start: datetime, end: datetime) -> pd.DataFrame:
+    """Rows of prices with a time_stamp between start and end (inclusive)."""
+    if len(prices) == 0:
+        return prices
+    time_stamp = pd.to_datetime(prices['time_stamp'], utc=True)
+    in_range = (time_stamp >= pd.Timestamp(datetime_to_ns(start), tz='UTC')) & \
+               (time_stamp <= pd.Timestamp(datetime_to_ns(end), tz='UTC'))
+    return prices[in_range].reset_index(drop=True)
+
+
+async def fetch_broker_history(epic: str, start: datetime, end: datetime, resolution: ResolutionEnum) -> pd.DataFrame:
+    """Fetch bars for an epic between start and end from the broker it is configured for."""
+    # Broker ranges are in whole seconds, the end is rounded up so the bar at end is included.
+    start_time = ns_to_ig_time(datetime_to_ns(start))
+    end_time = ns_to_ig_time(datetime_to_ns(end) + 10 ** 9 - 1)
+    if epic in get_config()['epics']['ig']:
+        history = await get_ig_integration().get_historical_data(epic, resolution.value, start=start_time,
+                                                                 end=end_time)
+        return pd.DataFrame() if history is None else filter_range(history, start, end)
+
+    if epic in get_config()['epics']['capital']:
+        candles = await get_capital_integration().candles(epic, resolution.value, limit=1000, start=start_time,
+                                                          end=end_time)
+        return filter_range(candles.to_pandas(), start, end)
+
+    raise HTTPException(status_code=404, detail=f'No data for {epic}')
+
+
+def stream_format(request: Request) -> Optional[str]:
+    """Return the first streaming media type accepted by the request, if any."""
+    accept = request.headers.get('accept', '')
+    return next((media_type for media_type in STREAM_FORMATS if media_type in accept), None)
+
+
+@router.get("/{epic}", response_model=HistoryType, responses={
+    404: not_found_response,
+    200: {"content": {media_type: {} for media_type in STREAM_FORMATS}},
+})
+async def get_history(request: Request, epic: str, start: Optional[datetime] = StartType,
+                      end: Optional[datetime] = EndType, resolution: ResolutionEnum = ResolutionType,
+                      columns: Optional[List[str]] = ColumnsType, store: PriceStore = Depends(get_price_store)):
+    """
+    API route for getting historical prices of an instrument.
+
+    Prices are read from the local store, the broker is only queried when there is no local data for the epic.
+    Large ranges can be streamed in batches as an Arrow IPC stream, NDJSON or CSV by setting the Accept header to
+    application/vnd.apache.arrow.stream, application/x-ndjson or text/csv.
+    """
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(hours=1)
+    try:
+        columns = resolve_columns(resolution.value, columns)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    media_type = stream_format(request)
+    source = SourceEnum.LOCAL
+    if store.has_prices(epic):
+        if media_type is not None:
+            # Batches are read and encoded in the threadpool as the client consumes them.
+            schema = history_schema(resolution.value, columns)
+            batches = iter_history(store, epic, start, end, resolution.value, columns)
+            return StreamingResponse(STREAM_FORMATS[media_type](batches, schema), media_type=media_type)
 
+        # Scanning and resampling a large range would otherwise block the event loop and every websocket on it.
+        prices = await run_in_threadpool(read_history, store, epic, start, end, resolution.value, columns)
+    elif resolution == ResolutionEnum.TICK:
+        raise HTTPException(status_code=404, detail=f'No tick data for {epic}')
+    else:
+        source = SourceEnum.BROKER
+        prices = await fetch_broker_history(epic, start, end, resolution)
+        if len(prices) > 0:
+            prices = prices[['time_stamp', *columns]]
+        if media_type is not None:
+            schema = history_schema(resolution.value, columns)
+            batches = [pa.RecordBatch.from_pandas(prices, schema=schema, preserve_index=False)] if len(prices) else []
+            return StreamingResponse(STREAM_FORMATS[media_type](batches, schema), media_type=media_type)
 
-@router.get("/{epic}", response_model=PositionType, responses={404: not_found_response})
-def get_position(epic: str):
-    """API route for getting a position."""
-    print(epic)
-    return {"Hello": "World"}
+    return {
+        'epic': epic,
+        'resolution': resolution,
+        'start': start,
+        'end': end,
+        'source': source,
+        'prices': prices.astype(object).where(prices.notna(), None).to_dict('records'),
+    }
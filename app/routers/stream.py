@@ -1,6 +1,13 @@
 """Router for /stream API routes"""
 
-from fastapi import APIRouter, WebSocket
+import asyncio
+from typing import List
+
+from fastapi import APIRouter, Query, WebSocket
+
+from app.dependencies import get_multiplexer
+from app.modules.bars import BAR_RESOLUTIONS, bar_topic
+from app.modules.market_data import tick_topic
 from app.schemas.errors import EntityNotFound
 
 router = APIRouter(prefix="/stream", tags=["Streaming"])
@@ -8,19 +15,43 @@ router = APIRouter(prefix="/stream", tags=["Streaming"])
 not_found_response = {"model": EntityNotFound, "description": "Stream Not Found"}
 
 
-@router.websocket("/ochl")
-async def ochl_websocket(websocket: WebSocket):
-    """Stream OCHL data via websocket."""
+EpicsType = Query(..., description='Comma separated list of EPICs to stream, or patterns such as CS.D.*')
+ResolutionType = Query('1m', description=f'Bar resolution, one of {", ".join(BAR_RESOLUTIONS)}.')
+
+
+async def relay(websocket: WebSocket, topics: List[str]):
+    """Forward the messages of topics from the Publisher of this host, through the subscription of this worker."""
     await websocket.accept()
-    while True:
-        data = await websocket.receive_text()
-        await websocket.send_text(f"Message text was: {data}")
+
+    async def forward():
+        async for message in get_multiplexer().subscribe(topics):
+            await websocket.send_text(message)
+
+    async def disconnected():
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass  # Clients only listen, but a disconnection must end the upstream subscription.
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Retrieves the exception of a task which failed, e.g. sending on a closed websocket.
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@router.websocket("/ochl")
+async def ochl_websocket(websocket: WebSocket, epics: str = EpicsType, resolution: str = ResolutionType):
+    """Stream partial and closed OCHL bars via websocket."""
+    if resolution not in BAR_RESOLUTIONS:
+        await websocket.close(code=1003, reason=f'Unknown resolution: {resolution}')
+        return
+
+    await relay(websocket, [bar_topic(resolution, epic) for epic in epics.split(',')])
 
 
 @router.websocket("/tick")
-async def tick_websocket(websocket: WebSocket):
+async def tick_websocket(websocket: WebSocket, epics: str = EpicsType):
     """Stream tick data via websocket."""
-    await websocket.accept()
-    while True:
-        data = await websocket.receive_text()
-        await websocket.send_text(f"Message text was: {data}")
+    await relay(websocket, [tick_topic(epic) for epic in epics.split(',')])
@@ -0,0 +1,34 @@
+"""Schemas for history API routes."""
+
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List
+
+from pydantic import BaseModel, Field
+
+
+class ResolutionEnum(str, Enum):
+    """Enumeration of supported price resolutions, named as in the IG API."""
+    TICK = 'TICK'
+    SECOND = 'SECOND'
+    MINUTE = 'MINUTE'
+    MINUTE_5 = 'MINUTE_5'
+    MINUTE_15 = 'MINUTE_15'
+    HOUR = 'HOUR'
+    DAY = 'DAY'
+
+
+class SourceEnum(str, Enum):
+    """Enumeration of history data sources."""
+    LOCAL = 'LOCAL'
+    BROKER = 'BROKER'
+
+
+class HistoryType(BaseModel):
+    """Response type for historical prices."""
+    epic: str = Field(description='EPIC of the instrument.', example='EURUSD')
+    resolution: ResolutionEnum = Field(description='Resolution of the prices.')
+    start: datetime = Field(description='Start of the requested time range (UTC).')
+    end: datetime = Field(description='End of the requested time range (UTC).')
+    source: SourceEnum = Field(description='Whether the prices were read locally or fetched from the broker.')
+    prices: List[Dict[str, Any]] = Field(description='Prices in time order, one object per tick or bar.')
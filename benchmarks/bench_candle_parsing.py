@@ -0,0 +1,74 @@
+"""
+Benchmark parsing a historical prices payload into a typed table, per point in Python versus parse_candles.
+
+Usage: python benchmarks/bench_candle_parsing.py [--candles 10000] [--repeat 20]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+# pylint: disable=wrong-import-position
+from app.modules.broker_integrations.base_integration import parse_candles
+
+
+def make_payload(candles: int) -> list:
+    """Build the 'prices' list of an IG historical prices response, as decoded from JSON."""
+    start = datetime(2023, 1, 2)
+    points = []
+    for i in range(candles):
+        price = 100 + i % 50
+        points.append({
+            'snapshotTime': (start + timedelta(minutes=i)).strftime('%Y/%m/%d %H:%M:%S'),
+            'snapshotTimeUTC': (start + timedelta(minutes=i)).isoformat(),
+            **{field: {'bid': price, 'ask': price + 0.5, 'lastTraded': None}
+               for field in ('openPrice', 'closePrice', 'highPrice', 'lowPrice')},
+            'lastTradedVolume': i % 100,
+        })
+    return json.loads(json.dumps(points))
+
+
+def parse_per_point(points: list) -> pd.DataFrame:
+    """The previous approach: a dict and datetime per candle, then a DataFrame."""
+    rows = []
+    for point in points:
+        if 'ask' not in point['openPrice'] or 'bid' not in point['openPrice']:
+            continue
+        rows.append({
+            'time_stamp': datetime.fromisoformat(point['snapshotTimeUTC']),
+            'open_ask': point['openPrice']['ask'],
+            'open_bid': point['openPrice']['bid'],
+            'close_ask': point['closePrice']['ask'],
+            'close_bid': point['closePrice']['bid'],
+            'high_ask': point['highPrice']['ask'],
+            'high_bid': point['highPrice']['bid'],
+            'low_ask': point['lowPrice']['ask'],
+            'low_bid': point['lowPrice']['bid'],
+            'volume': point['lastTradedVolume'],
+        })
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--candles', type=int, default=10_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    points = make_payload(args.candles)
+    print(f'{args.candles} candles, best of {args.repeat}')
+    for name, parse in (('per point', parse_per_point), ('parse_candles', parse_candles),
+                        ('parse_candles + to_pandas', lambda p: parse_candles(p).to_pandas())):
+        best = min(timeit.repeat(lambda: parse(points), number=1, repeat=args.repeat))  # pylint: disable=cell-var-from-loop
+        print(f'{name:>26}: {best * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
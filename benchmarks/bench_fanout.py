@@ -0,0 +1,100 @@
+"""
+Benchmark Publisher fanout to 1k websocket subscribers of one tick topic, in the text path sending a frame per message
+and with the binary encoding, batching and permessage-deflate.
+
+Messages/s counts each message delivered to each subscriber, from the first broadcast to the last message received.
+The subscribers run in the same process as the Publisher, so their receive work is included.
+
+Usage: python benchmarks/bench_fanout.py [--subscribers 1000] [--messages 200]
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import aiohttp
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+# pylint: disable=wrong-import-position
+from app.modules.broker_integrations.base_integration import Tick, epic_table
+from app.modules.pub_sub import Publisher, decode_records
+
+MODES = {
+    'text': {},
+    'text, batch 5ms': {'batch': 5},
+    'binary': {'encoding': 'binary'},
+    'binary, batch 5ms': {'encoding': 'binary', 'batch': 5},
+    'binary, batch 5ms, deflate': {'encoding': 'binary', 'batch': 5, 'compress': True},
+}
+
+
+def count_messages(msg: aiohttp.WSMessage, batched: bool) -> int:
+    """Messages in a frame."""
+    if msg.type == aiohttp.WSMsgType.BINARY:
+        return len(decode_records(msg.data))
+    return len(json.loads(msg.data)) if batched else 1
+
+
+async def receive(ws: aiohttp.ClientWebSocketResponse, expected: int, batched: bool, done: asyncio.Event):
+    """Receive frames until expected messages arrived."""
+    received = 0
+    async for msg in ws:
+        received += count_messages(msg, batched)
+        if received >= expected:
+            break
+    done.set()
+
+
+async def measure(subscribers: int, messages: int, options: dict) -> float:
+    """Messages per second delivered to subscribers."""
+    publisher = Publisher()
+    listener = asyncio.create_task(publisher.listen())
+    await asyncio.sleep(0.2)
+
+    query = {'topics': 'tick:BENCH.A', **{key: value for key, value in options.items() if key != 'compress'}}
+    url = f'ws://localhost:9000/subscribe?{urlencode(query)}'
+    epic_id = epic_table.intern('BENCH.A')
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        sockets = [await session.ws_connect(url, compress=15 if options.get('compress') else 0)
+                   for _ in range(subscribers)]
+        while publisher.stats().get('tick:BENCH.A', 0) < subscribers:
+            await asyncio.sleep(0.01)
+        events = [asyncio.Event() for _ in sockets]
+        receivers = [asyncio.create_task(receive(ws, messages, 'batch' in options, done))
+                     for ws, done in zip(sockets, events)]
+
+        start = time.perf_counter()
+        for i in range(messages):
+            await publisher.broadcast('tick:BENCH.A', Tick(epic_id, i, i, 100.0 + i, 100.5 + i))
+            if i % 10 == 0:
+                await asyncio.sleep(0)
+        for done in events:
+            await done.wait()
+        elapsed = time.perf_counter() - start
+
+        await asyncio.gather(*receivers)
+        for ws in sockets:
+            await ws.close()
+    await publisher.close()
+    await listener
+    return subscribers * messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    for name, options in MODES.items():
+        rate = asyncio.run(measure(args.subscribers, args.messages, options))
+        print(f'{name:28} {rate:12,.0f} messages/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark peak server RSS and time-to-first-byte of /history/{epic} for each response format.
+
+A synthetic tick dataset is written to a temporary data folder, then for every format a fresh API server is
+started and one large history query is made against it.
+
+Usage: python benchmarks/bench_history_stream.py [--ticks 2000000]
+"""
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import yaml
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+# pylint: disable=wrong-import-position
+from app.modules.parquet_dataset import compact_partition, partitions, write_partitioned
+from app.modules.price_store import PriceStore, prices_to_table
+
+EPIC = 'CS.D.BENCH.CFD.IP'
+START = np.datetime64('2023-10-16T00:00:00', 'ns').astype(np.int64)
+FORMATS = ['application/json', 'application/vnd.apache.arrow.stream', 'application/x-ndjson', 'text/csv']
+PORT = 8765
+
+
+def write_dataset(folder: str, ticks: int):
+    """Write one day of random-walk ticks, compacted as they would be in production."""
+    store = PriceStore(folder)
+    time_stamps = START + np.sort(np.random.randint(0, 24 * 3600 * 10 ** 9, ticks))
+    bid = 100 + np.cumsum(np.random.normal(0, 0.01, ticks))
+    table = prices_to_table({'time_stamp': time_stamps, 'bid': bid, 'ask': bid + 0.1,
+                             'volume': np.full(ticks, np.nan)})
+    write_partitioned(store.get_price_dir(EPIC), table, store.partitioning)
+    for directory in partitions(store.get_price_dir(EPIC), store.partitioning):
+        compact_partition(directory)
+
+
+def peak_rss_kb(pid: int) -> int:
+    """Read the peak resident set size of a process."""
+    with open(f'/proc/{pid}/status', encoding='UTF-8') as file:
+        return next(int(line.split()[1]) for line in file if line.startswith('VmHWM'))
+
+
+def wait_for_server():
+    """Poll until the API server accepts connections."""
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection('localhost', PORT).connect()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise TimeoutError('Server did not start')
+
+
+def run(media_type: str, config_path: str):
+    """Query the whole day in one format against a fresh server, returning (ttfb, total, bytes, rss delta)."""
+    env = {**os.environ, 'CONFIG_PATH': config_path}
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(PORT)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server()
+        baseline = peak_rss_kb(server.pid)
+        connection = http.client.HTTPConnection('localhost', PORT)
+        started = time.perf_counter()
+        connection.request('GET', f'/history/{EPIC}?start=2023-10-16T00:00:00&end=2023-10-17T00:00:00',
+                           headers={'access-token': 'fake-super-secret-token', 'accept': media_type})
+        response = connection.getresponse()
+        size = len(response.read(1))
+        ttfb = time.perf_counter() - started
+        while chunk := response.read(1 << 16):
+            size += len(chunk)
+        total = time.perf_counter() - started
+        return ttfb, total, size, peak_rss_kb(server.pid) - baseline
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    """Run the benchmark for every format and print a table of results."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=2_000_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_dataset(folder, args.ticks)
+        with open('./configs/default.yaml', encoding='UTF-8') as file:
+            config = yaml.safe_load(file)
+        config['data_folder'] = folder
+        config_path = os.path.join(folder, 'config.yaml')
+        with open(config_path, 'w', encoding='UTF-8') as file:
+            yaml.safe_dump(config, file)
+
+        print(f'{args.ticks} ticks, pyarrow {pa.__version__}')
+        print(f'{"format":<40}{"ttfb (s)":>10}{"total (s)":>11}{"MB sent":>9}{"peak RSS +MB":>14}')
+        for media_type in FORMATS:
+            ttfb, total, size, rss = run(media_type, config_path)
+            print(f'{media_type:<40}{ttfb:>10.3f}{total:>11.3f}{size / 1e6:>9.1f}{rss / 1e3:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
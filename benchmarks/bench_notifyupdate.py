@@ -0,0 +1,119 @@
+"""
+Benchmark the per-update cost of decoding an IG price update, from the stream line to the yielded values.
+
+Usage: python benchmarks/bench_notifyupdate.py [--updates 200000]
+"""
+
+import argparse
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+# pylint: disable=wrong-import-position
+from app.modules.broker_integrations.ig_stream import parse_update_time
+from app.modules.broker_integrations.lightstreamer import Subscription
+
+ITEMS = [f'MARKET:CS.D.BENCH{i}.CFD.IP' for i in range(10)]
+FIELDS = ['BID', 'OFFER', 'UPDATE_TIME']
+
+
+class LegacySubscription:
+    """The previous decoding path: a dict per token set, per item and per event."""
+
+    def __init__(self, items, fields):
+        self.item_names = items
+        self.field_names = fields
+        self._items_map = {}
+        self._listeners = []
+
+    @staticmethod
+    def _decode(value, last):
+        if value == "$":
+            return ""
+        if value == "#":
+            return None
+        if not value:
+            return last
+        if value[0] in "#$":
+            value = value[1:]
+        return value
+
+    def notifyupdate(self, item_line):
+        toks = item_line.rstrip("\r\n").split("|")
+        undecoded_item = dict(list(zip(self.field_names, toks[1:])))
+        item_pos = int(toks[0])
+        curr_item = self._items_map.get(item_pos, {})
+        self._items_map[item_pos] = dict(
+            [(k, self._decode(v, curr_item.get(k))) for k, v in list(undecoded_item.items())]
+        )
+        item_info = {"pos": item_pos, "name": self.item_names[item_pos - 1], "values": self._items_map[item_pos]}
+        for on_item_update in self._listeners:
+            on_item_update(item_info)
+
+
+def legacy_tick(item):
+    hour, minutes, seconds = tuple(map(int, item['values']['UPDATE_TIME'].split(':')))
+    now = datetime.now().replace(hour=hour, minute=minutes, second=seconds, microsecond=0)
+    return {'epic': item['name'].split(':')[1], 'ask': float(item['values']['OFFER']),
+            'bid': float(item['values']['BID']), 't': now}
+
+
+def make_lines(updates: int) -> list:
+    """Update lines as they arrive on the stream, the update time only changes once a second."""
+    lines = []
+    for i in range(updates):
+        bid = f'{100 + i % 97 / 10:.1f}'
+        changed = i < len(ITEMS) or i % 100 == 0
+        time_field = f'12:{i // 6000 % 60:02d}:{i // 100 % 60:02d}' if changed else ''
+        lines.append(f'{i % len(ITEMS) + 1}|{bid}|{float(bid) + 0.5:.1f}|{time_field}\r\n')
+    return lines
+
+
+def run_legacy(lines):
+    subscription = LegacySubscription(ITEMS, FIELDS)
+    ticks = []
+    subscription._listeners.append(lambda item: ticks.append(legacy_tick(item)))  # pylint: disable=protected-access
+    start = time.perf_counter()
+    for line in lines:
+        subscription.notifyupdate(line)
+    return time.perf_counter() - start
+
+
+def run_current(lines):
+    epics = {item: item.split(':')[1] for item in ITEMS}
+    subscription = Subscription('MERGE', ITEMS, FIELDS,
+                                converters={'BID': float, 'OFFER': float, 'UPDATE_TIME': parse_update_time})
+    ticks = []
+    midnight_ns = 0
+    subscription.addlistener(lambda item: ticks.append({
+        'epic': epics[item.name], 'ask': item.values[1], 'bid': item.values[0],
+        't': midnight_ns + item.values[2] * 10 ** 9}))
+    start = time.perf_counter()
+    for line in lines:
+        subscription.notifyupdate(line)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=200_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    lines = make_lines(args.updates)
+    runs = {'legacy': run_legacy, 'current': run_current}
+    timings = {name: [] for name in runs}
+    for _ in range(args.repeat):  # The paths are run alternately, so a change in machine load affects both.
+        for name, run in runs.items():
+            timings[name].append(run(lines))
+    best = {name: min(values) for name, values in timings.items()}
+    for name, elapsed in best.items():
+        print(f'{name:>8}: {elapsed / args.updates * 1e9:6.0f} ns/update')
+    print(f'{"speedup":>8}: {best["legacy"] / best["current"]:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark the throughput of a fake IG feed streamed in the hub's process and in 1, 2 and 4 shard processes.
+
+Each feed decodes Lightstreamer update lines into Ticks, which is the per-update work moved to the shards.
+Throughput is measured from the first to the last tick received, excluding the start of the shard processes.
+
+Usage: python benchmarks/bench_shards.py [--updates 400000] [--epics 40]
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from functools import partial
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parents[1]))
+
+# pylint: disable=wrong-import-position
+from app.modules.broker_integrations.base_integration import Tick, epic_table
+from app.modules.broker_integrations.ig_stream import PRICE_CONVERTERS, PRICE_FIELDS
+from app.modules.broker_integrations.lightstreamer import Subscription
+
+
+async def fake_feed(epics, updates):
+    """Decode updates update lines spread over epics, as the IG stream does, yielding a Tick for each."""
+    ids = [epic_table.intern(epic) for epic in epics]
+    ticks = []
+    subscription = Subscription('MERGE', [f'MARKET:{epic}' for epic in epics], PRICE_FIELDS,
+                                converters=PRICE_CONVERTERS)
+    subscription.addlistener(lambda item: ticks.append(
+        Tick(ids[item.pos - 1], item.values[2] * 10 ** 9, time.time_ns(), item.values[0], item.values[1])))
+    for i in range(updates):
+        bid = 100 + i % 97 / 10
+        subscription.notifyupdate(f'{i % len(epics) + 1}|{bid:.1f}|{bid + 0.5:.1f}|12:00:{i // 1000 % 60:02d}')
+        if len(ticks) >= 100:
+            for tick in ticks:
+                yield tick
+            ticks.clear()
+            await asyncio.sleep(0)
+    for tick in ticks:
+        yield tick
+
+
+async def measure(stream, epics) -> float:
+    """Ticks per second received from a stream."""
+    count = 0
+    first = last = 0.0
+    async for _ in stream(epics):
+        if count == 0:
+            first = time.perf_counter()
+        count += 1
+    last = time.perf_counter()
+    return count / (last - first)
+
+
+def main():
+    # pylint: disable=import-outside-toplevel
+    from app.modules.shards import ShardedStream
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=400_000)
+    parser.add_argument('--epics', type=int, default=40)
+    args = parser.parse_args()
+
+    epics = [f'CS.D.BENCH{i}.CFD.IP' for i in range(args.epics)]
+    rate = asyncio.run(measure(partial(fake_feed, updates=args.updates), epics))
+    print(f'in-process: {rate:10,.0f} ticks/s')
+    for shards in (1, 2, 4):
+        # Each shard decodes its share of the updates.
+        feed = partial(fake_feed, updates=args.updates // shards)
+        rate = asyncio.run(measure(ShardedStream(feed, shards).stream, epics))
+        print(f'{shards} shard{"s" if shards > 1 else " "}:   {rate:10,.0f} ticks/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import asyncio
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from app.modules.backfill import Backfill, windows
+from app.modules.broker_integrations.ig_integration import IGIntegration, ig_time_to_ns
+from app.modules.price_store import PriceStore
+
+DAY = 86400 * 10 ** 9
+
+
+async def mock_prices(version, method, path, params):
+    start = datetime.fromisoformat(params['from'])
+    end = datetime.fromisoformat(params['to'])
+    return {'prices': [{
+        'snapshotTimeUTC': (start + timedelta(days=i)).isoformat(),
+        'openPrice': {'bid': i, 'ask': i + 1}, 'closePrice': {'bid': i, 'ask': i + 1},
+        'highPrice': {'bid': i, 'ask': i + 1}, 'lowPrice': {'bid': i, 'ask': i + 1}, 'lastTradedVolume': 10,
+    } for i in range((end - start).days + 1)]}
+
+
+class BackfillTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_windows(self):
+        self.assertEqual(windows('DAY', 0, 25 * DAY, candles=10), [(0, 10 * DAY), (10 * DAY, 20 * DAY),
+                                                                   (20 * DAY, 25 * DAY)])
+        self.assertEqual(windows('DAY', 5 * DAY, 12 * DAY, candles=10), [(5 * DAY, 10 * DAY), (10 * DAY, 12 * DAY)])
+        self.assertEqual(windows('DAY', 5 * DAY, 5 * DAY, candles=10), [])
+
+    async def test_run_and_resume(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = PriceStore(folder)
+            api = IGIntegration('key', 'account', 'user', 'pass', price_store=store)
+            start, end = ig_time_to_ns('2022-01-01'), ig_time_to_ns('2022-03-01')
+            job = Backfill(api, ['TSLA', 'EURUSD'], 'DAY', start, end, concurrency=3, candles=10)
+            self.assertEqual(len(job.pending()), 14)
+
+            failing = ig_time_to_ns('2022-02-07')
+
+            async def flaky_prices(version, method, path, params):
+                if ig_time_to_ns(params['from']) == failing and path == '/prices/TSLA':
+                    raise asyncio.TimeoutError()
+                return await mock_prices(version, method, path, params)
+
+            with mock.patch('app.modules.broker_integrations.ig_integration.IGIntegration._IGIntegration__make_request',
+                            side_effect=flaky_prices) as mock_make_request:
+                self.assertEqual(await job.run(), 1)
+                self.assertEqual(mock_make_request.call_count, 14)
+                self.assertEqual(job.stored, 59 * 2 - 10)
+
+            resumed = Backfill(api, ['TSLA', 'EURUSD'], 'DAY', start, end, candles=10)
+            self.assertEqual(resumed.pending(), [('TSLA', failing, failing + 10 * DAY)])
+            with mock.patch('app.modules.broker_integrations.ig_integration.IGIntegration._IGIntegration__make_request',
+                            side_effect=mock_prices) as mock_make_request:
+                self.assertEqual(await resumed.run(), 0)
+                mock_make_request.assert_called_once()
+
+            candles = await store.read_candles('TSLA', 'DAY', start, end)
+            self.assertEqual(len(candles), 59)
+            self.assertTrue(candles['time_stamp'].is_monotonic_increasing)
+
+
+if __name__ == '__main__':
+    unittest.main()
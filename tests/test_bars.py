@@ -0,0 +1,105 @@
+import asyncio
+import tempfile
+import time
+import unittest
+
+import pandas as pd
+
+from app.modules.bars import BarAggregator
+from app.modules.broker_integrations.base_integration import Tick, epic_table
+from app.modules.price_store import PriceStore
+
+SECOND = 10 ** 9
+
+
+class MockPublisher:
+    def __init__(self):
+        self.messages = []
+
+    async def broadcast(self, topic, message):
+        self.messages.append((topic, message))
+
+
+class BarAggregatorTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_update(self):
+        aggregator = BarAggregator(resolutions={'1s': SECOND, '1m': 60 * SECOND})
+        events = aggregator.update('TSLA', 0, 10, 11)
+        self.assertEqual([(resolution, closed) for resolution, _, closed in events], [('1s', False), ('1m', False)])
+
+        aggregator.update('TSLA', SECOND // 2, 12, 13)
+        aggregator.update('TSLA', SECOND // 2, 9, 10)
+        events = aggregator.update('TSLA', SECOND, 10, 11)
+        self.assertEqual([(resolution, closed) for resolution, _, closed in events],
+                         [('1s', True), ('1s', False), ('1m', False)])
+
+        closed = events[0][1]
+        self.assertEqual((closed.open_bid, closed.high_bid, closed.low_bid, closed.close_bid), (10, 12, 9, 9))
+        self.assertEqual((closed.open_ask, closed.high_ask, closed.low_ask, closed.close_ask), (11, 13, 10, 10))
+        self.assertEqual(closed.volume, 3)
+
+        minute = events[2][1]
+        self.assertEqual((minute.time_stamp, minute.high_bid, minute.close_bid, minute.volume), (0, 12, 10, 4))
+        late = aggregator.update('TSLA', 0, 1, 1)
+        self.assertEqual([resolution for resolution, _, _ in late], ['1m'], msg='Ticks for closed bars are ignored')
+
+    def test_close_expired(self):
+        aggregator = BarAggregator(resolutions={'1s': SECOND, '1m': 60 * SECOND})
+        aggregator.update('TSLA', 0, 10, 11)
+        expired = aggregator.close_expired(2 * SECOND)
+        self.assertEqual([(epic, resolution) for epic, resolution, _ in expired], [('TSLA', '1s')])
+        self.assertEqual(list(aggregator.bars), [('TSLA', '1m')])
+
+        # A tick arriving after its bar expired does not open a second bar for the period.
+        aggregator.close_expired(61 * SECOND)
+        late = aggregator.update('TSLA', 59 * SECOND, 12, 13)
+        self.assertEqual([resolution for resolution, _, _ in late], ['1s'])
+        self.assertNotIn(('TSLA', '1m'), aggregator.bars)
+        self.assertIn(('1m', False), [(resolution, closed) for resolution, _, closed in
+                                      aggregator.update('TSLA', 60 * SECOND, 12, 13)])
+
+    def test_close_expired_broker_time(self):
+        aggregator = BarAggregator(resolutions={'1s': SECOND})
+        aggregator.update('TSLA', 10 * SECOND, 10, 11)
+        # The broker's clock is 5s behind, so its bar has not ended yet in broker time.
+        self.assertEqual(aggregator.close_expired(12 * SECOND, {'TSLA': -5 * SECOND}), [])
+        self.assertEqual(len(aggregator.close_expired(16 * SECOND, {'TSLA': -5 * SECOND})), 1)
+
+    async def test_publish_and_persist(self):
+        with tempfile.TemporaryDirectory() as folder:
+            publisher, store = MockPublisher(), PriceStore(folder)
+            aggregator = BarAggregator(publisher, store, resolutions={'1s': SECOND})
+
+            async def ticks():
+                for i in range(5):
+                    yield Tick(epic_table.intern('TSLA'), i * SECOND // 2, i * SECOND // 2, 10 + i, 11 + i)
+
+            await aggregator.consume(ticks())
+            self.assertEqual(len(publisher.messages), 7, msg='5 partial and 2 closed bars should be published')
+            self.assertEqual(publisher.messages[0][0], 'ochl:1s:TSLA')
+            self.assertIn('"closed": true', publisher.messages[2][1])
+
+            await store.flush()
+            bars = pd.concat(map(pd.read_parquet, store.get_bar_files('TSLA', '1s')))
+            self.assertEqual(bars['open_bid'].tolist(), [10, 12])
+            self.assertEqual(bars['volume'].tolist(), [2, 2])
+
+    async def test_shutdown(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = PriceStore(folder)
+            aggregator = BarAggregator(store=store, resolutions={'1s': SECOND, '1h': 3600 * SECOND})
+            now = time.time_ns()
+            time_stamp = now - now % (3600 * SECOND) + 10 * SECOND
+            await aggregator.on_tick('TSLA', time_stamp, 10, 11)
+            closer = asyncio.create_task(aggregator.close_periodically(frequency=60))
+            await asyncio.sleep(0)
+            # The broker's clock is now 2s after the tick, so its 1s bar has ended and its hour bar has not.
+            aggregator.clock_offsets['TSLA'] = time_stamp + 2 * SECOND - time.time_ns()
+            closer.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await closer
+            # The ended bar is persisted, the open bar is left for the next aggregator to rebuild.
+            self.assertEqual(list(store.bar_accumulators), [('TSLA', '1s')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import json
+import unittest
+
+from app.modules.broker_integrations.base_integration import EpicTable, Tick, epic_table, ticks_to_array
+
+
+class TickTestCase(unittest.TestCase):
+    def test_epic_table(self):
+        table = EpicTable()
+        self.assertEqual([table.intern(epic) for epic in ['A', 'B', 'A']], [0, 1, 0])
+        self.assertEqual(table.names, ['A', 'B'])
+        self.assertEqual(len(table), 2)
+
+    def test_serialisation(self):
+        tick = Tick(epic_table.intern('CS.D.EURUSD.CFD.IP'), 1_697_464_618_000_000_000, 1_697_464_618_012_345_678,
+                    1.05412, 1.05421)
+        self.assertEqual(tick.epic, 'CS.D.EURUSD.CFD.IP')
+        self.assertEqual(json.loads(tick.to_json()), {
+            'epic': 'CS.D.EURUSD.CFD.IP', 'time_stamp': 1_697_464_618_000_000_000,
+            'received': 1_697_464_618_012_345_678, 'bid': 1.05412, 'ask': 1.05421})
+        self.assertEqual(Tick.from_bytes(tick.to_bytes()), tick)
+
+        array = ticks_to_array([tick, tick._replace(bid=1.5)])
+        self.assertEqual(list(array['bid']), [1.05412, 1.5])
+        self.assertEqual(int(array['time_stamp'][0]), tick.time_stamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
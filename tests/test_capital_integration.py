@@ -1,8 +1,14 @@
+import asyncio
 import os
 import unittest
+from unittest import mock
 
-from app.modules.broker_integrations.base_integration import NewPositionDetails
-from app.modules.broker_integrations.capital_integration import CapitalIntegration
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.modules.broker_integrations.base_integration import NewPositionDetails, stream_gaps
+from app.modules.broker_integrations.capital_integration import CapitalAPIException, CapitalIntegration
+from app.modules.broker_integrations.sessions import close_sessions
 
 CAPITAL_API_KEY = os.environ.get('CAPITAL_API_KEY')
 CAPITAL_USER = os.environ.get('CAPITAL_USER')
@@ -10,6 +16,8 @@ CAPITAL_PASS = os.environ.get('CAPITAL_PASS')
 
 
 class CapitalTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await close_sessions()
 
     async def test_stream(self):
         client = CapitalIntegration(CAPITAL_USER, CAPITAL_API_KEY, CAPITAL_PASS, demo=True)
@@ -59,6 +67,98 @@ class CapitalTestCase(unittest.IsolatedAsyncioTestCase):
             f"I´ve made {result['profit']}$ of profit!"
         )
 
+    async def test_candles(self):
+        """Tests that a prices response is normalised to the common candle schema, keeping missing prices as null."""
+        prices = {'prices': [{
+            'snapshotTime': '2022-04-06T14:00:00', 'snapshotTimeUTC': '2022-04-06T13:00:00',
+            'openPrice': {'bid': 1.0, 'ask': 1.5}, 'closePrice': {'bid': 2.0, 'ask': 2.5},
+            'highPrice': {'bid': 3.0, 'ask': 3.5}, 'lowPrice': {'bid': 0.5, 'ask': 1.0}, 'lastTradedVolume': 7,
+        }, {
+            'snapshotTime': '2022-04-06T14:01:00', 'snapshotTimeUTC': '2022-04-06T13:01:00',
+            'openPrice': {'bid': 1.0}, 'closePrice': {'bid': 2.0}, 'highPrice': {'bid': 3.0}, 'lowPrice': {'bid': 0.5},
+            'lastTradedVolume': 3,
+        }]}
+        client = CapitalIntegration(CAPITAL_USER, CAPITAL_API_KEY, CAPITAL_PASS, demo=True)
+        with mock.patch('app.modules.broker_integrations.capital_integration.CapitalIntegration.'
+                        '_CapitalIntegration__auth_request', return_value=prices) as auth_request:
+            candles = (await client.candles('TSLA')).to_pandas()
+            await client.candles('TSLA', start='2022-04-06T13:00:00', end='2022-04-06T14:00:00')
+
+        self.assertEqual(auth_request.call_args[0][1], '/api/v1/prices/TSLA?resolution=MINUTE&max=10'
+                                                       '&from=2022-04-06T13:00:00&to=2022-04-06T14:00:00')
+
+        self.assertEqual(str(candles['time_stamp'][1]), '2022-04-06 13:01:00+00:00')
+        self.assertEqual(list(candles['high_ask'][:1]), [3.5])
+        self.assertTrue(candles['open_ask'][1:].isna().all())
+        self.assertEqual(list(candles['volume']), [7, 3])
+
+    async def test_stream_reconnects(self):
+        """Tests that the stream subscribes again after the websocket is closed by the server."""
+        connections = []
+
+        async def connect(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            connections.append(await ws.receive_json())
+            await ws.send_json({'status': 'OK', 'destination': 'marketData.subscribe',
+                                'payload': {'subscriptions': {'OIL_CRUDE': 'PROCESSED'}}})
+            await ws.send_json({'status': 'OK', 'destination': 'quote', 'payload': {
+                'epic': 'OIL_CRUDE', 'bid': len(connections), 'ofr': 2.0, 'timestamp': 1649250000000}})
+            if len(connections) > 1:
+                await ws.receive()
+            return ws
+
+        app = web.Application()
+        app.router.add_get('/connect', connect)
+        async with TestServer(app) as test_server:
+            client = CapitalIntegration(CAPITAL_USER, CAPITAL_API_KEY, CAPITAL_PASS, demo=True)
+            client.stream_url = str(test_server.make_url('/connect'))
+            with mock.patch('app.modules.broker_integrations.capital_integration.CapitalIntegration.'
+                            '_CapitalIntegration__token', return_value=('XST', 'CST')):
+                stream = client.stream(['OIL_CRUDE'])
+                ticks = [await asyncio.wait_for(stream.__anext__(), 2) for _ in range(2)]
+                await stream.aclose()
+
+        self.assertEqual([tick.bid for tick in ticks], [1, 2])
+        self.assertEqual(ticks[0].time_stamp, 1649250000000 * 10 ** 6)
+        self.assertEqual(ticks[0].epic, 'OIL_CRUDE')
+        self.assertEqual([message['correlationId'] for message in connections], [1, 2])
+        self.assertEqual(connections[1]['payload'], {'epics': ['OIL_CRUDE']})
+        self.assertEqual(stream_gaps[-1].broker, 'Capital.com')
+        self.assertLessEqual(stream_gaps[-1].start, stream_gaps[-1].end)
+
+    async def test_stream_not_subscribed(self):
+        """Tests that the stream raises instead of reconnecting when it is closed or rejected before subscribing."""
+        replies = [
+            None,
+            {'status': 'ERROR', 'destination': 'marketData.subscribe',
+             'payload': {'errorCode': 'error.invalid.session.token'}},
+            {'status': 'OK', 'destination': 'marketData.subscribe',
+             'payload': {'subscriptions': {'OIL_CRUDE': 'ERROR: invalid.epic'}}},
+        ]
+
+        async def connect(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.receive_json()
+            if reply is not None:
+                await ws.send_json(reply)
+                await ws.receive()
+            return ws
+
+        app = web.Application()
+        app.router.add_get('/connect', connect)
+        async with TestServer(app) as test_server:
+            client = CapitalIntegration(CAPITAL_USER, CAPITAL_API_KEY, CAPITAL_PASS, demo=True)
+            client.stream_url = str(test_server.make_url('/connect'))
+            with mock.patch('app.modules.broker_integrations.capital_integration.CapitalIntegration.'
+                            '_CapitalIntegration__token', return_value=('XST', 'CST')):
+                for reply, error in zip(replies, (ConnectionError, CapitalAPIException, CapitalAPIException)):
+                    with self.subTest(reply=reply), self.assertRaises(error) as context:
+                        await asyncio.wait_for(client.stream(['OIL_CRUDE']).__anext__(), 2)
+                    if reply is not None:
+                        self.assertTrue(context.exception.code)
+
     # TODO: write a test case for when the market is closed, assert the correct exception is raised.
 
 
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from app.modules.coverage import CoverageIndex
+
+
+class CoverageIndexTestCase(unittest.TestCase):
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as folder:
+            index = CoverageIndex(os.path.join(folder, 'coverage.json'))
+            self.assertEqual(index.missing('TSLA', 'DAY', 0, 100), [(0, 100)])
+
+            index.add('TSLA', 'DAY', 10, 20)
+            index.add('TSLA', 'DAY', 40, 50)
+            self.assertEqual(index.missing('TSLA', 'DAY', 0, 100), [(0, 10), (20, 40), (50, 100)])
+            self.assertEqual(index.missing('TSLA', 'DAY', 12, 45), [(20, 40)])
+            self.assertEqual(index.missing('TSLA', 'DAY', 12, 18), [])
+            self.assertEqual(index.missing('TSLA', 'HOUR', 12, 18), [(12, 18)])
+
+    def test_add_merges_and_persists(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coverage.json')
+            index = CoverageIndex(path)
+            index.add('TSLA', 'DAY', 10, 20)
+            index.add('TSLA', 'DAY', 30, 40)
+            index.add('TSLA', 'DAY', 20, 30)
+            index.add('TSLA', 'DAY', 5, 5)
+            self.assertEqual(index.covered('TSLA', 'DAY'), [(10, 40)])
+
+            other = CoverageIndex(path)
+            self.assertEqual(other.covered('TSLA', 'DAY'), [(10, 40)])
+            other.add('TSLA', 'DAY', 50, 60)
+            os.utime(path, ns=(0, 0))  # Make sure the change is seen even on coarse mtime file systems.
+            self.assertEqual(index.covered('TSLA', 'DAY'), [(10, 40), (50, 60)])
+
+    def test_concurrent_add(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'coverage.json')
+            first, second = CoverageIndex(path), CoverageIndex(path)
+            first.add('TSLA', 'DAY', 10, 20)
+            self.assertEqual(second.covered('TSLA', 'DAY'), [(10, 20)])
+            first.add('TSLA', 'DAY', 30, 40)
+            os.utime(path, ns=(second._mtime, second._mtime))  # pylint: disable=protected-access
+            # The second index adds its interval to the latest file, even though it looks unchanged.
+            second.add('TSLA', 'DAY', 50, 60)
+            self.assertEqual(CoverageIndex(path).covered('TSLA', 'DAY'), [(10, 20), (30, 40), (50, 60)])
+
+
+if __name__ == '__main__':
+    unittest.main()
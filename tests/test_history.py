@@ -0,0 +1,103 @@
+import io
+import json
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+
+from app.modules.history import datetime_to_ns, encode_arrow, encode_csv, encode_ndjson, history_schema, \
+    iter_bars, iter_history, read_history, resolve_columns
+from app.modules.price_store import PriceStore
+
+START = datetime(2023, 10, 17, 9)
+
+
+class HistoryTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = PriceStore(self.folder.name)
+        for i in range(180):  # One tick every 20 seconds for an hour.
+            t = datetime_to_ns(START + timedelta(seconds=20 * i))
+            self.store.store_price('TSLA', {'t': t, 'bid': 100 + i, 'ask': 101 + i})
+        await self.store.flush()
+
+    async def asyncTearDown(self):
+        self.folder.cleanup()
+
+    def test_read_ticks(self):
+        ticks = read_history(self.store, 'TSLA', START + timedelta(minutes=1), START + timedelta(minutes=2),
+                             columns=['bid'])
+        self.assertEqual(list(ticks.columns), ['time_stamp', 'bid'])
+        self.assertEqual(ticks['bid'].tolist(), [103, 104, 105, 106])
+
+    def test_read_bars(self):
+        bars = read_history(self.store, 'TSLA', START, START + timedelta(minutes=5) - timedelta(seconds=1),
+                            resolution='MINUTE', columns=['open_bid', 'close_bid', 'volume'])
+        self.assertEqual(list(bars.columns), ['time_stamp', 'open_bid', 'close_bid', 'volume'])
+        self.assertEqual(bars['open_bid'].tolist(), [100, 103, 106, 109, 112])
+        self.assertEqual(bars['close_bid'].tolist(), [102, 105, 108, 111, 114])
+        self.assertEqual(bars['volume'].tolist(), [3] * 5)
+
+    def test_read_outside_range(self):
+        ticks = read_history(self.store, 'TSLA', START - timedelta(days=1), START - timedelta(hours=1))
+        self.assertEqual(len(ticks), 0)
+        self.assertTrue(self.store.has_prices('TSLA'))
+        self.assertFalse(self.store.has_prices('EURUSD'))
+
+    async def test_read_during_compaction(self):
+        self.store.store_price('TSLA', {'t': datetime_to_ns(START + timedelta(seconds=10)), 'bid': 1, 'ask': 2})
+        await self.store.flush()
+        ticks = iter_history(self.store, 'TSLA', START, START + timedelta(hours=1), columns=['bid'])
+        first = next(ticks)
+        # The partition was read under its lock, which is not held while its batches are consumed.
+        await self.store.compact()
+        self.assertEqual(len(self.store.get_price_files('TSLA')), 1)
+        rows = first.num_rows + sum(batch.num_rows for batch in ticks)
+        self.assertEqual(rows, 181)
+        self.assertEqual(len(read_history(self.store, 'TSLA', START, START + timedelta(hours=1))), 181)
+
+    def test_bars_across_batches(self):
+        ticks = list(iter_history(self.store, 'TSLA', START, START + timedelta(hours=1), columns=['bid']))
+        small_batches = [batch.slice(i, 7) for batch in ticks for i in range(0, batch.num_rows, 7)]
+        bars = pa.Table.from_batches(list(iter_bars(small_batches, 'MINUTE', ['open_bid', 'close_bid', 'volume'])))
+        self.assertEqual(bars.column('volume').to_pylist(), [3] * 60)
+        self.assertEqual(bars.column('open_bid').to_pylist(), list(range(100, 280, 3)))
+        self.assertEqual(bars.column('close_bid').to_pylist(), list(range(102, 280, 3)))
+
+    def test_stream_formats(self):
+        end = START + timedelta(minutes=1)
+        schema = history_schema('TICK', ['bid'])
+
+        arrow = b''.join(encode_arrow(iter_history(self.store, 'TSLA', START, end, columns=['bid']), schema))
+        self.assertEqual(pa.ipc.open_stream(arrow).read_all().column('bid').to_pylist(), [100, 101, 102, 103])
+
+        ndjson = b''.join(encode_ndjson(iter_history(self.store, 'TSLA', START, end, columns=['bid']), schema))
+        rows = [json.loads(line) for line in ndjson.splitlines() if line]
+        self.assertEqual([row['bid'] for row in rows], [100, 101, 102, 103])
+
+        csv = b''.join(encode_csv(iter_history(self.store, 'TSLA', START, end, columns=['bid']), schema))
+        lines = io.BytesIO(csv).read().decode().splitlines()
+        self.assertEqual(lines[0], 'time_stamp,bid')
+        self.assertEqual(len(lines), 5)
+
+    def test_nan_formats(self):
+        schema = history_schema('MINUTE', ['open_bid', 'volume'])
+        batch = pa.RecordBatch.from_arrays([pa.array([0, 60 * 10 ** 9], schema.field('time_stamp').type),
+                                            pa.array([float('nan'), 1.5]), pa.array([0, 2])], schema=schema)
+
+        ndjson = b''.join(encode_ndjson([batch], schema))
+        self.assertEqual([json.loads(line)['open_bid'] for line in ndjson.splitlines()], [None, 1.5])
+
+        csv = b''.join(encode_csv([batch], schema)).decode().splitlines()
+        self.assertEqual([line.split(',')[1] for line in csv[1:]], ['', '1.5'])
+
+    def test_resolve_columns(self):
+        self.assertEqual(resolve_columns('TICK', None), ['bid', 'ask', 'volume'])
+        self.assertEqual(resolve_columns('MINUTE', ['volume', 'open_ask']), ['open_ask', 'volume'])
+        with self.assertRaises(ValueError):
+            resolve_columns('TICK', ['open_bid'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
 import os
+import tempfile
 import unittest
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
 from app.modules.broker_integrations.base_integration import NewPositionDetails
 from app.modules.broker_integrations.ig_integration import IGIntegration
+from app.modules.broker_integrations.ig_stream import parse_update_time, uk_midnight_ns
+from app.modules.broker_integrations.sessions import close_sessions
+from app.modules.price_store import PriceStore
 
 IG_API_KEY = os.environ.get('IG_API_KEY')
 IG_ACCOUNT = os.environ.get('IG_ACCOUNT')
@@ -30,6 +35,8 @@ class MockAsyncResponse:
 
 
 class IGIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await close_sessions()
 
     async def test_make_session(self):
         api = IGIntegration(IG_API_KEY, IG_ACCOUNT, IG_USER, IG_PASS)
@@ -130,6 +137,49 @@ class IGIntegrationTestCase(unittest.IsolatedAsyncioTestCase):
                                                          'timeInForce': None, 'quoteId': None})
         mock_get_close_deal_details.assert_called_with(mock_open_response['dealReference'])
 
+    async def test_historical_data_gaps(self):
+        """Tests that only ranges missing from the store are requested from IG."""
+
+        async def mock_prices(version, method, path, params):
+            start = datetime.fromisoformat(params['from'])
+            end = datetime.fromisoformat(params['to'])
+            days = (end - start).days + 1
+            return {'prices': [{
+                'snapshotTimeUTC': (start + timedelta(days=i)).isoformat(),
+                'openPrice': {'bid': i, 'ask': i + 1}, 'closePrice': {'bid': i, 'ask': i + 1},
+                'highPrice': {'bid': i, 'ask': i + 1}, 'lowPrice': {'bid': i, 'ask': i + 1}, 'lastTradedVolume': 10,
+            } for i in range(days)]}
+
+        with tempfile.TemporaryDirectory() as folder:
+            api = IGIntegration(IG_API_KEY, IG_ACCOUNT, IG_USER, IG_PASS, price_store=PriceStore(folder))
+            with mock.patch('app.modules.broker_integrations.ig_integration.IGIntegration._IGIntegration__make_request',
+                            side_effect=mock_prices) as mock_make_request:
+                result = await api.get_historical_data('TSLA', 'DAY', start='2022-02-05', end='2022-02-10')
+                self.assertEqual(len(result), 5)
+                mock_make_request.assert_called_once()
+                self.assertEqual(mock_make_request.call_args.kwargs['params']['to'], '2022-02-09T23:59:59')
+
+                mock_make_request.reset_mock()
+                result = await api.get_historical_data('TSLA', 'DAY', start='2022-02-06', end='2022-02-08')
+                self.assertEqual(len(result), 2)
+                mock_make_request.assert_not_called()
+
+                result = await api.get_historical_data('TSLA', 'DAY', start='2022-02-01', end='2022-02-12')
+                self.assertEqual(len(result), 11)
+                self.assertEqual([call.kwargs['params']['from'] for call in mock_make_request.call_args_list],
+                                 ['2022-02-01T00:00:00', '2022-02-10T00:00:00'])
+                self.assertEqual(result['time_stamp'].is_unique, True)
+
+    def test_update_time(self):
+        self.assertEqual(parse_update_time('13:56:58'), 13 * 3600 + 56 * 60 + 58)
+        with self.assertRaises(ValueError):
+            parse_update_time('1:56:58')
+
+        # 00:30 BST on the 16th is 23:30 UTC on the 15th.
+        now = datetime(2023, 10, 15, 23, 30, tzinfo=timezone.utc)
+        self.assertEqual(uk_midnight_ns(int(now.timestamp()) * 10 ** 9),
+                         int(datetime(2023, 10, 15, 23, tzinfo=timezone.utc).timestamp()) * 10 ** 9)
+
 
 if __name__ == '__main__':
     unittest.main()
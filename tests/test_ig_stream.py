@@ -0,0 +1,167 @@
+import asyncio
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.modules.broker_integrations.base_integration import stream_gaps
+from app.modules.broker_integrations.ig_stream import IGStreamManager
+from app.modules.broker_integrations.lightstreamer import ItemUpdate
+from app.modules.broker_integrations.sessions import close_sessions
+
+
+class MockLightstreamer:
+    """Serves sessions which push an update for every table as soon as it is added, until END is pushed."""
+
+    def __init__(self):
+        self.sessions = 0
+        self.controls = []
+        self.lines = asyncio.Queue()
+        self.app = web.Application()
+        self.app.router.add_post('/lightstreamer/create_session.txt', self.create_session)
+        self.app.router.add_post('/lightstreamer/control.txt', self.control)
+
+    async def create_session(self, request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        self.sessions += 1
+        await response.write(f'OK\r\nSessionId:S{self.sessions}\r\n\r\n'.encode())
+        while (line := await self.lines.get()) is not None:
+            await response.write(f'{line}\r\n'.encode())
+            if line == 'END':
+                break
+        return response
+
+    async def control(self, request):
+        control = dict(await request.post())
+        self.controls.append(control)
+        if control['LS_op'] == 'add':
+            self.lines.put_nowait(f"{control['LS_Table']},1|1.5|1.6|12:00:01")
+        elif control['LS_op'] == 'destroy':
+            self.lines.put_nowait(None)
+        return web.Response(text='OK\r\n')
+
+
+class MockIntegration:
+    account_id = 'ACCOUNT'
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.sessions = 0
+
+    async def create_session(self):
+        self.sessions += 1
+        return {'lightstreamerEndpoint': self.endpoint}
+
+    async def get_session_tokens(self):
+        return 'XST', 'CST'
+
+
+class IGStreamManagerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await close_sessions()
+
+    async def test_shared_session(self):
+        server = MockLightstreamer()
+        async with TestServer(server.app) as test_server:
+            integration = MockIntegration(str(test_server.make_url('/')))
+            manager = IGStreamManager(integration)
+
+            first = manager.stream(['A', 'B', 'A'])
+            ticks = [await asyncio.wait_for(first.__anext__(), 1) for _ in range(2)]
+            self.assertEqual([tick.epic for tick in ticks], ['A', 'B'])
+            self.assertEqual((ticks[0].bid, ticks[0].ask), (1.5, 1.6))
+
+            # The second consumer shares the session, only the new epic is added to it. It starts with the latest
+            # tick of the epic which was already subscribed.
+            second = manager.stream(['B', 'C'])
+            self.assertEqual([(await asyncio.wait_for(second.__anext__(), 1)).epic for _ in range(2)], ['B', 'C'])
+            self.assertEqual(integration.sessions, 1)
+            self.assertEqual(manager.stats()['epics'], {'A': 1, 'B': 2, 'C': 1})
+
+            # Updates of a shared epic reach every consumer.
+            server.lines.put_nowait('2,1|1.7||')
+            self.assertEqual((await asyncio.wait_for(first.__anext__(), 1)).bid, 1.7)
+            self.assertEqual((await asyncio.wait_for(second.__anext__(), 1)).bid, 1.7)
+
+            # Closing the first consumer only deletes the epic nobody else streams.
+            await first.aclose()
+            self.assertEqual([(control['LS_op'], control.get('LS_id')) for control in server.controls], [
+                ('add', 'MARKET:A'), ('add', 'MARKET:B'), ('add', 'MARKET:C'), ('delete', None)])
+            self.assertEqual(server.controls[-1]['LS_Table'], '1')
+            self.assertEqual(manager.stats()['epics'], {'B': 1, 'C': 1})
+
+            await manager.close()
+            await second.aclose()
+            self.assertEqual(server.controls[-1]['LS_op'], 'destroy')
+            self.assertEqual(manager.stats(), {'connected': False, 'sessions': 1, 'epics': {}})
+
+    async def test_failed_subscription(self):
+        server = MockLightstreamer()
+        async with TestServer(server.app) as test_server:
+            manager = IGStreamManager(MockIntegration(str(test_server.make_url('/'))))
+            stream = manager.stream(['A'])
+            await asyncio.wait_for(stream.__anext__(), 1)
+
+            async def fail(_):
+                raise ConnectionError('Control request failed')
+
+            add_table = manager._add_table  # pylint: disable=protected-access
+            manager._add_table = fail  # pylint: disable=protected-access
+            with self.assertRaises(ConnectionError):
+                await manager.stream(['A', 'B']).__anext__()
+            manager._add_table = add_table  # pylint: disable=protected-access
+            self.assertEqual(manager.stats()['epics'], {'A': 1})
+            self.assertEqual(list(manager.tables), ['A'])
+
+            await stream.aclose()
+            await manager.close()
+
+    def test_update_time_day(self):
+        """Tests that an UPDATE_TIME is placed on the UK day bringing it closest to the time it was received."""
+        def time_stamp(now: datetime, update_time: int) -> datetime:
+            manager = IGStreamManager(None)
+            with mock.patch('time.time_ns', return_value=int(now.timestamp()) * 10 ** 9):
+                # pylint: disable=protected-access
+                manager._on_update('A', 0, ItemUpdate(1, 'MARKET:A', (1.5, 1.6, update_time)))
+            return datetime.fromtimestamp(manager.last_ticks['A'].time_stamp / 10 ** 9, timezone.utc)
+
+        # A live update, at 08:00:01 BST.
+        self.assertEqual(time_stamp(datetime(2023, 10, 16, 7, 0, 2, tzinfo=timezone.utc), 8 * 3600 + 1),
+                         datetime(2023, 10, 16, 7, 0, 1, tzinfo=timezone.utc))
+        # The snapshot of a market which last traded at 21:00 the evening before.
+        self.assertEqual(time_stamp(datetime(2023, 10, 16, 7, tzinfo=timezone.utc), 21 * 3600),
+                         datetime(2023, 10, 15, 20, tzinfo=timezone.utc))
+        # An update sent at 23:59:59 GMT, received after midnight.
+        self.assertEqual(time_stamp(datetime(2023, 12, 1, 0, 0, 1, tzinfo=timezone.utc), 24 * 3600 - 1),
+                         datetime(2023, 11, 30, 23, 59, 59, tzinfo=timezone.utc))
+        # An update sent at 00:00:01 BST, received before midnight by a host clock running slow.
+        self.assertEqual(time_stamp(datetime(2023, 10, 15, 22, 59, 59, tzinfo=timezone.utc), 1),
+                         datetime(2023, 10, 15, 23, 0, 1, tzinfo=timezone.utc))
+
+    async def test_recovery(self):
+        server = MockLightstreamer()
+        async with TestServer(server.app) as test_server:
+            integration = MockIntegration(str(test_server.make_url('/')))
+            manager = IGStreamManager(integration)
+
+            stream = manager.stream(['A'])
+            await asyncio.wait_for(stream.__anext__(), 1)
+
+            # The epic is subscribed again on a new session, whose snapshot is the next tick.
+            server.lines.put_nowait('END')
+            self.assertEqual((await asyncio.wait_for(stream.__anext__(), 2)).epic, 'A')
+            self.assertEqual(integration.sessions, 2)
+            self.assertEqual([(control['LS_session'], control['LS_snapshot']) for control in server.controls],
+                             [('S1', 'true'), ('S2', 'true')])
+            self.assertEqual(stream_gaps[-1].broker, 'IG')
+            self.assertEqual(stream_gaps[-1].epics, ('A',))
+
+            await stream.aclose()
+            await manager.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.modules.broker_integrations.lightstreamer import ItemUpdate, LSClient, Subscription, async_adapter
+from app.modules.broker_integrations.sessions import close_sessions
+
+
+class MockLightstreamer:
+    """Serves a single session which loops (asking for a rebind) after its first update."""
+
+    def __init__(self):
+        self.controls = []
+        self.rejected = set()  # Items whose subscription is rejected.
+        self.subscribed = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.app = web.Application()
+        self.app.router.add_post('/lightstreamer/create_session.txt', self.create_session)
+        self.app.router.add_post('/lightstreamer/bind_session.txt', self.bind_session)
+        self.app.router.add_post('/lightstreamer/control.txt', self.control)
+
+    async def stream(self, request, lines):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for line in lines:
+            if line is None:
+                await self.subscribed.wait()
+            else:
+                await response.write(f'{line}\r\n'.encode())
+        return response
+
+    async def create_session(self, request):
+        return await self.stream(request, ['OK', 'SessionId:S1', '', 'Preamble: test', 'PROBE', None,
+                                           '1,1|1.5|1.6|12:00:01', 'LOOP'])
+
+    async def bind_session(self, request):
+        response = await self.stream(request, ['OK', 'SessionId:S1', '', '1,1|1.7||', '1,2|#|$|12:00:03'])
+        await self.closed.wait()
+        return response
+
+    async def control(self, request):
+        self.controls.append(dict(await request.post()))
+        if self.controls[-1]['LS_op'] == 'add':
+            if self.controls[-1]['LS_id'] in self.rejected:
+                return web.Response(text='ERROR\r\n17\r\nData item not found\r\n')
+            self.subscribed.set()
+        return web.Response(text='OK\r\n')
+
+
+class SubscriptionTestCase(unittest.TestCase):
+    def test_converters(self):
+        updates = []
+        subscription = Subscription('MERGE', ['MARKET:A'], ['BID', 'OFFER', 'UPDATE_TIME'],
+                                    converters={'BID': float, 'OFFER': float})
+        subscription.addlistener(updates.append)
+        subscription.notifyupdate('1|1.5|1.6|12:00:01\r\n')
+        subscription.notifyupdate('1|1.7||')
+        subscription.notifyupdate('1|x|#|12:00:02')
+        self.assertEqual([update.values for update in updates], [
+            (1.5, 1.6, '12:00:01'), (1.7, 1.6, '12:00:01'), (None, None, '12:00:02')])
+        self.assertEqual(subscription.field_index('UPDATE_TIME'), 2)
+
+
+class LSClientTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await close_sessions()
+
+    async def test_stream(self):
+        server = MockLightstreamer()
+        async with TestServer(server.app) as test_server:
+            client = LSClient(str(test_server.make_url('/')), password='secret')
+            await client.connect()
+
+            updates, put = async_adapter()
+            subscription = Subscription('MERGE', ['MARKET:A', 'MARKET:B'], ['BID', 'OFFER', 'UPDATE_TIME'])
+            subscription.addlistener(put)
+            self.assertEqual(await client.subscribe(subscription), 1)
+
+            items = [await asyncio.wait_for(updates.__anext__(), 1) for _ in range(3)]
+            self.assertEqual(items[0], ItemUpdate(1, 'MARKET:A', ('1.5', '1.6', '12:00:01')))
+            # The update after the rebind keeps the unchanged values of the item.
+            self.assertEqual(items[1].values, ('1.7', '1.6', '12:00:01'))
+            self.assertEqual(items[2], ItemUpdate(2, 'MARKET:B', (None, '', '12:00:03')))
+
+            await client.destroy()
+            self.assertEqual([control['LS_op'] for control in server.controls], ['add', 'destroy'])
+            self.assertEqual(server.controls[0]['LS_id'], 'MARKET:A MARKET:B')
+            self.assertEqual(server.controls[0]['LS_session'], 'S1')
+            server.closed.set()
+
+    async def test_rejected_subscription(self):
+        server = MockLightstreamer()
+        server.rejected.add('MARKET:X')
+        async with TestServer(server.app) as test_server:
+            client = LSClient(str(test_server.make_url('/')), password='secret')
+            await client.connect()
+            with self.assertRaisesRegex(IOError, 'ERROR 17 Data item not found'):
+                await client.subscribe(Subscription('MERGE', ['MARKET:X'], ['BID']))
+            self.assertEqual(client._subscriptions, {})  # pylint: disable=protected-access
+            server.subscribed.set()
+            server.closed.set()
+            await client.destroy()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import asyncio
+import tempfile
+import unittest
+
+from app.modules.broker_integrations.base_integration import Tick, epic_table
+from app.modules.market_data import MarketDataHub, create_hub
+from app.modules.price_store import PriceStore
+
+SECOND = 10 ** 9
+
+
+class MockIntegration:
+    def __init__(self, ticks=10, fail=False):
+        self.ticks = ticks
+        self.fail = fail
+        self.streams = 0
+
+    async def stream(self, epics):
+        self.streams += 1
+        for i in range(self.ticks):
+            yield Tick(epic_table.intern(epics[i % len(epics)]), i * SECOND, i * SECOND, 1.0 + i, 2.0 + i)
+        if self.fail:
+            raise ConnectionError('Stream dropped')
+        await asyncio.Event().wait()
+
+
+class MarketDataHubTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_sink(self):
+        hub = MarketDataHub()
+        hub.add_stream('broker', MockIntegration(ticks=100).stream, ['A'])
+        fast = []
+
+        async def handle_fast(ticks):
+            fast.extend(ticks)
+
+        async def handle_slow(_):
+            await asyncio.sleep(10)
+
+        hub.add_sink('fast', handle_fast)
+        hub.add_sink('slow', handle_slow, maxsize=10)
+        hub.start()
+        await asyncio.sleep(0.05)
+        await hub.stop()
+
+        # The slow sink dropped the ticks it had no room for without holding back the fast sink.
+        self.assertEqual([tick.bid for tick in fast], [1.0 + i for i in range(100)])
+        stats = hub.stats()
+        self.assertEqual(stats['streams'], {'broker': 100})
+        self.assertEqual(stats['sinks']['slow']['dropped'], 90)
+        self.assertEqual(stats['sinks']['fast']['dropped'], 0)
+
+    async def test_durable_sink(self):
+        hub = MarketDataHub()
+        hub.add_stream('broker', MockIntegration(ticks=100).stream, ['A'])
+        handled = []
+
+        async def handle_slow(ticks):
+            await asyncio.sleep(0.01)
+            handled.extend(ticks)
+
+        hub.add_sink('durable', handle_slow, maxsize=50, durable=True)
+        hub.start()
+        with self.assertLogs('MarketDataHub', 'WARNING') as logs:
+            await asyncio.sleep(0.005)
+            await hub.stop()
+
+        # The ticks still queued when the hub stopped were handled, and the ticks dropped were logged.
+        dropped = hub.stats()['sinks']['durable']['dropped']
+        self.assertGreater(dropped, 0)
+        self.assertEqual(len(handled), 100 - dropped)
+        self.assertEqual(handled[-1].bid, 100.0)
+        self.assertIn(f'dropped {dropped} ticks', logs.output[0])
+
+    async def test_stream_restarts(self):
+        integration = MockIntegration(ticks=2, fail=True)
+        hub = MarketDataHub()
+        hub.add_stream('broker', integration.stream, ['A'])
+        hub.start()
+        await asyncio.sleep(0.3)
+        await hub.stop()
+        self.assertGreater(integration.streams, 1)
+        self.assertEqual(hub.stats()['streams']['broker'], 2 * integration.streams)
+
+    async def test_create_hub(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = PriceStore(folder)
+            config = {'epics': {'ig': ['IG.A', 'IG.B'], 'capital': ['CAP.A'], 'other': ['X']}}
+            hub = create_hub(config, {'ig': MockIntegration(), 'capital': MockIntegration()}, store=store)
+            self.assertEqual(list(hub.streams), ['ig', 'capital'])
+            self.assertEqual([sink.name for sink in hub.sinks], ['store', 'bars'])
+
+            hub.start()
+            await asyncio.sleep(0.05)
+            await hub.stop()
+            self.assertEqual(list(store.get_prices('IG.A')['bid']), [1.0, 3.0, 5.0, 7.0, 9.0])
+            self.assertEqual(len(store.get_prices('CAP.A')['bid']), 10)
+            # The bars closed by later ticks are persisted, the bars still open when the hub stops are not.
+            self.assertEqual(len(store.bar_accumulators[('IG.A', '1s')]), 4)
+            self.assertNotIn(('IG.A', '1h'), store.bar_accumulators)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import asyncio
 import os.path
+import tempfile
 import unittest
 
 import pandas as pd
@@ -7,30 +8,102 @@ import numpy as np
 from fastparquet import write
 
 from app.modules.price_store import PriceStore
+from app.modules.tick_buffer import TickBuffer
+
+
+class TickBufferTestCase(unittest.TestCase):
+    def test_append_and_grow(self):
+        buffer = TickBuffer(capacity=2)
+        for i in range(5):
+            buffer.append(i, 1.0 + i, 2.0 + i)
+
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.capacity, 8)
+        prices = buffer.view()
+        np.testing.assert_array_equal(prices['time_stamp'], [0, 1, 2, 3, 4])
+        np.testing.assert_array_equal(prices['ask'], [2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertTrue(np.isnan(prices['volume']).all())
+
+    def test_view_is_zero_copy(self):
+        buffer = TickBuffer()
+        buffer.append(1, 1.0, 2.0, 10.0)
+        prices = buffer.view()
+        self.assertTrue(np.shares_memory(prices['bid'], buffer.arrays['bid']))
+
+        buffer.append(2, 1.5, 2.5)
+        self.assertEqual(len(prices['bid']), 1, msg='Earlier views should be unaffected by later appends')
+
+    def test_bytes_per_tick(self):
+        ps = PriceStore('./data')
+        self.assertEqual(ps.bytes_per_tick, 32)
+        for i in range(1024):
+            ps.store_price('TSLA', {'t': i, 'bid': 1.0, 'ask': 2.0})
+        self.assertEqual(ps.bytes_per_tick, 32)
+        self.assertEqual(len(ps.get_prices('TSLA')['bid']), 1024)
+        self.assertEqual(len(ps.get_prices('EURUSD')['bid']), 0)
 
 
 class PriceStoreTestCase(unittest.IsolatedAsyncioTestCase):
     async def test_store_price(self):
-        self.skipTest('not implemented')
-        ps = PriceStore('./data', frequency=1)
+        with tempfile.TemporaryDirectory() as folder:
+            ps = PriceStore(folder, frequency=0.1)
 
-        async def test():
-            ps.store_price('TSLA', {'open': 10})
-            ps.store_price('TSLA', {'open': 12})
-            print(ps.accumulators)
-            self.assertEqual(len(ps.accumulators['TSLA']), 2)
-            await asyncio.sleep(2)
-            print(ps.accumulators)
-            ps.stop()
+            async def test():
+                ps.store_price('TSLA', {'t': 1, 'bid': 10, 'ask': 11})
+                ps.store_price('TSLA', {'t': 2, 'bid': 12, 'ask': 13})
+                self.assertEqual(len(ps.accumulators['TSLA']), 2)
+                await asyncio.sleep(0.3)
+                ps.store_price('TSLA', {'t': 3, 'bid': 14, 'ask': 15})
+                ps.stop()
+                self.assertEqual(len(ps.accumulators['TSLA']), 1)
+
+            await asyncio.gather(ps.start(), test())
             self.assertEqual(len(ps.accumulators['TSLA']), 0)
-            self.assertEqual(os.path.exists('data/TSLA.parquet'), True)
-            # TODO: assert that the required files exist on disk
+            files = ps.get_price_files('TSLA')
+            self.assertEqual(len(files), 2, msg='Each flush should write a new file')
+            self.assertEqual(pd.concat(map(pd.read_parquet, files))['bid'].tolist(), [10, 12, 14])
+
+    async def test_flush_on_buffer_size(self):
+        with tempfile.TemporaryDirectory() as folder:
+            ps = PriceStore(folder, frequency=60, max_buffer_ticks=3)
+
+            async def test():
+                await asyncio.sleep(0)
+                for i in range(3):
+                    ps.store_price('TSLA', {'t': i, 'bid': 10, 'ask': 11})
+                await asyncio.sleep(0.2)
+                self.assertEqual(len(ps.get_price_files('TSLA')), 1, msg='A full buffer should be flushed')
+                self.assertEqual(len(ps.accumulators['TSLA']), 0)
+                ps.stop()
+
+            await asyncio.wait_for(asyncio.gather(ps.start(), test()), timeout=5)
+            partition = os.path.join(folder, 'ticks', 'epic=TSLA', 'date=1970-01-01', 'hour=00')
+            self.assertEqual(len(os.listdir(partition)), 1, msg='No temporary files should be left behind')
+
+    async def test_partitioned_files(self):
+        hour = 3600 * 10 ** 9
+        with tempfile.TemporaryDirectory() as folder:
+            ps = PriceStore(folder)
+            for t in [hour - 1, 2, 1, hour + 5]:
+                ps.store_price('TSLA', {'t': t, 'bid': 10, 'ask': 11})
+            await ps.flush()
+            ps.store_price('TSLA', {'t': 3, 'bid': 10, 'ask': 11})
+            await ps.flush()
+
+            self.assertEqual(len(ps.get_price_files('TSLA')), 3)
+            self.assertEqual(len(ps.get_price_files('TSLA', hour, 2 * hour)), 1)
+            self.assertEqual(len(ps.get_price_files('TSLA', 4, 10)), 1, msg='Files should be pruned by time range')
+            self.assertEqual(len(ps.get_price_files('TSLA', hour + 6, 2 * hour)), 0)
 
-        return await asyncio.gather(ps.start(), test())
+            await ps.compact()
+            files = ps.get_price_files('TSLA')
+            self.assertEqual(len(files), 2, msg='Closed partitions should be compacted into a single file')
+            times = pd.read_parquet(files[0])['time_stamp'].astype('int64').tolist()
+            self.assertEqual(times, [1, 2, 3, hour - 1])
 
-    async def test_get_price_file(self):
+    async def test_get_price_dir(self):
         ps = PriceStore('./data', frequency=1)
-        self.assertEqual(ps.get_price_file('TSLA'), 'data/TSLA.parquet')
+        self.assertEqual(str(ps.get_price_dir('TSLA')), 'data/ticks/epic=TSLA')
 
     def test_parquet(self):
         self.skipTest('not needed yet')
@@ -1,7 +1,34 @@
 import asyncio
+import json
+import os
+import tempfile
 import unittest
 
-from app.modules.pub_sub import Publisher, subscribe
+import aiohttp
+
+from app.modules.broker_integrations.base_integration import TICK_BINARY, Tick, epic_table
+from app.modules.pub_sub import Message, Multiplexer, Publisher, Subscriber, TopicIndex, decode_records, \
+    subscribe, subscription_url
+
+
+class MockWebSocket:
+    """Records sent messages, sending blocks until released."""
+
+    def __init__(self):
+        self.messages = []
+        self.released = asyncio.Event()
+        self.closed = None
+
+    async def send_str(self, message):
+        await self.released.wait()
+        self.messages.append(message)
+
+    async def send_bytes(self, data):
+        await self.released.wait()
+        self.messages.append(data)
+
+    async def close(self, code, message):
+        self.closed = (code, message)
 
 
 class MyTestCase(unittest.IsolatedAsyncioTestCase):
@@ -39,6 +66,253 @@ class MyTestCase(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(results[-2], ['hello all', 'hello again', 'hello others'])
         self.assertEqual(results[-1], ['hello others'])
 
+    async def test_unix_subscribe(self):
+        pub = Publisher()
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'publisher.sock')
+
+        async def pause_broadcast():
+            await asyncio.sleep(0.2)
+            await pub.broadcast('tick:UNIX.A', '{"bid":1.5}')
+            await asyncio.sleep(0.1)
+            await pub.close()
+
+        async def first_message():
+            await asyncio.sleep(0.1)
+            async for message in subscribe(['tick:UNIX.A'], path=path):
+                return message
+
+        results = await asyncio.gather(pub.listen(path), pause_broadcast(), first_message())
+        self.assertEqual(results[-1], '{"bid":1.5}')
+
+    async def test_binary_subscribe(self):
+        pub = Publisher()
+        tick = Tick(epic_table.intern('PUB.A'), 1, 2, 1.5, 1.75)
+
+        async def pause_broadcast():
+            await asyncio.sleep(0.2)
+            await pub.broadcast('tick:PUB.A', tick)
+            await pub.broadcast('other', '{"a":1}')
+            await asyncio.sleep(0.1)
+            await pub.close()
+
+        async def first_frame():
+            await asyncio.sleep(0.1)
+            async for frame in subscribe(['tick:PUB.A', 'other'], encoding='binary', batch=50, compress=True):
+                return decode_records(frame)
+
+        results = await asyncio.gather(pub.listen(), pause_broadcast(), first_frame())
+        self.assertEqual(results[-1], [('tick:PUB.A', TICK_BINARY.pack(1, 2, 1.5, 1.75)), ('other', '{"a":1}')])
+
+
+class TopicIndexTestCase(unittest.TestCase):
+    def test_patterns(self):
+        index = TopicIndex()
+        self.assertEqual(index.subscribers('tick:CS.D.A'), set())
+        index.add('exact', ['tick:CS.D.A'])
+        index.add('pattern', ['tick:CS.D.*', 'tick:IG.*'])
+        self.assertEqual(index.subscribers('tick:CS.D.A'), {'exact', 'pattern'})
+        self.assertEqual(index.subscribers('tick:CS.D.B'), {'pattern'})
+        self.assertEqual(index.subscribers('ochl:1m:CS.D.A'), set())
+        self.assertEqual(index.counts(), {'tick:CS.D.A': 1, 'tick:CS.D.*': 1, 'tick:IG.*': 1})
+
+        # A topic stays subscribed while another subscription of the subscriber matches it.
+        index.add('exact', ['tick:*'])
+        index.remove('exact', ['tick:CS.D.A'])
+        self.assertEqual(index.subscribers('tick:CS.D.A'), {'exact', 'pattern'})
+        index.remove('exact', ['tick:*', 'unknown'])
+        self.assertEqual(index.subscribers('tick:CS.D.A'), {'pattern'})
+        self.assertEqual(index.topics('pattern'), ['tick:CS.D.*', 'tick:IG.*'])
+
+        index.discard('pattern')
+        self.assertEqual(index.subscribers('tick:CS.D.B'), set())
+        self.assertEqual(index.counts(), {})
+
+
+class ControlTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_control(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        path = os.path.join(folder.name, 'publisher.sock')
+        pub = Publisher()
+        listener = asyncio.create_task(pub.listen(path))
+        await asyncio.sleep(0.1)
+
+        async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path)) as session:
+            async with session.ws_connect(subscription_url(['tick:A'], path)) as ws:
+                await ws.send_json({'action': 'subscribe', 'topics': ['tick:CS.D.*']})
+                self.assertEqual(await ws.receive_json(), {'action': 'subscribe', 'topics': ['tick:A', 'tick:CS.D.*']})
+                await pub.broadcast('tick:CS.D.B', '{"b":1}')
+                await pub.broadcast('tick:B', '{"b":2}')
+                await pub.broadcast('tick:A', '{"a":1}')
+                self.assertEqual([await ws.receive_str(), await ws.receive_str()], ['{"b":1}', '{"a":1}'])
+
+                await ws.send_json({'action': 'unsubscribe', 'topics': ['tick:A']})
+                self.assertEqual(await ws.receive_json(), {'action': 'unsubscribe', 'topics': ['tick:CS.D.*']})
+                await ws.send_json({'action': 'list'})
+                self.assertEqual(await ws.receive_json(), {'action': 'list', 'topics': ['tick:CS.D.*']})
+                await ws.send_str('{"action": "watch"}')
+                self.assertIn('Unknown action', (await ws.receive_json())['error'])
+                await ws.send_str('[]')
+                self.assertIn('error', await ws.receive_json())
+                self.assertEqual(pub.stats(), {'tick:CS.D.*': 1})
+        await asyncio.sleep(0.05)
+        self.assertEqual(pub.stats(), {})
+        await pub.close()
+        await listener
+
+
+class MultiplexerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, 'publisher.sock')
+        self.pub = Publisher()
+        self.listener = asyncio.create_task(self.pub.listen(self.path))
+        await asyncio.sleep(0.1)
+
+    async def asyncTearDown(self):
+        await self.pub.close()
+        await self.listener
+
+    async def test_shared_upstream(self):
+        multiplexer = Multiplexer(self.path)
+        first, second = multiplexer.subscribe(['tick:A', 'tick:B']), multiplexer.subscribe(['tick:B'])
+        receive_first = asyncio.ensure_future(first.__anext__())
+        receive_second = asyncio.ensure_future(second.__anext__())
+        await asyncio.sleep(0.1)
+        # One upstream subscriber per topic, however many local subscribers.
+        self.assertEqual(self.pub.stats(), {'tick:A': 1, 'tick:B': 1})
+        self.assertEqual(multiplexer.stats()['topics'], {'tick:A': 1, 'tick:B': 2})
+
+        await self.pub.broadcast('tick:B', Tick(epic_table.intern('B'), 1, 2, 1.5, 1.75))
+        self.assertEqual(json.loads(await receive_first)['bid'], 1.5)
+        self.assertEqual(json.loads(await receive_second)['bid'], 1.5)
+        self.assertEqual(multiplexer.stats()['received'], 1)
+
+        await first.aclose()
+        await second.aclose()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.pub.stats(), {}, msg='The upstream subscription closes with the last local subscriber')
+        self.assertIsNone(multiplexer.upstream)
+
+    async def test_new_topics(self):
+        multiplexer = Multiplexer(self.path)
+        first = multiplexer.subscribe(['tick:A'])
+        receive_first = asyncio.ensure_future(first.__anext__())
+        await asyncio.sleep(0.1)
+        second = multiplexer.subscribe(['tick:C'])
+        receive_second = asyncio.ensure_future(second.__anext__())
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.pub.stats(), {'tick:A': 1, 'tick:C': 1})
+
+        await self.pub.broadcast('tick:C', '{"c":1}')
+        await self.pub.broadcast('tick:A', '{"a":1}')
+        self.assertEqual(await receive_second, '{"c":1}')
+        self.assertEqual(await receive_first, '{"a":1}')
+        self.assertEqual(multiplexer.reconnects, 0, msg='Topics are added over the open upstream subscription')
+
+        await second.aclose()
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.pub.stats(), {'tick:A': 1})
+        await multiplexer.close()
+
+    async def test_patterns(self):
+        multiplexer = Multiplexer(self.path)
+        pattern = multiplexer.subscribe(['tick:CS.D.*'])
+        receive = asyncio.ensure_future(pattern.__anext__())
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.pub.stats(), {'tick:CS.D.*': 1})
+        await self.pub.broadcast('tick:IG.A', '{"ig":1}')
+        await self.pub.broadcast('tick:CS.D.A', '{"cs":1}')
+        self.assertEqual(await receive, '{"cs":1}')
+        await multiplexer.close()
+
+
+class SubscriberTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_conflate(self):
+        ws = MockWebSocket()
+        subscriber = Subscriber(ws, 'conflate')
+        writer = asyncio.create_task(subscriber.write())
+        await asyncio.sleep(0)
+        subscriber.put(Message('a', 'a1'))
+        await asyncio.sleep(0)  # The writer is now blocked sending a1.
+        for message in ['a2', 'b1', 'a3', 'b2']:
+            subscriber.put(Message(message[0], message))
+        ws.released.set()
+        await asyncio.sleep(0.01)
+        writer.cancel()
+        self.assertEqual(ws.messages, ['a1', 'a3', 'b2'])
+        self.assertIsNone(ws.closed)
+
+    async def test_lossless_overflow(self):
+        ws = MockWebSocket()
+        subscriber = Subscriber(ws, maxsize=2)
+        for i in range(3):
+            subscriber.put(Message('a', str(i)))
+        await subscriber.closer
+        self.assertTrue(subscriber.closing)
+        self.assertEqual(ws.closed[0], 1013)
+
+    async def test_lagging(self):
+        ws = MockWebSocket()
+        subscriber = Subscriber(ws, 'drop_oldest', maxsize=2, max_lag=0.01)
+        for i in range(3):
+            subscriber.put(Message('a', str(i)))
+        self.assertFalse(subscriber.closing, msg='A full queue is tolerated for max_lag')
+        await asyncio.sleep(0.02)
+        subscriber.put(Message('a', '3'))
+        await asyncio.sleep(0)
+        self.assertEqual(ws.closed, (1013, b'Subscriber behind for over 0.01s'))
+        self.assertEqual(subscriber.stats()['dropped'], 2)
+
+    async def test_max_hz(self):
+        ws = MockWebSocket()
+        ws.released.set()
+        subscriber = Subscriber(ws, 'conflate', max_hz=20)
+        writer = asyncio.create_task(subscriber.write())
+        for i in range(10):
+            subscriber.put(Message('a', str(i)))
+            await asyncio.sleep(0.01)
+        writer.cancel()
+        self.assertLess(len(ws.messages), 5)
+        self.assertEqual(ws.messages[0], '0')
+
+    async def test_batch(self):
+        ws = MockWebSocket()
+        ws.released.set()
+        subscriber = Subscriber(ws, batch=0.01)
+        writer = asyncio.create_task(subscriber.write())
+        for i in range(3):
+            subscriber.put(Message('a', json.dumps({'i': i})))
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.02)
+        writer.cancel()
+        self.assertEqual(ws.messages, ['[{"i": 0},{"i": 1},{"i": 2}]'])
+        self.assertEqual(subscriber.stats()['frames'], 1)
+
+    def test_message(self):
+        class Payload:
+            encoded = 0
+
+            def to_json(self):
+                self.encoded += 1
+                return '{}'
+
+        payload = Payload()
+        message = Message('topic', payload)
+        for _ in range(3):
+            self.assertEqual(message.text, '{}')
+        self.assertEqual(payload.encoded, 1, msg='Messages are serialised once')
+        self.assertEqual(decode_records(message.record + Message('x', '[1]').record), [('topic', '{}'), ('x', '[1]')])
+
+    def test_policy(self):
+        with self.assertRaises(ValueError):
+            Subscriber(MockWebSocket(), 'latest')
+        with self.assertRaises(ValueError):
+            Subscriber(MockWebSocket(), encoding='msgpack')
+
 
 if __name__ == '__main__':
     unittest.main()
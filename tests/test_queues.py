@@ -0,0 +1,73 @@
+import asyncio
+import threading
+import unittest
+
+from app.modules.queues import BatchQueue
+
+
+class BatchQueueTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_batches(self):
+        queue = BatchQueue(maxsize=10)
+        for i in range(5):
+            queue.put_nowait(i)
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(await queue.get_batch(), [0, 1, 2, 3, 4])
+
+        consumer = asyncio.create_task(queue.get_batch())
+        await asyncio.sleep(0)
+        queue.put_nowait(5)
+        queue.put_nowait(6)
+        self.assertEqual(await consumer, [5, 6])
+        self.assertEqual(queue.stats()['drains'], 2)
+
+    async def test_block(self):
+        queue = BatchQueue(maxsize=2, policy='block')
+        queue.put_nowait(0)
+        queue.put_nowait(1)
+        with self.assertRaises(asyncio.QueueFull):
+            queue.put_nowait(2)
+
+        producer = asyncio.create_task(queue.put(2))
+        await asyncio.sleep(0)
+        self.assertFalse(producer.done())
+        self.assertEqual(await queue.get_batch(), [0, 1])
+        await producer
+        self.assertEqual(await queue.get_batch(), [2])
+        self.assertEqual(queue.dropped, 0)
+
+    async def test_drop_oldest(self):
+        queue = BatchQueue(maxsize=3, policy='drop_oldest')
+        for i in range(5):
+            queue.put_nowait(i)
+        self.assertEqual(await queue.get_batch(), [2, 3, 4])
+        self.assertEqual(queue.stats()['dropped'], 2)
+
+    async def test_conflate(self):
+        queue = BatchQueue(maxsize=2, policy='conflate', key=lambda item: item[0])
+        for item in [('A', 1), ('B', 1), ('A', 2), ('C', 1)]:
+            queue.put_nowait(item)
+        self.assertEqual(await queue.get_batch(), [('A', 2), ('C', 1)])
+        self.assertEqual(queue.dropped, 2)
+
+        with self.assertRaises(ValueError):
+            BatchQueue(policy='conflate')
+
+    async def test_threadsafe(self):
+        queue = BatchQueue(maxsize=100, policy='block')
+        items = []
+
+        def produce():
+            for i in range(1000):
+                queue.put_threadsafe(i)
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        while len(items) < 1000:
+            items.extend(await asyncio.wait_for(queue.get_batch(), 1))
+        thread.join()
+        self.assertEqual(items, list(range(1000)))
+        self.assertLess(queue.drains, 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
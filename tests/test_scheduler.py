@@ -0,0 +1,61 @@
+import asyncio
+import unittest
+
+from app.modules.broker_integrations.scheduler import ACCOUNT, MARKET_DATA, TRADING, RequestScheduler
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class RequestSchedulerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_priority_lanes(self):
+        scheduler = RequestScheduler({'all': (50, 1)})
+        order = []
+
+        async def request(name):
+            order.append(name)
+
+        await scheduler.submit(lambda: request('first'), ACCOUNT, ['all'])
+        tasks = [asyncio.create_task(scheduler.submit(lambda name=name: request(name), lane, ['all']))
+                 for name, lane in (('history', MARKET_DATA), ('positions', ACCOUNT), ('order', TRADING))]
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ['first', 'order', 'positions', 'history'])
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['lanes']['market_data']['queued'], 0)
+        self.assertEqual(stats['lanes']['account']['requests'], 2)
+        self.assertGreater(stats['lanes']['market_data']['max_wait'], stats['lanes']['trading']['max_wait'])
+
+    async def test_rate(self):
+        scheduler = RequestScheduler({'all': (100, 2)})
+
+        async def request():
+            return asyncio.get_running_loop().time()
+
+        times = await asyncio.gather(*(scheduler.submit(request, MARKET_DATA, ['all']) for _ in range(6)))
+        self.assertGreaterEqual(max(times) - min(times), 0.035)
+
+    async def test_retry(self):
+        scheduler = RequestScheduler({'all': (1000, 10)}, errors=(StatusError,), backoff=0.001)
+        statuses = [429, 503]
+
+        async def request():
+            if statuses:
+                raise StatusError(statuses.pop(0))
+            return 'ok'
+
+        self.assertEqual(await scheduler.submit(request, ACCOUNT, ['all']), 'ok')
+
+        statuses = [503]
+        with self.assertRaises(StatusError):
+            await scheduler.submit(request, TRADING, ['all'], idempotent=False)
+
+        statuses = [400]
+        with self.assertRaises(StatusError):
+            await scheduler.submit(request, ACCOUNT, ['all'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+from app.modules.broker_integrations.sessions import close_sessions, get_session
+
+
+class SessionsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await close_sessions()
+
+    async def test_session_per_host(self):
+        session = get_session('https://demo-api.ig.com/gateway/deal')
+        self.assertIs(get_session('https://demo-api.ig.com/gateway/deal/session'), session)
+        self.assertIsNot(get_session('https://api.ig.com/gateway/deal'), session)
+        self.assertEqual(session.connector.limit_per_host, 16)
+
+    async def test_close_sessions(self):
+        session = get_session('https://demo-api.ig.com/gateway/deal')
+        await close_sessions()
+        self.assertTrue(session.closed)
+        self.assertIsNot(get_session('https://demo-api.ig.com/gateway/deal'), session)
+
+
+if __name__ == '__main__':
+    unittest.main()
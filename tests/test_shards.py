@@ -0,0 +1,65 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from functools import partial
+from unittest import mock
+
+from app.modules.broker_integrations.base_integration import Tick, epic_table
+from app.modules.shards import ShardedStream, TickDecoder, TickEncoder, shard_epics
+
+
+async def fake_stream(epics, ticks=100, fail_once=None):
+    """Stream ticks numbered from 0, failing halfway the first time when fail_once is the path of a marker file."""
+    for i in range(ticks):
+        if fail_once is not None and i == ticks // 2 and not os.path.exists(fail_once):
+            open(fail_once, 'w', encoding='utf-8').close()
+            raise ConnectionError('Stream dropped')
+        yield Tick(epic_table.intern(epics[i % len(epics)]), i, i, float(i), float(i) + 0.5)
+        if i % 10 == 0:
+            await asyncio.sleep(0)
+
+
+class ShardsTestCase(unittest.IsolatedAsyncioTestCase):
+    def test_shard_epics(self):
+        self.assertEqual(shard_epics(['A', 'B', 'C', 'D', 'E'], 2), [['A', 'C', 'E'], ['B', 'D']])
+        self.assertEqual(shard_epics(['A'], 4), [['A']])
+
+    async def test_frames(self):
+        encoder, decoder = TickEncoder(), TickDecoder()
+        ticks = [Tick(epic_table.intern(epic), 1, 2, 1.5, 1.6) for epic in ['FRAME.A', 'FRAME.B', 'FRAME.A']]
+        reader = asyncio.StreamReader()
+        reader.feed_data(encoder.encode(ticks))
+        reader.feed_data(encoder.encode(ticks[:1]))
+        reader.feed_data(b'\0' * 8)
+
+        self.assertEqual(await decoder.read(reader), ticks)
+        self.assertEqual(await decoder.read(reader), ticks[:1])
+        self.assertIsNone(await decoder.read(reader))
+        # Epic names are only sent in the first frame using them.
+        self.assertEqual(len(encoder.encode(ticks)), 8 + 3 * 36)
+
+    async def test_sharded_stream(self):
+        sharded = ShardedStream(partial(fake_stream, ticks=100), 2)
+        ticks = [tick async for tick in sharded.stream(['SHARD.A', 'SHARD.B', 'SHARD.C'])]
+        self.assertEqual(len(ticks), 200)
+        self.assertEqual({tick.epic for tick in ticks}, {'SHARD.A', 'SHARD.B', 'SHARD.C'})
+        self.assertEqual(sorted(tick.bid for tick in ticks if tick.epic == 'SHARD.B'), [float(i) for i in range(100)])
+
+    async def test_no_executor(self):
+        """Tests that waiting for shard processes does not hold threads of the default executor."""
+        loop = asyncio.get_running_loop()
+        with mock.patch.object(loop, 'run_in_executor', side_effect=AssertionError('Default executor used')):
+            ticks = [tick async for tick in ShardedStream(partial(fake_stream, ticks=10), 2).stream(['WAIT.A'])]
+        self.assertEqual(len(ticks), 10)
+
+    async def test_shard_restart(self):
+        with tempfile.TemporaryDirectory() as folder:
+            sharded = ShardedStream(partial(fake_stream, ticks=20, fail_once=os.path.join(folder, 'failed')), 1)
+            ticks = [tick async for tick in sharded.stream(['RESTART.A'])]
+        self.assertEqual(sharded.restarts, 1)
+        self.assertEqual([tick.bid for tick in ticks][-20:], [float(i) for i in range(20)])
+
+
+if __name__ == '__main__':
+    unittest.main()
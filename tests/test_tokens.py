@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+from app.modules.broker_integrations.tokens import TokenManager, stop_token_managers
+
+
+class TokenManagerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_single_flight(self):
+        calls = []
+
+        async def acquire():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return f'token-{len(calls)}'
+
+        manager = TokenManager(acquire, ttl=60)
+        tokens = await asyncio.gather(*(manager.get() for _ in range(10)))
+        self.assertEqual(tokens, ['token-1'] * 10)
+        self.assertEqual(await manager.get(), 'token-1')
+        self.assertEqual(len(calls), 1)
+        manager.stop()
+
+    async def test_cancelled_caller(self):
+        async def acquire():
+            await asyncio.sleep(0.02)
+            return 'token'
+
+        manager = TokenManager(acquire, ttl=60)
+        cancelled = asyncio.create_task(manager.get())
+        waiting = asyncio.create_task(manager.get())
+        await asyncio.sleep(0.005)
+        cancelled.cancel()
+        self.assertEqual(await waiting, 'token')
+        manager.stop()
+
+    async def test_failure(self):
+        results = [ValueError('login failed'), 'token']
+
+        async def acquire():
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        manager = TokenManager(acquire, ttl=60)
+        with self.assertRaises(ValueError):
+            await manager.get()
+        self.assertEqual(await manager.get(), 'token')
+        manager.stop()
+
+    async def test_background_renewal(self):
+        calls = []
+
+        async def acquire():
+            calls.append(None)
+            return f'token-{len(calls)}'
+
+        manager = TokenManager(acquire, ttl=0.1, margin=0.05)
+        self.assertEqual(await manager.get(), 'token-1')
+        await asyncio.sleep(0.12)
+        self.assertTrue(manager.valid)
+        self.assertGreaterEqual(len(calls), 2)
+        self.assertEqual(await manager.get(), f'token-{len(calls)}')
+        manager.stop()
+
+    async def test_stop_token_managers(self):
+        async def acquire():
+            return 'token'
+
+        registries = [{'a': TokenManager(acquire, ttl=60)}, {'b': TokenManager(acquire, ttl=60)}]
+        for registry in registries:
+            await next(iter(registry.values())).get()
+        # pylint: disable=protected-access
+        renewals = [manager._renewal for registry in registries for manager in registry.values()]
+        stop_token_managers(*registries)
+        await asyncio.gather(*renewals, return_exceptions=True)
+        self.assertTrue(all(renewal.cancelled() for renewal in renewals))
+
+
+if __name__ == '__main__':
+    unittest.main()